@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     assets.py
+#
+#     Collects the images of a document before it is built. Images with the
+#     same asset key are placed once by the script, which duplicates the frame
+#     for the other occurrences. The key is made from the path of the image,
+#     or optionally from its content, so copies of an image at other paths
+#     are placed once too. Optionally a downsampled proxy is made of images
+#     that are placed much smaller than their resolution, if Pillow is
+#     installed.
+#
+import hashlib
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image as PILImage
+    from PIL import ImageOps
+except ImportError:
+    PILImage = None
+
+from pagebot.toolbox.units import upt
+from indesigncontext.imagesize import ImageSizeCache
+
+# Default resolution of proxies in pixels per inch of the placed size.
+PROXY_RESOLUTION = 150
+# Images that need more than this fraction of their pixels are used as they are.
+MAX_PROXY_SCALE = 0.8
+# Extensions of the image files that are downsampled.
+PROXY_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+def makeProxy(path, proxyPath, size):
+    """Save the image at path, resized to size (w, h) pixels, as proxyPath.
+    The image is rotated by its EXIF orientation first, as size is the
+    displayed size from imagesize.readImageSize(), and the proxy has no
+    orientation. The file is written under a temporary name first, so
+    parallel builds never see a partial proxy.
+
+    >>> import os, tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> path = os.path.join(folder, 'rotated.jpg')
+    >>> exif = PILImage.Exif()
+    >>> exif[0x0112] = 6 # Orientation, rotated 90 degrees clockwise.
+    >>> im = PILImage.new('L', (400, 100))
+    >>> im.paste(255, (0, 0, 200, 100)) # Left half is white, displayed as top half.
+    >>> im.save(path, exif=exif)
+    >>> from indesigncontext.imagesize import readImageSize
+    >>> readImageSize(path)
+    (100, 400)
+    >>> proxyPath = makeProxy(path, os.path.join(folder, 'proxy.jpg'), (25, 100))
+    >>> with PILImage.open(proxyPath) as im:
+    ...     im.size, im.getexif().get(0x0112), im.getpixel((12, 10)) > 128, im.getpixel((12, 90)) > 128
+    ((25, 100), None, True, False)
+    """
+    tmpPath = '%s.%d.tmp%s' % (proxyPath, os.getpid(), os.path.splitext(proxyPath)[1])
+    try:
+        with PILImage.open(path) as im:
+            im = ImageOps.exif_transpose(im)
+            im = im.resize(size, PILImage.LANCZOS)
+            if proxyPath.lower().endswith(('.jpg', '.jpeg')):
+                im.save(tmpPath, quality=90)
+            else:
+                im.save(tmpPath)
+        os.replace(tmpPath, proxyPath)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+    return proxyPath
+
+class AssetStage:
+    """Asset keys and proxies of the images of a document. Call self.add()
+    for every placed image, then self.build() to make the proxies, then
+    self.get(path) answers the (path, key) to place. If proxyFolder is
+    None, no proxies are made. Proxy names contain the asset key and size,
+    so existing proxies are used again by the next builds. The sizes and
+    content hashes of the images are read through the imagesize.ImageSizeCache
+    sizes, if it is given. If dedupe is True, the key is made from the
+    content of the image, otherwise from its path, modification time and
+    file size, so the images are not read.
+
+    >>> import os, shutil, tempfile
+    >>> path = os.path.join(os.path.dirname(__file__), 'resources/images/cookbot10.jpg')
+    >>> assets = AssetStage()
+    >>> assets.add(path, 100, 50)
+    >>> assets.build()
+    >>> placedPath, key = assets.get(path)
+    >>> placedPath == path, len(key)
+    (True, 16)
+    >>> copyPath = shutil.copy(path, tempfile.mkdtemp())
+    >>> assets.getKey(copyPath) == key
+    False
+    >>> assets = AssetStage(dedupe=True)
+    >>> assets.getKey(copyPath) == assets.getKey(path)
+    True
+    >>> assets = AssetStage(proxyFolder='proxies')
+    >>> assets.add(path, 100, 50)
+    >>> assets.add(path, 200, 50) # Proxy is made for the largest placed size.
+    >>> [(os.path.basename(proxyPath) == key + '-417x192.jpg', size) for key, path, proxyPath, size in assets.getProxies()]
+    [(True, (417, 192))]
+    """
+    def __init__(self, proxyFolder=None, resolution=PROXY_RESOLUTION, maxWorkers=None,
+            sizes=None, dedupe=False):
+        self.proxyFolder = proxyFolder
+        self.resolution = resolution
+        self.maxWorkers = maxWorkers
+        if sizes is None: # Cache of this stage only.
+            sizes = ImageSizeCache(None)
+        self.sizes = sizes
+        self.dedupe = dedupe
+        self.hits = 0 # Number of proxies that already existed.
+        self.misses = 0 # Number of proxies that were made.
+        self.reset()
+
+    def reset(self):
+        """Forget the images of the previous document."""
+        self._keys = {} # Path --> asset key, None if the file cannot be read.
+        self._imageSizes = {} # Path --> (w, h) or None.
+        self._sources = {} # Asset key --> path of the first image with that key.
+        self._scales = {} # Asset key --> largest scale of the placed pixel size.
+        self._proxies = {} # Asset key --> path of the proxy.
+
+    def getKey(self, path):
+        """Answers the asset key of the image at path, or None if the file
+        cannot be read."""
+        if path in self._keys:
+            return self._keys[path]
+        key = None
+        if self.dedupe:
+            contentHash = self.sizes.getHash(path)
+            if contentHash is not None:
+                key = contentHash[:16]
+        else:
+            try:
+                stat = os.stat(path)
+                key = hashlib.sha1(repr((os.path.abspath(path), stat.st_mtime, stat.st_size)).encode('utf-8')).hexdigest()[:16]
+            except OSError:
+                pass
+        self._keys[path] = key
+        return key
+
+    def getSize(self, path):
+        """Answers the (w, h) pixel size of the image at path, or None if it
+        cannot be read."""
+        if path not in self._imageSizes:
+            self._imageSizes[path] = self.sizes.get(path)
+        return self._imageSizes[path]
+
+    def add(self, path, w, h):
+        """Add an occurrence of the image at path, placed in a frame of w
+        by h. Only the largest placement of each asset is kept."""
+        key = self.getKey(path)
+        if key is None:
+            return
+        self._sources.setdefault(key, path)
+        size = self.getSize(path)
+        if size is None or not size[0] or not size[1]:
+            return
+        w, h = upt(w, h)
+        # Scale that keeps the resolution in both directions, also for
+        # images that are not placed proportionally.
+        scale = max(w * self.resolution / 72 / size[0], h * self.resolution / 72 / size[1])
+        self._scales[key] = max(scale, self._scales.get(key, 0))
+
+    def getProxies(self):
+        """Answers the list of (key, path, proxyPath, size) of the images that
+        need a proxy of size (w, h) pixels, for their largest placement."""
+        proxies = []
+        if self.proxyFolder is None:
+            return proxies
+        for key, scale in self._scales.items():
+            path = self._sources[key]
+            extension = os.path.splitext(path)[1].lower()
+            if scale > MAX_PROXY_SCALE or extension not in PROXY_EXTENSIONS:
+                continue
+            w, h = self.getSize(path)
+            size = max(1, int(math.ceil(w * scale))), max(1, int(math.ceil(h * scale)))
+            proxyPath = os.path.join(self.proxyFolder, '%s-%dx%d%s' % (key, size[0], size[1], extension))
+            proxies.append((key, path, proxyPath, size))
+        return proxies
+
+    def build(self):
+        """Make the missing proxies, in parallel threads."""
+        if PILImage is None:
+            return
+        jobs = []
+        for key, path, proxyPath, size in self.getProxies():
+            self._proxies[key] = proxyPath
+            if os.path.exists(proxyPath):
+                self.hits += 1
+            else:
+                jobs.append((path, proxyPath, size))
+        if not jobs:
+            return
+        if not os.path.exists(self.proxyFolder):
+            os.makedirs(self.proxyFolder)
+        self.misses += len(jobs)
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            for path, proxyPath, size in jobs:
+                executor.submit(makeProxy, path, proxyPath, size)
+        for path, proxyPath, size in jobs: # Use the original if the proxy failed.
+            if not os.path.exists(proxyPath):
+                del self._proxies[self.getKey(path)]
+
+    def get(self, path):
+        """Answers the (path, key) of the image to place for path: the path
+        of the proxy or path itself, and the asset key, None if unknown."""
+        key = self.getKey(path)
+        return self._proxies.get(key, path), key
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
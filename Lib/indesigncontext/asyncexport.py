@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     asyncexport.py
+#
+#     Exports a document as a sequence of script chunks. The document is built
+#     in a background thread, with the builder streaming into a bounded queue,
+#     so generation overlaps with writing the chunks to a file or response.
+#
+import asyncio
+import gzip
+import queue
+import threading
+
+# Default maximum number of chunks that are generated ahead of the consumer.
+MAX_CHUNKS = 16
+# Name given to doc.export, to make it save as script.
+SCRIPT_NAME = 'document.js'
+
+class ExportCancelled(Exception):
+    """Raised in the building thread when the consumer stopped reading."""
+
+class QueueStream:
+    """File-like object for InDesignBuilder.openStream, that hands the
+    written chunks to put(chunk). It raises ExportCancelled once
+    self.cancelled is set, to stop the building thread."""
+    def __init__(self, put):
+        self.put = put
+        self.cancelled = False
+
+    def write(self, s):
+        if self.cancelled:
+            raise ExportCancelled()
+        self.put(s)
+
+    def flush(self):
+        pass
+
+_END = object()
+
+def _startExport(doc, stream, put, bufferSize):
+    """Start a thread that builds doc with its builder streaming to stream,
+    and puts the end marker, or the exception, when done. If the build is
+    cancelled or fails, the builder stops streaming first, so the context
+    can export again."""
+    def run():
+        result = _END
+        try:
+            doc.context.openStream(stream, bufferSize=bufferSize)
+            doc.export(SCRIPT_NAME) # Streaming, saveDocument only closes the stream.
+            doc.context.b.closeStream()
+        except ExportCancelled:
+            pass
+        except BaseException as e:
+            result = e
+        finally:
+            if doc.context.b.isStreaming:
+                doc.context.b.resetStream()
+        put(result)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def iterChunks(doc, bufferSize=None, maxChunks=MAX_CHUNKS):
+    """Generator of the script chunks of doc, an exportable Document with
+    an InDesignContext. The chunks are about bufferSize characters. At most
+    maxChunks are generated ahead, so memory stays bounded. Exceptions of
+    the build are raised here. Closing the generator cancels the build.
+
+    >>> from indesigncontext.context import InDesignContext
+    >>> class Doc:
+    ...     def __init__(self):
+    ...         self.context = InDesignContext()
+    ...     def export(self, path):
+    ...         for n in range(3):
+    ...             self.context.b._out('var a%d;' % n)
+    >>> doc = Doc()
+    >>> list(iterChunks(doc, bufferSize=8))
+    ['var a0;\\n', 'var a1;\\n', 'var a2;\\n', '\\n\\n\\n']
+    >>> chunks = iterChunks(doc, bufferSize=8, maxChunks=1)
+    >>> next(chunks)
+    'var a0;\\n'
+    >>> chunks.close() # Cancels the build, the context can export again.
+    >>> doc.context.b.isStreaming, len(list(iterChunks(doc, bufferSize=8)))
+    (False, 4)
+    """
+    chunks = queue.Queue(maxChunks)
+    stream = QueueStream(chunks.put)
+    thread = _startExport(doc, stream, chunks.put, bufferSize)
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _END:
+                break
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        stream.cancelled = True
+        while thread.is_alive(): # Unblock the thread if it waits for space.
+            try:
+                chunks.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        thread.join()
+
+async def aiterChunks(doc, bufferSize=None, maxChunks=MAX_CHUNKS):
+    """Asynchronous generator of the script chunks of doc, see iterChunks.
+    The event loop is not blocked by the build, so the chunks can be
+    streamed into an HTTP response while the document is generated.
+
+    >>> import asyncio
+    >>> from indesigncontext.context import InDesignContext
+    >>> class Doc:
+    ...     def __init__(self):
+    ...         self.context = InDesignContext()
+    ...     def export(self, path):
+    ...         self.context.b._out('var a;')
+    >>> async def collect(doc):
+    ...     return [chunk async for chunk in aiterChunks(doc)]
+    >>> asyncio.run(collect(Doc()))
+    ['var a;\\n', '\\n\\n\\n']
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(maxChunks)
+    def put(chunk): # Called in the building thread, waits while the queue is full.
+        asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+    stream = QueueStream(put)
+    thread = _startExport(doc, stream, put, bufferSize)
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is _END:
+                break
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        stream.cancelled = True
+        while thread.is_alive():
+            try:
+                chunks.get_nowait()
+            except asyncio.QueueEmpty:
+                await asyncio.sleep(0.01)
+        await loop.run_in_executor(None, thread.join)
+
+async def exportAsync(doc, path, compress=None, bufferSize=None, maxChunks=MAX_CHUNKS):
+    """Export the script of doc to path, without blocking the event loop:
+    the chunks are generated in one thread and written in another. If
+    compress is True, or None and path ends with .gz, then the file is
+    gzip compressed. Answers the number of characters written.
+
+    >>> import asyncio, gzip, os, tempfile
+    >>> from indesigncontext.context import InDesignContext
+    >>> class Doc:
+    ...     def __init__(self):
+    ...         self.context = InDesignContext()
+    ...     def export(self, path):
+    ...         self.context.b._out('var a;')
+    >>> path = os.path.join(tempfile.mkdtemp(), 'document.js.gz')
+    >>> asyncio.run(exportAsync(Doc(), path))
+    10
+    >>> gzip.open(path, 'rt').read()
+    'var a;\\n\\n\\n\\n'
+    """
+    if compress is None:
+        compress = path.endswith('.gz')
+    loop = asyncio.get_running_loop()
+    if compress:
+        f = await loop.run_in_executor(None, lambda: gzip.open(path, 'wt', encoding='utf-8'))
+    else:
+        f = await loop.run_in_executor(None, lambda: open(path, 'w', encoding='utf-8'))
+    size = 0
+    try:
+        pending = None # Write of the previous chunk, overlapping with the next one.
+        async for chunk in aiterChunks(doc, bufferSize=bufferSize, maxChunks=maxChunks):
+            if pending is not None:
+                await pending
+            pending = loop.run_in_executor(None, f.write, chunk)
+            size += len(chunk)
+        if pending is not None:
+            await pending
+    finally:
+        await loop.run_in_executor(None, f.close)
+    return size
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     batch.py
+#
+#     Exports many documents in parallel worker processes. Each worker has
+#     its own InDesignContext and builder, so their state is not shared.
+#
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+def exportDocument(factory, path, **contextKwargs):
+    """Make a new InDesignContext with the contextKwargs options (such as
+    compact, incremental or cull), let factory(context) answer the Document
+    and export it to path. Answers a dictionary with path, seconds and the
+    error traceback (None if export succeeded). This runs in the worker
+    process, so factory must be a module-level function."""
+    from indesigncontext.context import InDesignContext
+    t = time.time()
+    try:
+        context = InDesignContext(**contextKwargs)
+        doc = factory(context)
+        doc.export(path)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return dict(path=path, seconds=time.time() - t, error=error)
+
+def _failed(path, error):
+    return dict(path=path, seconds=0, error=error)
+
+def exportDocuments(jobs, maxWorkers=None, **contextKwargs):
+    """Export the (factory, path) jobs in a pool of maxWorkers processes
+    (default is the number of CPUs). factory(context) answers the Document
+    to export to path, with an InDesignContext made with the contextKwargs
+    options. Answers the list of result dictionaries of exportDocument, in
+    the order of jobs. A failing document reports its error without
+    stopping the others. If a worker process dies, the jobs that did not
+    finish yet are retried one by one in their own process, so only the job
+    that crashed is reported as failed.
+
+    >>> import functools, os, tempfile
+    >>> from indesigncontext.benchmark import makeDocument
+    >>> folder = tempfile.mkdtemp()
+    >>> factory = functools.partial(makeDocument, pages=1, elementsPerPage=4, colors=2, textRuns=1, images=0)
+    >>> jobs = [(factory, os.path.join(folder, 'Good.js')), (lambda context: None, os.path.join(folder, 'Bad.js'))]
+    >>> results = exportDocuments(jobs, maxWorkers=2, compact=True)
+    >>> [os.path.basename(result['path']) for result in results]
+    ['Good.js', 'Bad.js']
+    >>> results[0]['error'] is None, os.path.exists(results[0]['path'])
+    (True, True)
+    >>> 'Traceback' in results[1]['error'] # A lambda cannot be sent to a worker.
+    True
+    """
+    jobs = list(jobs)
+    results = [None] * len(jobs)
+    retry = []
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        futures = {}
+        for index, (factory, path) in enumerate(jobs):
+            futures[executor.submit(exportDocument, factory, path, **contextKwargs)] = index
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except BrokenProcessPool:
+                retry.append(index)
+            except Exception: # E.g. the factory could not be pickled.
+                results[index] = _failed(jobs[index][1], traceback.format_exc())
+    for index in sorted(retry):
+        factory, path = jobs[index]
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                results[index] = executor.submit(exportDocument, factory, path, **contextKwargs).result()
+            except Exception:
+                results[index] = _failed(path, traceback.format_exc())
+    return results
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
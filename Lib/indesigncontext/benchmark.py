@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     benchmark.py
+#
+#     Times the InDesign export pipeline on synthetic documents of several
+#     sizes, and saves the results as JSON, to compare versions.
+#
+#     python -m indesigncontext.benchmark --scale small medium -o bench.json
+#
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Synthetic document sizes.
+SCALES = dict(
+    tiny=dict(pages=2, elementsPerPage=10, colors=4, textRuns=1, images=1),
+    small=dict(pages=20, elementsPerPage=40, colors=16, textRuns=2, images=2),
+    medium=dict(pages=100, elementsPerPage=100, colors=64, textRuns=4, images=4),
+    large=dict(pages=400, elementsPerPage=200, colors=256, textRuns=8, images=8),
+)
+# Element types that are timed, in the order they are built on a page.
+ELEMENT_TYPES = ('rect', 'oval', 'textBox', 'image')
+
+IMAGE_PATH = os.path.join(os.path.dirname(__file__), 'resources/images/cookbot10.jpg')
+WORDS = 'PageBot builds InDesign documents from Python scripts'.split()
+
+def makeDocument(context, pages, elementsPerPage, colors, textRuns, images, seed=0):
+    """Answers a Document with random rects, ovals, text boxes of textRuns
+    styled runs and images, in a palette of colors. Every page has
+    elementsPerPage elements, of which images are Image elements. The same
+    seed makes the same document."""
+    from pagebot.document import Document
+    from pagebot.elements import newRect, newOval, newTextBox, Image
+    from pagebot.toolbox.color import color
+    from pagebot.toolbox.units import pt
+
+    rnd = random.Random(seed)
+    palette = [color(rnd.random(), rnd.random(), rnd.random()) for _ in range(colors)]
+    doc = Document(w=595, h=842, context=context, autoPages=pages)
+    styles = [dict(fontSize=pt(8 + 2 * n), leading=pt(10 + 2 * n), textFill=palette[n % colors])
+        for n in range(textRuns)]
+    for pn in range(1, pages + 1):
+        page = doc[pn]
+        for n in range(elementsPerPage):
+            x, y = pt(rnd.randint(0, 500)), pt(rnd.randint(0, 740))
+            w, h = pt(rnd.randint(10, 95)), pt(rnd.randint(10, 100))
+            fill = rnd.choice(palette)
+            if n < images:
+                Image(IMAGE_PATH, parent=page, x=x, y=y, w=w, h=h, fill=fill)
+            elif n % 3 == 0:
+                bs = None
+                for style in styles:
+                    s = context.newString(' '.join(rnd.sample(WORDS, 3)) + ' ', style=style)
+                    bs = s if bs is None else bs + s
+                newTextBox(bs, parent=page, x=x, y=y, w=w, h=h, fill=fill)
+            elif n % 3 == 1:
+                newOval(parent=page, x=x, y=y, w=w, h=h, fill=fill)
+            else:
+                newRect(parent=page, x=x, y=y, w=w, h=h, fill=fill,
+                    stroke=rnd.choice(palette), strokeWidth=pt(1))
+    return doc
+
+def getElementType(e):
+    """Answers the name of the builder method that draws e."""
+    name = e.__class__.__name__
+    if name == 'Image':
+        return 'image'
+    if name == 'TextBox':
+        return 'textBox'
+    if name == 'Oval':
+        return 'oval'
+    return 'rect'
+
+def buildDocument(context, doc, timings, counts):
+    """Build doc by the builder of context, the same calls as the view of
+    an export makes. The time of each element type is added to timings."""
+    b = context.b
+    t = time.perf_counter()
+    b.newDocument(doc=doc)
+    timings['newDocument'] += time.perf_counter() - t
+    for pn, pnPages in doc.getSortedPages():
+        for page in pnPages:
+            t = time.perf_counter()
+            b.newPage(page=page)
+            timings['newPage'] += time.perf_counter() - t
+            byType = dict((elementType, []) for elementType in ELEMENT_TYPES)
+            for e in page.elements:
+                byType[getElementType(e)].append(e)
+            for elementType in ELEMENT_TYPES:
+                elements = byType[elementType]
+                t = time.perf_counter()
+                if elementType == 'rect':
+                    for e in elements:
+                        b.rect(e.x, e.y, e=e)
+                elif elementType == 'oval':
+                    for e in elements:
+                        b.oval(e.x, e.y, e=e)
+                elif elementType == 'textBox':
+                    for e in elements:
+                        b.textBox(e.bs, (e.x, e.y), e=e)
+                else:
+                    for e in elements:
+                        b.image(e.path, (e.x, e.y), e=e)
+                timings[elementType] += time.perf_counter() - t
+                counts[elementType] += len(elements)
+
+def runOnce(params, folder, compact=False, seed=0):
+    """Answers the (timings, counts, outputSize) of one export of a
+    synthetic document of params."""
+    from indesigncontext.context import InDesignContext
+    timings = dict.fromkeys(('context', 'document', 'newDocument', 'newPage') +
+        ELEMENT_TYPES + ('getOut', 'saveDocument'), 0)
+    counts = dict.fromkeys(ELEMENT_TYPES, 0)
+    t = time.perf_counter()
+    context = InDesignContext(compact=compact)
+    timings['context'] = time.perf_counter() - t
+    t = time.perf_counter()
+    doc = makeDocument(context, seed=seed, **params)
+    timings['document'] = time.perf_counter() - t
+    buildDocument(context, doc, timings, counts)
+    t = time.perf_counter()
+    outputSize = len(context.b.getOut().encode('utf-8'))
+    timings['getOut'] = time.perf_counter() - t
+    path = os.path.join(folder, 'benchmark.js')
+    t = time.perf_counter()
+    context.b.saveDocument(path)
+    timings['saveDocument'] = time.perf_counter() - t
+    return timings, counts, outputSize
+
+def runScale(name, params, repeat=3, compact=False):
+    """Answers the result dictionary of the scale. Times are the minimum of
+    repeat runs, peak memory is measured in an extra run with tracemalloc,
+    as tracing slows down the timed runs."""
+    with tempfile.TemporaryDirectory() as folder:
+        best = None
+        for _ in range(repeat):
+            timings, counts, outputSize = runOnce(params, folder, compact=compact)
+            if best is None:
+                best = timings
+            else:
+                best = dict((key, min(value, timings[key])) for key, value in best.items())
+        tracemalloc.start()
+        runOnce(params, folder, compact=compact)
+        peakMemory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    elements = sum(counts.values())
+    buildTime = sum(best[key] for key in ('newDocument', 'newPage') + ELEMENT_TYPES)
+    throughput = dict((elementType, counts[elementType] / best[elementType])
+        for elementType in ELEMENT_TYPES if counts[elementType] and best[elementType])
+    if buildTime:
+        throughput['elements'] = elements / buildTime
+    if best['saveDocument']:
+        throughput['outputBytes'] = outputSize / best['saveDocument']
+    return dict(scale=name, params=params, compact=compact, repeat=repeat,
+        elements=elements, counts=counts, timings=best, throughput=throughput,
+        peakMemory=peakMemory, outputSize=outputSize)
+
+def runBenchmarks(scales=('small',), repeat=3, compact=False):
+    """Answers the benchmark report of the named scales, as dictionary
+    that can be saved as JSON."""
+    results = [runScale(name, SCALES[name], repeat=repeat, compact=compact) for name in scales]
+    return dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+        platform=platform.platform(), results=results)
+
+def printReport(report, f=sys.stdout):
+    for result in report['results']:
+        f.write('%s: %d elements, %d bytes, peak memory %.1f MB\n' % (result['scale'],
+            result['elements'], result['outputSize'], result['peakMemory'] / 1e6))
+        for key, value in result['timings'].items():
+            f.write('    %-14s %9.4fs\n' % (key, value))
+        for key, value in result['throughput'].items():
+            f.write('    %-14s %9.0f/s\n' % (key, value))
+
+def printComparison(report, previous, f=sys.stdout):
+    """Print the ratio of the timings in report to the timings of the same
+    scales in the previous report. Ratios above 1 are slower."""
+    previousResults = dict((result['scale'], result) for result in previous['results'])
+    for result in report['results']:
+        previousResult = previousResults.get(result['scale'])
+        if previousResult is None or previousResult['params'] != result['params']:
+            continue
+        f.write('%s compared to %s:\n' % (result['scale'], previous['time']))
+        for key, value in result['timings'].items():
+            previousValue = previousResult['timings'].get(key)
+            if previousValue:
+                f.write('    %-14s %9.2fx\n' % (key, value / previousValue))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the InDesign export pipeline.')
+    parser.add_argument('--scale', nargs='+', default=['small'], choices=sorted(SCALES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compact', action='store_true', help='Build in compact row mode.')
+    parser.add_argument('-o', '--output', help='Path of the JSON results file.')
+    parser.add_argument('--compare', help='Path of a previous JSON results file.')
+    args = parser.parse_args(args)
+    report = runBenchmarks(args.scale, repeat=args.repeat, compact=args.compact)
+    printReport(report)
+    if args.compare:
+        with open(args.compare) as f:
+            printComparison(report, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     bulk.py
+#
+#     Geometry of many frames at once, for InDesignBuilder.rects() and
+#     InDesignBuilder.ovals(). Uses NumPy if it is installed, otherwise the
+#     same values are calculated by plain Python.
+#
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pagebot.toolbox.units import upt
+
+# Number of decimals of bounds in the output, same as idml.fmt()
+DECIMALS = 4
+# Format of a rounded bound, without trailing zeros, same as idml.fmt()
+BOUND_FORMAT = '%.10g'
+
+def isSequence(v):
+    """Answers True if v is a list, tuple or array of values, instead of a
+    single value."""
+    if numpy is not None and isinstance(v, numpy.ndarray):
+        return v.ndim > 0
+    return isinstance(v, (list, tuple, range))
+
+def _asValues(v):
+    """Answers v as array (or list) of pt values. Arrays are used as they
+    are, to avoid the Unit conversion per value."""
+    if isinstance(v, range):
+        v = list(v)
+    if numpy is not None:
+        if isinstance(v, numpy.ndarray):
+            return v.astype(float)
+        return numpy.asarray(upt(v), dtype=float)
+    if isSequence(v):
+        return [float(vv) for vv in upt(v)]
+    return float(upt(v))
+
+def getBounds(x, y, w, h, originTop=True):
+    """Answers the list of rounded bounds of the frames defined by x, y, w
+    and h. Each of them is a sequence, or a single value for all frames. The
+    values are in the same order as the bounds of single frames in the rows
+    of InDesignBuilder.rect, from the (top, right, bottom, left) of getXY.
+
+    >>> getBounds([0, 10], [0, 20], 100, 50)
+    [[100.0, 0.0, 0.0, 50.0], [110.0, 20.0, 10.0, 70.0]]
+    >>> getBounds([10], [20], [1/3], 50, originTop=False)
+    [[10.3333, 70.0, 10.0, 20.0]]
+    """
+    x, y, w, h = _asValues(x), _asValues(y), _asValues(w), _asValues(h)
+    if numpy is not None:
+        x, y, w, h = numpy.broadcast_arrays(x, y, w, h)
+        if originTop:
+            top, bottom = y, y + h
+        else:
+            top, bottom = y + h, y
+        # Adding 0.0 turns the -0.0 of rounding into 0.0
+        bounds = numpy.round(numpy.stack((x + w, top, x, bottom), axis=-1), DECIMALS) + 0.0
+        return numpy.atleast_2d(bounds).tolist()
+    n = max([len(v) for v in (x, y, w, h) if isinstance(v, list)] or [1])
+    x, y, w, h = [v if isinstance(v, list) else [v] * n for v in (x, y, w, h)]
+    bounds = []
+    for xx, yy, ww, hh in zip(x, y, w, h):
+        if originTop:
+            top, bottom = yy, yy + hh
+        else:
+            top, bottom = yy + hh, yy
+        bounds.append([round(v, DECIMALS) + 0.0 for v in (xx + ww, top, xx, bottom)])
+    return bounds
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
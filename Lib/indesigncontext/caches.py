@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     caches.py
+#
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+def saveJson(path, data):
+    """Write data as JSON file at path. The file is written under a unique
+    temporary name in the same folder first, so processes that save the
+    same cache at the same time never replace each other's partial files.
+    Caches are only an optimization, so answers False instead of raising if
+    the file cannot be written.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'cache', 'data.json')
+    >>> saveJson(path, dict(a=1)), open(path).read()
+    (True, '{"a": 1}')
+    >>> saveJson(os.path.join(path, 'data.json'), {}) # Folder is a file.
+    False
+    """
+    folder = os.path.dirname(path) or '.'
+    try:
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=folder)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmpPath, path)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+    except OSError:
+        return False
+    return True
+
+class LRUCache:
+    """Dictionary-like cache with a maximum size, that removes the least
+    recently used items first. Counts hits and misses of self.get.
+
+    >>> cache = LRUCache(maxSize=2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3 # Removes 'b', as 'a' was used more recently.
+    >>> cache.get('b') is None, 'a' in cache, len(cache)
+    (True, True, 2)
+    >>> cache.info()
+    {'hits': 1, 'misses': 1, 'size': 2, 'maxSize': 2, 'hitRate': 0.5}
+    """
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        """Answers the cached value of key and marks it as recently used.
+        Answers default if the key is not in the cache."""
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxSize:
+            self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def items(self):
+        """Answers the (key, value) items, from least to most recently used."""
+        return self._items.items()
+
+    def clear(self):
+        """Empty the cache and reset the counters."""
+        self._items.clear()
+        self.hits = self.misses = 0
+
+    def info(self):
+        """Answers a dictionary with the cache statistics."""
+        lookups = self.hits + self.misses
+        if lookups:
+            hitRate = self.hits / lookups
+        else:
+            hitRate = 0
+        return dict(hits=self.hits, misses=self.misses, size=len(self._items),
+            maxSize=self.maxSize, hitRate=hitRate)
+
+class DiskLRUCache(LRUCache):
+    """LRUCache of string keys and JSON values, that is read from the file
+    at path, and written back by self.save() if items were added or
+    removed. The order of use is stored with them, so eviction continues
+    over runs. Cache hits only change the order, so they do not cause the
+    file to be written again.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'cache.json')
+    >>> cache = DiskLRUCache(path, maxSize=2)
+    >>> cache['a'] = 'A'
+    >>> cache['b'] = 'B'
+    >>> cache.save()
+    >>> cache = DiskLRUCache(path, maxSize=2)
+    >>> os.utime(path, (0, 0))
+    >>> cache.get('a'), cache.get('c'), len(cache)
+    ('A', None, 2)
+    >>> cache.save() # Only hits, the file is not written.
+    >>> os.stat(path).st_mtime
+    0.0
+    >>> cache['c'] = 'C' # Removes 'b'
+    >>> cache.save()
+    >>> sorted(key for key, value in DiskLRUCache(path).items())
+    ['a', 'c']
+    """
+    def __init__(self, path, maxSize=1024):
+        LRUCache.__init__(self, maxSize=maxSize)
+        self.path = path
+        self._dirty = False
+        try:
+            with open(path) as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            items = []
+        for key, value in items[-maxSize:]:
+            self._items[key] = value
+
+    def __setitem__(self, key, value):
+        LRUCache.__setitem__(self, key, value)
+        self._dirty = True
+
+    def clear(self):
+        LRUCache.clear(self)
+        self._dirty = True
+
+    def save(self):
+        """Write the cache file, if items changed. If writing fails,
+        the cache stays unsaved, see saveJson()."""
+        if self._dirty and saveJson(self.path, list(self._items.items())):
+            self._dirty = False
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
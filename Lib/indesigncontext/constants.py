@@ -40,6 +40,115 @@ function pbGetColor(doc, c){
     //alert(colorName);
     return(pbColor);
 }
+function pbNewColor(doc, c){
+    // Same swatch names as pbGetColor, but without exception-driven lookup.
+    if (c.length == 4){
+        colorName = "C=" + Math.round(c[0]) + " M=" + Math.round(c[1]) +" Y=" + Math.round(c[2]) + " K=" + Math.round(c[3]);
+        colorSpace = ColorSpace.cmyk;
+    } else {
+        colorName = "R=" + Math.round(c[0]) + " G=" + Math.round(c[1]) +" B=" + Math.round(c[2]);
+        colorSpace = ColorSpace.rgb;
+    }
+    pbColor = doc.colors.itemByName(colorName);
+    if (!pbColor.isValid){
+        pbColor = doc.colors.add({
+            name: colorName,
+            model: ColorModel.process,
+            space: colorSpace,
+            colorValue: c});
+    }
+    return(pbColor);
+}
+function pbNewColors(doc, colors){
+    var swatches = [];
+    for (var i = 0; i < colors.length; i++){
+        swatches.push(pbNewColor(doc, colors[i]));
+    }
+    return(swatches);
+}
+function pbNewCharacterStyle(doc, name, properties){
+    // Answers the character style with name, created from properties if it does not exist.
+    var style = doc.characterStyles.itemByName(name);
+    if (!style.isValid){
+        properties.name = name;
+        style = doc.characterStyles.add(properties);
+    }
+    return(style);
+}
+function pbSetRuns(story, defaultStyle, ranges){
+    // Apply character style pbCharacterStyles[defaultStyle] to all text of
+    // the story in one call, then the [start, end, style] ranges that differ.
+    // Style null is [None].
+    var style;
+    if (defaultStyle != null) story.texts.item(0).appliedCharacterStyle = pbCharacterStyles[defaultStyle];
+    for (var i = 0; i < ranges.length; i++){
+        if (ranges[i][2] == null){
+            style = pbDoc.characterStyles.item(0);
+        } else {
+            style = pbCharacterStyles[ranges[i][2]];
+        }
+        story.characters.itemByRange(ranges[i][0], ranges[i][1] - 1).appliedCharacterStyle = style;
+    }
+}
+var pbImages = {}; // Asset key --> frame where the image was placed, see pbPlaceImage.
+function pbPlaceImage(e, path, key){
+    // Place the image file at path in frame e. If an image with the same
+    // asset key was placed before, answer a duplicate of that frame instead,
+    // with the bounds, colors and opacity of e, as that is much faster.
+    if (key == null) key = path;
+    var source = pbImages[key];
+    if (source === undefined || !source.isValid){
+        e.place(File(myScriptPath() + path));
+        pbImages[key] = e;
+        return(e);
+    }
+    var copy = source.duplicate(e.parentPage);
+    copy.geometricBounds = e.geometricBounds;
+    copy.fillColor = e.fillColor;
+    copy.strokeColor = e.strokeColor;
+    copy.strokeWeight = e.strokeWeight;
+    copy.fillTransparencySettings.blendingSettings.opacity = e.fillTransparencySettings.blendingSettings.opacity;
+    copy.strokeTransparencySettings.blendingSettings.opacity = e.strokeTransparencySettings.blendingSettings.opacity;
+    e.remove();
+    return(copy);
+}
+function pbBuildFrames(page, rows){
+    // Rows of compact InDesignBuilder output:
+    // [kind, y1, x1, y2, x2, fill, fillOpacity, stroke, strokeWeight, strokeOpacity, ...]
+    // kind 0 = rectangle, 1 = oval, 2 = image [..., path, proportional, assetKey],
+    // 3 = text frame [..., contents, paragraphStyleName, insetSpacing,
+    // optional defaultCharacterStyle, characterStyleRanges], see pbSetRuns.
+    var r, e, bounds;
+    for (var i = 0; i < rows.length; i++){
+        r = rows[i];
+        bounds = {geometricBounds:[r[1] + "pt", r[2] + "pt", r[3] + "pt", r[4] + "pt"]};
+        if (r[0] == 1){
+            e = page.ovals.add(bounds);
+        } else if (r[0] == 3){
+            e = page.textFrames.add(bounds);
+        } else {
+            e = page.rectangles.add(bounds);
+        }
+        if (r[5] != null) e.fillColor = pbSwatches[r[5]];
+        if (r[6] != null) e.fillTransparencySettings.blendingSettings.opacity = r[6];
+        if (r[7] != null){
+            e.strokeColor = pbSwatches[r[7]];
+            e.strokeWeight = r[8] + "pt";
+        }
+        if (r[9] != null) e.strokeTransparencySettings.blendingSettings.opacity = r[9];
+        if (r[0] == 2){
+            e = pbPlaceImage(e, r[10], r[12]);
+            e.fit(FitOptions.CONTENT_TO_FRAME);
+            e.fit(FitOptions.CENTER_CONTENT);
+            if (r[11]) e.fit(FitOptions.PROPORTIONALLY);
+        } else if (r[0] == 3){
+            e.contents = r[10];
+            if (r[11] != null) e.parentStory.paragraphs.item(0).appliedParagraphStyle = pbDoc.paragraphStyles.item(r[11], false);
+            if (r.length > 13) pbSetRuns(e.parentStory, r[13], r[14]);
+            e.textFramePreferences.insetSpacing = [r[12][0] + "pt", r[12][1] + "pt", r[12][2] + "pt", r[12][3] + "pt"];
+        }
+    }
+}
 function myScriptPath(){
     return(File(app.activeScript).parent + '/');
 }
@@ -19,20 +19,59 @@
 #     InDesign JavaScript file specifications here:
 #     https://www.adobe.com/content/dam/acom/en/devnet/indesign/sdk/cs6/scripting/InDesign_ScriptingGuide_JS.pdf
 #
+import os
+
 from pagebot.contexts.base.context import BaseContext
 from pagebot.constants import *
 from pagebot.toolbox.units import pt, em
 from indesigncontext.indesignbuilder import InDesignBuilder
 from indesigncontext.indesignstring import InDesignString
+from indesigncontext.imagesize import ImageSizeCache
+from indesigncontext.caches import DiskLRUCache
+from indesigncontext.assets import AssetStage, PROXY_RESOLUTION
+from indesigncontext.profiling import Profiler
 
 class InDesignContext(BaseContext):
 
     # Used by the generic BaseContext.newString( )
     STRING_CLASS = InDesignString
     EXPORT_TYPES = (FILETYPE_IDML,)
+    # File with the cached sizes of images, see self.imageSize()
+    IMAGE_SIZE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pagebot', 'indesigncontext', 'imagesizes.json')
+    # File with the cached script fragments of elements, see InDesignBuilder._outFragment()
+    FRAGMENT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pagebot', 'indesigncontext', 'fragments.json')
+    FRAGMENT_CACHE_SIZE = 10000
+    # Context methods that are recorded by self.startProfiling()
+    PROFILE_METHODS = ('newDocument', 'newPage', 'rect', 'oval', 'textBox', 'image',
+        'rects', 'ovals', 'newString', 'imageSize', 'saveDocument')
 
-    def __init__(self):
-        """Constructor of InDesignContext.
+    def __init__(self, compact=False, incremental=False, fragmentCache=False,
+            proxyFolder=None, proxyResolution=PROXY_RESOLUTION, cull=False, extractMasters=False,
+            pagesPerChunk=None, dedupeImages=False):
+        """Constructor of InDesignContext. If compact is True, the builder
+        outputs elements as data rows, instead of unrolled script code. If
+        incremental is True, exporting a script also writes a manifest of
+        page hashes, and an update script for the pages that changed since
+        the previous export, see InDesignBuilder.saveDocument. Such exports
+        cannot be streamed, see self.openStream(). If fragmentCache is True,
+        the script fragments of elements are cached in FRAGMENT_CACHE_PATH,
+        for the next builds. Images that are placed at much less than their
+        resolution are replaced by downsampled proxies of proxyResolution
+        (ppi) in proxyFolder, if it is given and Pillow is installed. Paths
+        of images are relative to the script, so proxyFolder should be too.
+        If dedupeImages is True, images with the same content at different
+        paths are placed once. This reads each image once, its hash is
+        cached with the image size. See indesigncontext.assets. If cull is
+        True, elements that are completely off-page or covered by an opaque
+        frame are not exported, see InDesignBuilder._outCulledFrames(). If
+        extractMasters is True, frames that repeat on pages, such as headers
+        and footers, are output once on a master spread that is applied to
+        these pages, see InDesignBuilder.outMasters(). If pagesPerChunk is
+        defined, exported scripts are split into a preamble and chunks of
+        that number of pages, run by a small driver script, so InDesign
+        never parses the complete script at once, see
+        InDesignBuilder.saveDocument(). Chunked scripts cannot be streamed
+        either.
 
         >>> from pagebot.elements import *
         >>> from pagebot.document import Document
@@ -75,8 +114,37 @@ class InDesignContext(BaseContext):
 
         """
         super().__init__()
-        self.b = InDesignBuilder() # cls.b builder for this context.
+        if fragmentCache:
+            fragmentCache = DiskLRUCache(self.FRAGMENT_CACHE_PATH, maxSize=self.FRAGMENT_CACHE_SIZE)
+        else:
+            fragmentCache = None
+        # Image sizes and hashes, read from IMAGE_SIZE_CACHE_PATH on first use.
+        self._imageSizes = ImageSizeCache(self.IMAGE_SIZE_CACHE_PATH)
+        assets = AssetStage(proxyFolder=proxyFolder, resolution=proxyResolution,
+            sizes=self._imageSizes, dedupe=dedupeImages)
+        self.b = InDesignBuilder(compact=compact, incremental=incremental,
+            fragmentCache=fragmentCache, assets=assets, cull=cull,
+            extractMasters=extractMasters, pagesPerChunk=pagesPerChunk) # cls.b builder for this context.
         self.name = self.__class__.__name__
+        self._fileType = None # Extension of the export path, see self.fileType
+
+    def _get_fileType(self):
+        return self._fileType
+    def _set_fileType(self, fileType):
+        """PageView.build() sets the extension of the export path before the
+        document is built. The builder only collects IDML if that is .idml
+
+        >>> context = InDesignContext()
+        >>> context.fileType = 'IDML'
+        >>> context.b.collectIdml, context.fileType
+        (True, 'IDML')
+        >>> context.fileType = 'js'
+        >>> context.b.collectIdml, context.fileType
+        (False, 'js')
+        """
+        self._fileType = fileType
+        self.b.collectIdml = (fileType or '').lower() == FILETYPE_IDML
+    fileType = property(_get_fileType, _set_fileType)
 
     def newDocument(self, w=None, h=None, doc=None):
         self.b.newDocument(w, h, doc)
@@ -102,6 +170,15 @@ class InDesignContext(BaseContext):
         """Ignore for now in this context."""
         self.b.oval(x, y, w=w, h=h, e=e)
 
+    def rects(self, x, y, w, h, fill=None, stroke=None, strokeWidth=None, e=None):
+        """Draw many rectangles at once from sequences (or NumPy arrays) of
+        x, y, w and h, see InDesignBuilder.rects()"""
+        self.b.rects(x, y, w, h, fill=fill, stroke=stroke, strokeWidth=strokeWidth, e=e)
+
+    def ovals(self, x, y, w, h, fill=None, stroke=None, strokeWidth=None, e=None):
+        """Draw many ovals at once, see InDesignBuilder.ovals()"""
+        self.b.ovals(x, y, w, h, fill=fill, stroke=stroke, strokeWidth=strokeWidth, e=e)
+
     def textBox(self, sOrBs, p, w=None, h=None, clipPath=None, e=None):
         self.b.textBox(sOrBs, p, w=w, h=h, clipPath=clipPath, e=e)
 
@@ -119,26 +196,123 @@ class InDesignContext(BaseContext):
         """
         return self.STRING_CLASS(s, context=self, style=style)
 
+    def joinStrings(self, fragments, style=None):
+        """Answers a new self.STRING_CLASS instance with all fragments (plain
+        strings with style, (s, style) pairs or strings of this context), made
+        in one pass. Use this instead of repeated += to build long texts.
+
+        >>> context = InDesignContext()
+        >>> context.joinStrings(['A', ('B', dict(tracking=1)), 'C']).runs
+        [['A', {}], ['B', {'tracking': 1}], ['C', {}]]
+        """
+        return self.STRING_CLASS.join(fragments, self, style=style)
+
     def text(self, sOrBs, p):
         """Ignore for now in this context."""
         pass
 
     def imageSize(self, path):
-        """Answers the (w, h) image size of the image file at path. If the path is an SVG
-        image, then determine by parsing the SVG-XML.
+        """Answers the (w, h) image size of the image file at path. The size
+        is read from the header of JPEG, PNG, GIF and TIFF files, and from the
+        root element of SVG files, and cached in IMAGE_SIZE_CACHE_PATH by path,
+        modification time and file size. Answers pt(1000, 1000) if the size
+        cannot be read.
 
-        if path.lower().endswith('.'+FILETYPE_SVG):
-            import xml.etree.ElementTree as ET
-            svgTree = ET.parse(path)
-            print(svgTree)
+        >>> import os
+        >>> context = InDesignContext()
+        >>> context.imageSize(os.path.join(os.path.dirname(__file__), 'resources/images/cookbot10.jpg'))
+        (2058pt, 946pt)
+        """
+        size = self._imageSizes.get(path)
+        if size is None:
             return pt(1000, 1000)
+        return pt(size)
+
+    def startProfiling(self, trace=False):
+        """Start recording call counts, time and emitted bytes of the context
+        and builder methods, by element type too. Context methods are recorded
+        with 'context.' prefix. Elements are recorded by the builder methods
+        only, as the context methods call them. If trace is True, then all calls are kept, to
+        be saved as Chrome trace. Answers the Profiler.
 
-        return pt(self.b.imageSize(path))
+        >>> context = InDesignContext()
+        >>> profiler = context.startProfiling()
+        >>> context.b.rects([0, 10], [0, 20], 100, 50)
+        >>> context.stopProfiling().getSummary()['rects']['calls']
+        1
         """
-        return pt(1000, 1000)
+        self.stopProfiling()
+        profiler = Profiler(trace=trace)
+        profiler.wrap(self, self.PROFILE_METHODS, prefix='context.', elements=False)
+        self.b.startProfiling(profiler)
+        return profiler
+
+    def stopProfiling(self):
+        """Stop recording and answer the Profiler with the results, or None
+        if there was no profiling. Use profiler.getSummary() for a dictionary
+        of the results, and profiler.saveTrace(path) for a Chrome trace."""
+        profiler = self.b.stopProfiling()
+        if profiler is not None:
+            profiler.unwrap()
+        return profiler
+
+    def openStream(self, path, bufferSize=None):
+        """Make the builder write the script to path while the document is
+        built, instead of keeping all of it in memory until saveDocument."""
+        self.b.openStream(path, bufferSize=bufferSize)
+
+    def iterChunks(self, doc, bufferSize=None):
+        """Answers a generator of the script chunks of doc, which is built
+        with this context in a background thread while the chunks are read.
+        See indesigncontext.asyncexport."""
+        from indesigncontext.asyncexport import iterChunks
+        assert doc.context is self
+        return iterChunks(doc, bufferSize=bufferSize)
+
+    def aiterChunks(self, doc, bufferSize=None):
+        """Answers an asynchronous generator of the script chunks of doc,
+        e.g. to stream them into an HTTP response."""
+        from indesigncontext.asyncexport import aiterChunks
+        assert doc.context is self
+        return aiterChunks(doc, bufferSize=bufferSize)
+
+    async def exportAsync(self, doc, path, compress=None, bufferSize=None):
+        """Export the script of doc to path without blocking the event loop,
+        gzip compressed if compress is True or path ends with .gz. Answers
+        the number of characters written."""
+        from indesigncontext.asyncexport import exportAsync
+        assert doc.context is self
+        return await exportAsync(doc, path, compress=compress, bufferSize=bufferSize)
+
+    def mergeRecords(self, template, records, path, pagesPerFile=None, setFields=None):
+        """Output the pages of the template Document for every record of the
+        records iterator, with the {field} placeholders of the frames filled
+        from the record, into numbered files of at most pagesPerFile pages.
+        Answers the list of paths. See indesigncontext.merge."""
+        from indesigncontext.merge import mergeRecords, PAGES_PER_FILE
+        assert template.context is self
+        paths = mergeRecords(self, template, records, path,
+            pagesPerFile=pagesPerFile or PAGES_PER_FILE, setFields=setFields)
+        self._imageSizes.save()
+        if self.b.fragmentCache is not None:
+            self.b.fragmentCache.save()
+        return paths
+
+    @classmethod
+    def exportDocuments(cls, jobs, maxWorkers=None, **contextKwargs):
+        """Export the list of (factory, path) jobs in parallel processes,
+        each with its own InDesignContext, made with the contextKwargs
+        options of the constructor. factory(context) answers the Document
+        for path. Answers the list of {path, seconds, error} results. See
+        indesigncontext.batch."""
+        from indesigncontext.batch import exportDocuments
+        return exportDocuments(jobs, maxWorkers=maxWorkers, **contextKwargs)
 
     def saveDocument(self, path, multiPage=True):
         self.b.saveDocument(path)
+        self._imageSizes.save()
+        if self.b.fragmentCache is not None:
+            self.b.fragmentCache.save()
 
     saveImage = saveDocument
 
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     culling.py
+#
+#     Finds the frames of a page that can never be visible: frames that are
+#     completely outside the page, and frames that are completely covered by
+#     an opaque frame above them. Frames with transparency are never culled.
+#
+
+# Reasons of culled frames.
+CULL_OFF_PAGE = 'offPage'
+CULL_COVERED = 'covered'
+# Default number of grid cells in each direction of a page.
+GRID_CELLS = 16
+
+class GridIndex:
+    """Spatial index of rectangles (x1, y1, x2, y2) with x1 <= x2 and
+    y1 <= y2, in a grid of cells of cellSize. Answers the rectangles that
+    contain a query rectangle, only checking the ones in the cell of its
+    center, as any containing rectangle must overlap that cell. If bounds
+    is given, cells outside it are merged into the cells on its border, so
+    large rectangles don't fill many cells.
+
+    >>> index = GridIndex(10)
+    >>> index.add((0, 0, 50, 50), 'a')
+    >>> index.add((40, 40, 100, 100), 'b')
+    >>> index.getContaining((10, 10, 20, 20))
+    ['a']
+    >>> index.getContaining((45, 45, 60, 60))
+    ['b']
+    >>> index.getContaining((30, 30, 60, 60))
+    []
+    >>> index = GridIndex(10, (0, 0, 100, 100))
+    >>> index.add((-1000, -1000, 1000, 50), 'c')
+    >>> len(index._cells), index.getContaining((-500, 10, -400, 20))
+    (66, ['c'])
+    """
+    def __init__(self, cellSize, bounds=None):
+        self.cellSize = cellSize
+        self._cells = {} # (column, row) --> list of (rectangle, value)
+        self._range = None # (minColumn, minRow, maxColumn, maxRow)
+        if bounds is not None:
+            self._range = (int(bounds[0] // cellSize), int(bounds[1] // cellSize),
+                int(bounds[2] // cellSize), int(bounds[3] // cellSize))
+
+    def _cell(self, x, y):
+        column, row = int(x // self.cellSize), int(y // self.cellSize)
+        if self._range is not None:
+            minColumn, minRow, maxColumn, maxRow = self._range
+            column = min(max(column, minColumn), maxColumn)
+            row = min(max(row, minRow), maxRow)
+        return column, row
+
+    def add(self, rectangle, value):
+        x1, y1, x2, y2 = rectangle
+        c1, r1 = self._cell(x1, y1)
+        c2, r2 = self._cell(x2, y2)
+        for column in range(c1, c2 + 1):
+            for row in range(r1, r2 + 1):
+                self._cells.setdefault((column, row), []).append((rectangle, value))
+
+    def getContaining(self, rectangle):
+        x1, y1, x2, y2 = rectangle
+        values = []
+        for (ox1, oy1, ox2, oy2), value in self._cells.get(self._cell((x1 + x2) / 2, (y1 + y2) / 2), ()):
+            if ox1 <= x1 and oy1 <= y1 and x2 <= ox2 and y2 <= oy2:
+                values.append(value)
+        return values
+
+def getCulledFrames(frames, pageBounds, cells=GRID_CELLS):
+    """Answers the list of (index, reason) of the frames that cannot be
+    visible. frames is the list of (rectangle, isOpaque, canCull) in
+    drawing order, where rectangle includes the stroke, isOpaque is True if
+    the frame completely hides what is below it and canCull is False for
+    frames that must be kept, such as frames with any transparency.
+    pageBounds is the rectangle outside which nothing is visible, including
+    the bleed.
+
+    >>> frames = [((10, 10, 20, 20), False, True), ((600, 10, 700, 20), False, True),
+    ...     ((12, 12, 18, 18), False, False), ((0, 0, 100, 100), True, True)]
+    >>> getCulledFrames(frames, (0, 0, 500, 500))
+    [(0, 'covered'), (1, 'offPage')]
+    """
+    px1, py1, px2, py2 = pageBounds
+    index = GridIndex(max(px2 - px1, py2 - py1) / cells or 1, pageBounds)
+    culled = []
+    for n in range(len(frames) - 1, -1, -1): # From the top down.
+        rectangle, isOpaque, canCull = frames[n]
+        x1, y1, x2, y2 = rectangle
+        if canCull:
+            if x2 <= px1 or px2 <= x1 or y2 <= py1 or py2 <= y1:
+                culled.append((n, CULL_OFF_PAGE))
+                continue
+            if index.getContaining(rectangle):
+                culled.append((n, CULL_COVERED))
+                continue
+        if isOpaque:
+            index.add(rectangle, n)
+    culled.reverse()
+    return culled
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
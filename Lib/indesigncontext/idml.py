@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     idml.py
+#
+#     Writes the elements collected by InDesignBuilder as native IDML package,
+#     which InDesign opens directly, without replaying a script.
+#     IDML file specifications here:
+#     https://wwwimages.adobe.com/content/dam/acom/en/devnet/indesign/sdk/cs6/idml/idml-specification.pdf
+#
+import os
+import pathlib
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+IDML_MIMETYPE = 'application/vnd.adobe.indesign-idml-package'
+IDML_DOMVERSION = '13.0'
+IDPKG_NS = 'http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging'
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+LAYER_ID = 'uLayer1'
+NO_PARAGRAPH_STYLE = 'ParagraphStyle/$ID/[No paragraph style]'
+NO_CHARACTER_STYLE = 'CharacterStyle/$ID/[No character style]'
+# Bezier handle factor to approximate a quarter ellipse.
+KAPPA = 0.5522847498
+
+def colorName(values):
+    """Answers the swatch name of the color values, the same as the pbGetColor
+    function in JSX_LIB makes, so scripts and packages show the same swatches.
+
+    >>> colorName([100, 50, 0, 0])
+    'C=100 M=50 Y=0 K=0'
+    >>> colorName([255, 127.5, 0])
+    'R=255 G=128 B=0'
+    """
+    values = [int(round(v)) for v in values]
+    if len(values) == 4:
+        return 'C=%d M=%d Y=%d K=%d' % tuple(values)
+    return 'R=%d G=%d B=%d' % tuple(values)
+
+def fmt(v):
+    """Answers the compact string of number v for IDML attributes.
+
+    >>> fmt(12.0), fmt(0.333333333), fmt(-0.0)
+    ('12', '0.3333', '0')
+    """
+    s = ('%.4f' % v).rstrip('0').rstrip('.')
+    if s == '-0':
+        return '0'
+    return s
+
+def getCharacterRanges(length, runs):
+    """Answers the list of (start, end, characterStyle) that covers a text of
+    length, from runs (defaultStyle, ranges) as InDesignBuilder._getRunNames()
+    answers them: defaultStyle for all text, except the [start, end, style]
+    ranges. Style None is no character style.
+
+    >>> getCharacterRanges(10, ('a', [(2, 4, 'b'), (4, 5, None)]))
+    [(0, 2, 'a'), (2, 4, 'b'), (4, 5, None), (5, 10, 'a')]
+    >>> getCharacterRanges(3, None)
+    [(0, 3, None)]
+    """
+    if runs is None:
+        return [(0, length, None)]
+    defaultStyle, ranges = runs
+    characterRanges = []
+    index = 0
+    for start, end, style in sorted(ranges):
+        if index < start:
+            characterRanges.append((index, start, defaultStyle))
+        characterRanges.append((start, end, style))
+        index = end
+    if index < length:
+        characterRanges.append((index, length, defaultStyle))
+    return characterRanges
+
+class IdmlPage:
+    """Collects the page items of one IDML page."""
+    def __init__(self, index, w, h, margins=None):
+        self.index = index
+        self.w = w
+        self.h = h
+        self.margins = margins or (0, 0, 0, 0) # top, right, bottom, left
+        self.items = []
+
+class IdmlWriter:
+    """Collects pages, colors, paragraph styles and page items in plain
+    numbers (pt) and writes them as IDML package with self.save(path).
+    All bounds are (top, left, bottom, right) in origin-top page coordinates.
+
+    >>> w = IdmlWriter(500, 800)
+    >>> w.newPage(0, 500, 800)
+    >>> w.rect(0, (10, 20, 110, 220), fill=[100, 0, 0, 0], opacity=50)
+    >>> w.textFrame(0, (10, 20, 110, 220), 'Hello & bye', paragraphStyle='h1', runs=(None, [(8, 11, 'bold')]))
+    >>> w.addCharacterStyle('bold', FontStyle='Bold')
+    >>> w.image(0, (0, 0, 100, 100), 'images/My image.jpg')
+    >>> w.colors
+    {'C=100 M=0 Y=0 K=0': [100, 0, 0, 0]}
+    >>> story = w.getStory(w.stories[0])
+    >>> '<Content>Hello &amp; </Content>' in story, 'CharacterStyle/bold"><Content>bye</Content>' in story
+    (True, True)
+    >>> '<FillTransparencySetting><BlendingSetting Opacity="50"/>' in w.getSpread(w.pages[0])
+    True
+    >>> w.basePath = '/Users/Me'
+    >>> 'LinkResourceURI="file:///Users/Me/images/My%20image.jpg"' in w.getSpread(w.pages[0])
+    True
+    >>> 'Name="bold" FontStyle="Bold"' in w.getStyles()
+    True
+    """
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+        self.pages = []
+        self.pageIndex = {} # Page index --> IdmlPage
+        self.colors = {} # Color name --> color values
+        self.paragraphStyles = {} # Style name --> dict of IDML attributes
+        self.characterStyles = {} # Style name --> dict of IDML attributes
+        self.stories = []
+        self.basePath = '' # Folder that relative image paths start from.
+        self._uid = 0
+
+    def newId(self, prefix='u'):
+        self._uid += 1
+        return '%s%x' % (prefix, self._uid)
+
+    def newPage(self, index, w, h, margins=None):
+        """Add the page with index, or update its size and margins."""
+        page = self.pageIndex.get(index)
+        if page is None:
+            page = IdmlPage(index, w, h, margins)
+            self.pageIndex[index] = page
+            self.pages.append(page)
+        else:
+            page.w, page.h = w, h
+            if margins is not None:
+                page.margins = margins
+        return None
+
+    def getSortedPages(self):
+        return sorted(self.pages, key=lambda page: page.index)
+
+    def getPage(self, index):
+        """Answers the page at index, creating it with document size if it was
+        not created by self.newPage."""
+        page = self.pageIndex.get(index)
+        if page is None:
+            self.newPage(index, self.w, self.h)
+            page = self.pageIndex[index]
+        return page
+
+    def addColor(self, values):
+        """Register the color values and answer the Self reference of the
+        swatch. None values answer the None swatch."""
+        if values is None:
+            return 'Swatch/None'
+        name = colorName(values)
+        self.colors[name] = values
+        return 'Color/%s' % name
+
+    def addParagraphStyle(self, name, **attributes):
+        self.paragraphStyles[name] = attributes
+
+    def addCharacterStyle(self, name, **attributes):
+        self.characterStyles[name] = attributes
+
+    def _addItem(self, pageIndex, kind, bounds, fill=None, stroke=None,
+            strokeWidth=1, opacity=None, strokeOpacity=None, **kwargs):
+        item = dict(kind=kind, bounds=bounds, fill=self.addColor(fill),
+            stroke=self.addColor(stroke), strokeWidth=strokeWidth,
+            opacity=opacity, strokeOpacity=strokeOpacity, id=self.newId('i'))
+        item.update(kwargs)
+        self.getPage(pageIndex).items.append(item)
+        return item
+
+    def rect(self, pageIndex, bounds, **kwargs):
+        self._addItem(pageIndex, 'Rectangle', bounds, **kwargs)
+
+    def oval(self, pageIndex, bounds, **kwargs):
+        self._addItem(pageIndex, 'Oval', bounds, **kwargs)
+
+    def image(self, pageIndex, bounds, path, proportional=True, **kwargs):
+        self._addItem(pageIndex, 'Rectangle', bounds, path=path,
+            proportional=proportional, **kwargs)
+
+    def textFrame(self, pageIndex, bounds, text, paragraphStyle=None,
+            inset=None, runs=None, **kwargs):
+        """Add a text frame with a story of text. runs is the optional
+        (defaultStyle, ranges) of character style names, see
+        getCharacterRanges()."""
+        storyId = self.newId('u')
+        self.stories.append((storyId, text, paragraphStyle, runs))
+        self._addItem(pageIndex, 'TextFrame', bounds, storyId=storyId,
+            inset=inset, **kwargs)
+
+    #   X M L
+
+    def _pathPoints(self, item):
+        """Answers the PathPointArray XML of the item bounds. Ovals get four
+        anchors with bezier handles, all other items get the corners."""
+        t, l, b, r = item['bounds']
+        points = []
+        if item['kind'] == 'Oval':
+            cx, cy = (l + r)/2, (t + b)/2
+            dx, dy = (r - l)/2 * KAPPA, (b - t)/2 * KAPPA
+            for (ax, ay), (lx, ly), (rx, ry) in (
+                    ((l, cy), (l, cy + dy), (l, cy - dy)),
+                    ((cx, t), (cx - dx, t), (cx + dx, t)),
+                    ((r, cy), (r, cy - dy), (r, cy + dy)),
+                    ((cx, b), (cx + dx, b), (cx - dx, b))):
+                points.append((ax, ay, lx, ly, rx, ry))
+        else:
+            for x, y in ((l, t), (l, b), (r, b), (r, t)):
+                points.append((x, y, x, y, x, y))
+        xml = []
+        for ax, ay, lx, ly, rx, ry in points:
+            xml.append('<PathPointType Anchor="%s %s" LeftDirection="%s %s" RightDirection="%s %s"/>'
+                % tuple(fmt(v) for v in (ax, ay, lx, ly, rx, ry)))
+        return ('<Properties><PathGeometry><GeometryPathType PathOpen="false">'
+            '<PathPointArray>%s</PathPointArray></GeometryPathType></PathGeometry></Properties>'
+            % ''.join(xml))
+
+    def _itemXml(self, item, page):
+        kind = item['kind']
+        # Page items are positioned relative to the page, which has its top
+        # at -h/2 in spread coordinates.
+        attrs = [
+            'Self="%s"' % item['id'],
+            'ItemLayer="%s"' % LAYER_ID,
+            'FillColor=%s' % quoteattr(item['fill']),
+            'StrokeColor=%s' % quoteattr(item['stroke']),
+            'StrokeWeight="%s"' % fmt(item['strokeWidth'] if item['stroke'] != 'Swatch/None' else 0),
+            'ItemTransform="1 0 0 1 0 %s"' % fmt(-page.h/2),
+        ]
+        if kind == 'TextFrame':
+            attrs.append('ParentStory="%s"' % item['storyId'])
+            attrs.append('ContentType="TextType"')
+        xml = ['<%s %s>' % (kind, ' '.join(attrs)), self._pathPoints(item)]
+        if item['opacity'] is not None:
+            xml.append('<FillTransparencySetting><BlendingSetting Opacity="%s"/></FillTransparencySetting>' % fmt(item['opacity']))
+        if item['strokeOpacity'] is not None:
+            xml.append('<StrokeTransparencySetting><BlendingSetting Opacity="%s"/></StrokeTransparencySetting>' % fmt(item['strokeOpacity']))
+        if kind == 'TextFrame' and item.get('inset') is not None:
+            xml.append('<TextFramePreference InsetSpacing="%s"/>' % ' '.join(fmt(v) for v in item['inset']))
+        if item.get('path') is not None:
+            if item['proportional']:
+                fitting = 'Proportionally'
+            else:
+                fitting = 'ContentToFrame'
+            xml.append('<FrameFittingOption AutoFit="true" FittingOnEmptyFrame="%s"/>' % fitting)
+            xml.append('<Image Self="%s" ItemTransform="1 0 0 1 %s %s"><Link Self="%s" LinkResourceURI=%s/></Image>'
+                % (self.newId('img'), fmt(item['bounds'][1]), fmt(item['bounds'][0]),
+                    self.newId('lnk'), quoteattr(pathlib.Path(os.path.abspath(os.path.join(self.basePath, item['path']))).as_uri())))
+        xml.append('</%s>' % kind)
+        return ''.join(xml)
+
+    def getSpread(self, page):
+        """Answers the Spread XML of the single page spread."""
+        t, r, b, l = page.margins
+        xml = [XML_HEADER, '<idPkg:Spread xmlns:idPkg="%s" DOMVersion="%s">' % (IDPKG_NS, IDML_DOMVERSION),
+            '<Spread Self="sp%d" PageCount="1" BindingLocation="0" ItemTransform="1 0 0 1 0 0">' % page.index,
+            '<Page Self="pg%d" Name="%d" GeometricBounds="0 0 %s %s" ItemTransform="1 0 0 1 0 %s">'
+                % (page.index, page.index + 1, fmt(page.h), fmt(page.w), fmt(-page.h/2)),
+            '<MarginPreference ColumnCount="1" Top="%s" Bottom="%s" Left="%s" Right="%s"/>'
+                % (fmt(t), fmt(b), fmt(l), fmt(r)),
+            '</Page>']
+        for item in page.items:
+            xml.append(self._itemXml(item, page))
+        xml.append('</Spread></idPkg:Spread>')
+        return ''.join(xml)
+
+    def getStory(self, story):
+        storyId, text, paragraphStyle, runs = story
+        if paragraphStyle is None:
+            styleRef = NO_PARAGRAPH_STYLE
+        else:
+            styleRef = 'ParagraphStyle/%s' % paragraphStyle
+        contents = []
+        for start, end, characterStyle in getCharacterRanges(len(text), runs):
+            if characterStyle is None:
+                characterRef = NO_CHARACTER_STYLE
+            else:
+                characterRef = 'CharacterStyle/%s' % characterStyle
+            contents.append('<CharacterStyleRange AppliedCharacterStyle=%s>' % quoteattr(characterRef))
+            for index, paragraph in enumerate(text[start:end].split('\n')):
+                if index:
+                    contents.append('<Br/>')
+                if paragraph:
+                    contents.append('<Content>%s</Content>' % escape(paragraph))
+            contents.append('</CharacterStyleRange>')
+        return ''.join((XML_HEADER,
+            '<idPkg:Story xmlns:idPkg="%s" DOMVersion="%s">' % (IDPKG_NS, IDML_DOMVERSION),
+            '<Story Self="%s" AppliedTOCStyle="n" TrackChanges="false" StoryTitle="$ID/">' % storyId,
+            '<ParagraphStyleRange AppliedParagraphStyle=%s>' % quoteattr(styleRef),
+            ''.join(contents),
+            '</ParagraphStyleRange></Story></idPkg:Story>'))
+
+    def getGraphic(self):
+        xml = [XML_HEADER, '<idPkg:Graphic xmlns:idPkg="%s" DOMVersion="%s">' % (IDPKG_NS, IDML_DOMVERSION),
+            '<Color Self="Color/Black" Model="Process" Space="CMYK" ColorValue="0 0 0 100" Name="Black"/>',
+            '<Color Self="Color/Paper" Model="Process" Space="CMYK" ColorValue="0 0 0 0" Name="Paper"/>',
+            '<Swatch Self="Swatch/None" Name="None"/>']
+        for name, values in sorted(self.colors.items()):
+            if len(values) == 4:
+                space = 'CMYK'
+            else:
+                space = 'RGB'
+            xml.append('<Color Self=%s Model="Process" Space="%s" ColorValue="%s" Name=%s/>'
+                % (quoteattr('Color/' + name), space, ' '.join(fmt(v) for v in values), quoteattr(name)))
+        xml.append('</idPkg:Graphic>')
+        return ''.join(xml)
+
+    def getStyles(self):
+        xml = [XML_HEADER, '<idPkg:Styles xmlns:idPkg="%s" DOMVersion="%s">' % (IDPKG_NS, IDML_DOMVERSION),
+            '<RootCharacterStyleGroup Self="rcsg">',
+            '<CharacterStyle Self=%s Name="$ID/[No character style]"/>' % quoteattr(NO_CHARACTER_STYLE)]
+        for name, attributes in self.characterStyles.items():
+            xml.append(self._styleXml('CharacterStyle', name, attributes))
+        xml += ['</RootCharacterStyleGroup>',
+            '<RootParagraphStyleGroup Self="rpsg">',
+            '<ParagraphStyle Self=%s Name="$ID/[No paragraph style]"/>' % quoteattr(NO_PARAGRAPH_STYLE)]
+        for name, attributes in self.paragraphStyles.items():
+            xml.append(self._styleXml('ParagraphStyle', name, attributes))
+        xml.append('</RootParagraphStyleGroup></idPkg:Styles>')
+        return ''.join(xml)
+
+    def _styleXml(self, kind, name, attributes):
+        """Answers the XML of the paragraph or character style (kind) name
+        with the dictionary of IDML attributes."""
+        attributes = dict(attributes)
+        font = attributes.pop('appliedFont', None)
+        attrs = ['Self=%s' % quoteattr('%s/%s' % (kind, name)), 'Name=%s' % quoteattr(name)]
+        for key, value in sorted(attributes.items()):
+            if key in ('FillColor', 'StrokeColor'):
+                value = self.addColor(value)
+            elif isinstance(value, (int, float)):
+                value = fmt(value)
+            attrs.append('%s=%s' % (key, quoteattr(value)))
+        if font is None:
+            return '<%s %s/>' % (kind, ' '.join(attrs))
+        return '<%s %s><Properties><AppliedFont type="string">%s</AppliedFont></Properties></%s>' % (
+            kind, ' '.join(attrs), escape(font), kind)
+
+    def getPreferences(self):
+        return ''.join((XML_HEADER,
+            '<idPkg:Preferences xmlns:idPkg="%s" DOMVersion="%s">' % (IDPKG_NS, IDML_DOMVERSION),
+            '<DocumentPreference PageWidth="%s" PageHeight="%s" PagesPerDocument="%d" FacingPages="false"/>'
+                % (fmt(self.w), fmt(self.h), max(1, len(self.pages))),
+            '</idPkg:Preferences>'))
+
+    def getDesignMap(self):
+        xml = [XML_HEADER,
+            '<?aid style="50" type="document" readerVersion="6.0" featureSet="257" product="%s" ?>\n' % IDML_DOMVERSION,
+            '<Document xmlns:idPkg="%s" DOMVersion="%s" Self="d" StoryList="%s" ActiveLayer="%s">'
+                % (IDPKG_NS, IDML_DOMVERSION, ' '.join(story[0] for story in self.stories), LAYER_ID),
+            '<idPkg:Graphic src="Resources/Graphic.xml"/>',
+            '<idPkg:Styles src="Resources/Styles.xml"/>',
+            '<idPkg:Preferences src="Resources/Preferences.xml"/>',
+            '<Layer Self="%s" Name="Layer 1" Visible="true" Locked="false"/>' % LAYER_ID]
+        for page in self.getSortedPages():
+            xml.append('<idPkg:Spread src="Spreads/Spread_sp%d.xml"/>' % page.index)
+        for story in self.stories:
+            xml.append('<idPkg:Story src="Stories/Story_%s.xml"/>' % story[0])
+        xml.append('</Document>')
+        return ''.join(xml)
+
+    def save(self, path):
+        """Write the IDML package to path. The mimetype entry must be the first
+        and uncompressed, so InDesign recognizes the zip file."""
+        self.basePath = os.path.dirname(os.path.abspath(path))
+        # Styles reference colors, so they are rendered before the graphics.
+        styles = self.getStyles()
+        z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        z.writestr(zipfile.ZipInfo('mimetype'), IDML_MIMETYPE, compress_type=zipfile.ZIP_STORED)
+        z.writestr('META-INF/container.xml', XML_HEADER +
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="designmap.xml" media-type="text/xml"/></rootfiles></container>')
+        for page in self.getSortedPages():
+            z.writestr('Spreads/Spread_sp%d.xml' % page.index, self.getSpread(page))
+        for story in self.stories:
+            z.writestr('Stories/Story_%s.xml' % story[0], self.getStory(story))
+        z.writestr('Resources/Styles.xml', styles)
+        z.writestr('Resources/Graphic.xml', self.getGraphic())
+        z.writestr('Resources/Preferences.xml', self.getPreferences())
+        z.writestr('designmap.xml', self.getDesignMap())
+        z.close()
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     imagesize.py
+#
+#     Reads the pixel size of JPEG, PNG, GIF, TIFF and SVG files from their
+#     headers, without decoding the image, and keeps the sizes and content
+#     hashes in a cache file.
+#
+import hashlib
+import json
+import os
+import re
+import struct
+import xml.etree.ElementTree as ET
+
+from indesigncontext.caches import saveJson
+
+# Version of the ImageSizeCache file. Increment when image sizes are read
+# differently, so existing cache files are read again.
+# 2: JPEG sizes are swapped for EXIF orientations 5-8.
+# 3: TIFF sizes are swapped for orientations 5-8.
+SIZE_CACHE_FORMAT = 3
+
+# Points per unit for SVG width and height values.
+SVG_UNITS = {'': 1, 'px': 1, 'pt': 1, 'pc': 12, 'in': 72, 'mm': 72/25.4, 'cm': 72/2.54}
+SVG_LENGTH = re.compile(r'^\s*([0-9.eE+-]+)\s*([a-z]*)\s*$')
+
+def _exifOrientation(data):
+    """Answers the orientation (1-8) from the EXIF data of an APP1 segment,
+    or None if it has none. Orientations 5-8 are rotated by 90 degrees."""
+    if data[:6] != b'Exif\x00\x00':
+        return None
+    tiff = data[6:]
+    endian = '<' if tiff[:2] == b'II' else '>'
+    try:
+        offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+        count = struct.unpack(endian + 'H', tiff[offset:offset+2])[0]
+        for index in range(offset + 2, offset + 2 + count * 12, 12):
+            tag, fieldType = struct.unpack(endian + 'HH', tiff[index:index+4])
+            if tag == 0x0112: # Orientation, a SHORT
+                return struct.unpack(endian + 'H', tiff[index+8:index+10])[0]
+    except struct.error: # Truncated EXIF data.
+        pass
+    return None
+
+def _jpegSize(f):
+    f.seek(2)
+    orientation = None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF: # Padding byte, the marker code follows.
+            f.seek(-1, 1)
+            continue
+        if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7: # Markers without length.
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        # Start of frame, except DHT, JPG and DAC markers.
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack('>xHH', f.read(5))
+            if orientation in (5, 6, 7, 8): # Displayed rotated by 90 degrees.
+                return h, w
+            return w, h
+        if code == 0xE1 and orientation is None: # APP1, may be EXIF.
+            orientation = _exifOrientation(f.read(length - 2))
+        else:
+            f.seek(length - 2, 1)
+
+def _tiffSize(f, head):
+    endian = '<' if head[:2] == b'II' else '>'
+    f.seek(4)
+    offset = struct.unpack(endian + 'I', f.read(4))[0]
+    f.seek(offset)
+    count = struct.unpack(endian + 'H', f.read(2))[0]
+    values = {}
+    for _ in range(count):
+        tag, fieldType = struct.unpack(endian + 'HH', f.read(4))
+        f.read(4) # Count
+        value = f.read(4)
+        if tag in (256, 257, 274): # ImageWidth, ImageLength, Orientation
+            if fieldType == 3: # SHORT
+                values[tag] = struct.unpack(endian + 'H', value[:2])[0]
+            else:
+                values[tag] = struct.unpack(endian + 'I', value)[0]
+    if 256 not in values or 257 not in values:
+        return None
+    if values.get(274) in (5, 6, 7, 8): # Displayed rotated by 90 degrees.
+        return values[257], values[256]
+    return values[256], values[257]
+
+def _svgLength(value):
+    m = SVG_LENGTH.match(value or '')
+    if m is None or m.group(2) not in SVG_UNITS:
+        return None
+    return float(m.group(1)) * SVG_UNITS[m.group(2)]
+
+def _svgSize(path):
+    """Answers the size from the width and height of the root element, or
+    from its viewBox. Only the start of the root element is parsed."""
+    for event, element in ET.iterparse(path, events=('start',)):
+        w = _svgLength(element.get('width'))
+        h = _svgLength(element.get('height'))
+        if (w is None or h is None) and element.get('viewBox'):
+            _, _, vw, vh = [float(v) for v in re.split(r'[\s,]+', element.get('viewBox').strip())]
+            w, h = w or vw, h or vh
+        if w is None or h is None:
+            return None
+        return w, h
+    return None
+
+def getContentHash(path):
+    """Answers the sha1 hex digest of the content of the file at path."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def readImageSize(path):
+    """Answers the (w, h) pixel size of the image at path, read from the
+    header bytes only. Answers None if the format is unknown or the file
+    cannot be read. JPEG and TIFF sizes are as displayed, so swapped if
+    their orientation rotates the image, as Pillow ImageOps.exif_transpose()
+    does.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(os.path.dirname(__file__), 'resources/images/cookbot10.jpg')
+    >>> readImageSize(path)
+    (2058, 946)
+    >>> exif = b'Exif\\x00\\x00MM\\x00*' + struct.pack('>IHHHIHHI', 8, 1, 0x0112, 3, 1, 6, 0, 0)
+    >>> path = os.path.join(tempfile.mkdtemp(), 'rotated.jpg')
+    >>> with open(path, 'wb') as f:
+    ...     _ = f.write(b'\\xff\\xd8\\xff\\xe1' + struct.pack('>H', len(exif) + 2) + exif + b'\\xff\\xc0' + struct.pack('>HBHH', 8, 8, 10, 20))
+    >>> readImageSize(path) # Orientation 6, rotated 90 degrees clockwise.
+    (10, 20)
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(26)
+            if head[:8] == b'\x89PNG\r\n\x1a\n':
+                return struct.unpack('>II', head[16:24])
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return struct.unpack('<HH', head[6:10])
+            if head[:2] == b'\xff\xd8':
+                return _jpegSize(f)
+            if head[:4] in (b'II*\x00', b'MM\x00*'):
+                return _tiffSize(f, head)
+        if path.lower().endswith('.svg'):
+            return _svgSize(path)
+    except (OSError, struct.error, ET.ParseError, ValueError):
+        pass
+    return None
+
+class ImageSizeCache:
+    """Cache of image sizes and content hashes by path, stored as JSON file
+    at cachePath, that is read on first use. If cachePath is None, the
+    cache is only kept in memory. An entry is valid as long as the
+    modification time and file size of the image did not change, so
+    repeated builds don't open the images again. Cache files of another
+    SIZE_CACHE_FORMAT are ignored, as their sizes may be read differently.
+
+    >>> import os, tempfile
+    >>> cachePath = os.path.join(tempfile.mkdtemp(), 'imagesizes.json')
+    >>> imagePath = os.path.join(os.path.dirname(__file__), 'resources/images/cookbot10.jpg')
+    >>> cache = ImageSizeCache(cachePath)
+    >>> cache.get(imagePath), cache.misses
+    ((2058, 946), 1)
+    >>> contentHash = cache.getHash(imagePath)
+    >>> cache.save()
+    >>> cache = ImageSizeCache(cachePath)
+    >>> cache.get(imagePath), cache.hits
+    ((2058, 946), 1)
+    >>> cache.getHash(imagePath) == contentHash, cache.misses
+    (True, 0)
+    """
+    def __init__(self, cachePath):
+        self.cachePath = cachePath
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._sizes = None # Absolute path --> [mtime, file size, w, h, content hash]
+
+    def _getEntry(self, path):
+        """Answers the valid [mtime, file size, w, h, content hash] entry of
+        the file at path, where w and h are None if the size cannot be read
+        and the hash is None until self.getHash() needs it. Answers None if
+        the file does not exist."""
+        if self._sizes is None:
+            self._sizes = {}
+            if self.cachePath is not None:
+                try:
+                    with open(self.cachePath) as f:
+                        data = json.load(f)
+                    if isinstance(data, dict) and data.get('format') == SIZE_CACHE_FORMAT:
+                        self._sizes = data['sizes']
+                except (OSError, ValueError, KeyError):
+                    pass
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        entry = self._sizes.get(path)
+        if entry is not None and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+            self.hits += 1
+        else:
+            self.misses += 1
+            w, h = readImageSize(path) or (None, None)
+            entry = self._sizes[path] = [stat.st_mtime, stat.st_size, w, h, None]
+            self._dirty = True
+        return entry
+
+    def get(self, path):
+        """Answers the (w, h) of the image at path, or None if the size
+        cannot be read."""
+        entry = self._getEntry(path)
+        if entry is None or entry[2] is None:
+            return None
+        return entry[2], entry[3]
+
+    def getHash(self, path):
+        """Answers the sha1 hex digest of the content of the file at path,
+        or None if it cannot be read. The file is only read again if it
+        changed since the hash was cached."""
+        entry = self._getEntry(path)
+        if entry is None:
+            return None
+        if entry[4] is None:
+            try:
+                entry[4] = getContentHash(path)
+            except OSError:
+                return None
+            self._dirty = True
+        return entry[4]
+
+    def save(self):
+        """Write the cache file, if there are new entries. If writing fails,
+        the cache stays unsaved, see caches.saveJson()."""
+        if self._dirty and self.cachePath is not None and saveJson(self.cachePath, dict(format=SIZE_CACHE_FORMAT, sizes=self._sizes)):
+            self._dirty = False
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
@@ -16,13 +16,22 @@
 #     indesignbuilder.py
 #
 import codecs
+import hashlib
+import json
 import os, shutil
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 from indesigncontext.constants import JSX_LIB
+from indesigncontext.idml import IdmlWriter, colorName, fmt
+from indesigncontext.bulk import getBounds, isSequence, BOUND_FORMAT
+from indesigncontext import templates
+from indesigncontext.profiling import Profiler
+from indesigncontext.assets import AssetStage
+from indesigncontext.culling import getCulledFrames
 from pagebot.contexts.base.builder import BaseBuilder
 from pagebot.toolbox.color import noColor
-from pagebot.toolbox.units import pt, point2D
+from pagebot.toolbox.units import pt, upt, point2D
 from pagebot.constants import *
 
 class InDesignBuilder(BaseBuilder):
@@ -37,14 +46,121 @@ class InDesignBuilder(BaseBuilder):
     SCRIPT_PATH = '%s/Library/Preferences/Adobe InDesign/Version %s/en_US/Scripts/Scripts Panel/PageBot/' % (home, VERSION)
     LOCAL_FOLDER = '_export/'
     #SCRIPT_PATH = '/Users/petr/Library/Preferences/Adobe InDesign/Version 14.0/en_US/Scripts/Scripts Panel/PageBot/'
+    # Number of characters that are buffered before writing to a stream.
+    STREAM_BUFFER_SIZE = 64 * 1024
+    # Frame kinds of compact output rows, as interpreted by pbBuildFrames in JSX_LIB.
+    ROW_RECT, ROW_OVAL, ROW_IMAGE, ROW_TEXTBOX = range(4)
+    # Maximum number of compact rows in one pbBuildFrames call.
+    MAX_ROWS = 1000
+    # Compact row of self.rects() and self.ovals(), from kind, 4 bounds and 5 color fields.
+    BULK_ROW = '[%d, ' + ', '.join([BOUND_FORMAT] * 4) + ', %s, %s, %s, %s, %s]'
+    # Classes of elements that are frames, that can be culled or moved to a master.
+    FRAME_CLASSES = ('Rect', 'Oval', 'Image', 'TextBox')
+    # Classes of elements that completely hide what is below their frame, if the fill is opaque.
+    OPAQUE_CLASSES = ('Rect', 'Image', 'TextBox')
+    # Minimum number of pages with the same frames, to make them a master spread.
+    MIN_MASTER_PAGES = 2
+    # Version of the script of elements, part of the keys of the fragment
+    # cache, so fragments of older versions are not used.
+    FRAGMENT_FORMAT = 2
+    # Paragraph style properties of character styles, as (JS name, IDML attribute).
+    IDML_STYLE_NAMES = (('appliedFont', 'appliedFont'), ('fontStyle', 'FontStyle'), ('pointSize', 'PointSize'),
+        ('leading', 'Leading'), ('fillColor', 'FillColor'), ('strokeColor', 'StrokeColor'))
+    # Methods that are recorded by self.startProfiling()
+    PROFILE_METHODS = ('newDocument', 'prepareAssets', '_outCulledFrames', 'outSwatches',
+        'outDocumentStyles', 'outMasters', 'newPage', 'rect', 'oval', 'image', 'textBox', 'rects', 'ovals', '_colorValues',
+        '_getSwatchIndex', '_outRows', '_outFragment', 'getOut', 'saveDocument')
 
-    def __init__(self):
+    def __init__(self, compact=False, incremental=False, fragmentCache=None, assets=None,
+            cull=False, extractMasters=False, pagesPerChunk=None):
         self._fillColor = noColor
         self._strokeColor = noColor
         self._strokeWidth = pt(1)
         self.originTop = True
+        # In compact mode elements are output as data rows per page, that
+        # are turned into frames by pbBuildFrames, instead of unrolled code.
+        self.compact = compact
+        # In incremental mode the pages are fingerprinted, and saveDocument
+        # writes a manifest and an update script for the changed pages.
+        self.incremental = incremental
+        self.changedPages = None # Page indices changed since the previous export, None if all.
+        # Optional caches.DiskLRUCache of element script fragments by hash of
+        # their input values, see self._outFragment()
+        self.fragmentCache = fragmentCache
+        # assets.AssetStage with the keys and optional proxies of the images.
+        if assets is None:
+            assets = AssetStage()
+        self.assets = assets
+        # If cull is True, elements that cannot be visible are not output.
+        self.cull = cull
+        self.culled = [] # List of (page, element, reason) of the culled elements.
+        self._pageFrames = [] # Held frames of the page, see self._holdFrame()
+        self._cullBounds = None # (x1, y1, x2, y2) of the page with its bleed.
+        self._replaying = False # True while held frames are output.
+        # If extractMasters is True, frames that repeat on pages are output
+        # once on a master spread, that is applied to these pages.
+        self.extractMasters = extractMasters
+        self.masterSpreads = [] # List of (name, pages, elements) of the master spreads.
+        self._masterElements = {} # id(element) --> name of the master spread with its frame.
+        self._pageMasters = {} # id(page) --> name of the master spread of the page.
+        self._buildingMasters = False
+        self._recordedFrames = None # List of frame calls, see self._recordPageFrames()
+        # If pagesPerChunk is defined, saveDocument writes the script as
+        # preamble and page range chunks, with a driver script that runs them.
+        self.pagesPerChunk = pagesPerChunk
+        self.chunks = [] # List of (path, isWritten) of the chunks of the last save.
 
         self.jsOut = []
+        self._rows = [] # Pending compact rows of the current page.
+        self.idml = None # IdmlWriter, collecting the document for IDML export.
+        # If collectIdml is True, newDocument collects the document for IDML
+        # export, as InDesignContext sets when the export path is .idml
+        self.collectIdml = False
+        self._pageIndex = None # Index of the page that is currently built.
+        self._pageIndexOverride = None # Index of the page, if not its page.index, see self.newPage()
+        self._swatches = {} # Color name --> index in the pbSwatches JS array.
+        self._swatchColors = [] # JS color values of the pbSwatches array, by index.
+        self._swatchLines = (0, 0) # Range of the swatch table in self.jsOut
+        self._characterStyles = {} # Character style name --> index in the pbCharacterStyles JS array.
+        self._characterStyleIdml = {} # Character style name --> IDML attributes of the style.
+        self._characterStyleDefs = [] # Script lines that create the pbCharacterStyles array.
+        self._characterStyleLines = (0, 0) # Range of the character style table in self.jsOut
+        self._runStyles = {} # (RunStyle, paragraph properties) --> index in pbCharacterStyles or None
+        self._pageSegments = [] # List of (pageIndex, start in self.jsOut), in output order.
+        self._pageDigests = {} # pageIndex --> sha1 of the page content.
+        self._stream = None # Optional file-like output, see self.openStream()
+        self._streamOwned = False
+        self._streamBuffered = 0
+        self._streamBufferSize = self.STREAM_BUFFER_SIZE
+        self.profiler = None # Profiler, while profiling.
+
+    def startProfiling(self, profiler=None, trace=False):
+        """Start recording calls, time and emitted bytes of the methods in
+        PROFILE_METHODS, by profiler or a new Profiler. If trace is True, all
+        calls are kept for a Chrome trace file. Answers the profiler.
+
+        >>> b = InDesignBuilder()
+        >>> profiler = b.startProfiling()
+        >>> b.rects([0, 10], [0, 20], 100, 50)
+        >>> b.getOut().count('\\n')
+        3
+        >>> summary = b.stopProfiling().getSummary()
+        >>> summary['rects']['calls'], summary['getOut']['bytes']
+        (1, 129)
+        """
+        if self.profiler is not None:
+            self.stopProfiling()
+        self.profiler = profiler or Profiler(trace=trace)
+        self.profiler.wrap(self, self.PROFILE_METHODS, outName='_out')
+        return self.profiler
+
+    def stopProfiling(self):
+        """Stop recording and answer the profiler, or None if not profiling."""
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.unwrap()
+            self.profiler = None
+        return profiler
 
     def getWH(self, w, h, e):
         if e is not None:
@@ -65,11 +181,126 @@ class InDesignBuilder(BaseBuilder):
 
     def _out(self, s):
         self.jsOut.append(s)
+        if self._stream is not None:
+            self._streamBuffered += len(s) + 1
+            if self._streamBuffered >= self._streamBufferSize:
+                self._flushStream()
 
     def getOut(self):
+        """Answers the generated script as string. In streaming mode this
+        only is the part that was not written to the stream yet. Held frames
+        and pending compact rows are output first."""
+        self._outCulledFrames()
+        self._outRows()
         return '\n'.join(self.jsOut)
 
-    def newDocument(self, w=None, h=None, doc=None):
+    def openStream(self, pathOrFile, bufferSize=None):
+        """Start streaming the script output to pathOrFile, which is a file
+        path or a file-like object with a write method. Lines are collected
+        in self.jsOut until about bufferSize characters are buffered, then
+        written, so memory usage is independent of the size of the document.
+        Call self.closeStream() (or self.saveDocument()) to finish the output.
+        Incremental and chunked export need the complete script to split
+        it by page, so they cannot be streamed.
+
+        >>> import io
+        >>> b = InDesignBuilder()
+        >>> f = io.StringIO()
+        >>> b.openStream(f, bufferSize=10)
+        >>> b._out('var a = 1;')
+        >>> b.jsOut, f.getvalue()
+        ([], 'var a = 1;\\n')
+        >>> b._out('var b;')
+        >>> b.getOut()
+        'var b;'
+        >>> b.closeStream()
+        >>> f.getvalue()
+        'var a = 1;\\nvar b;\\n\\n\\n\\n'
+        >>> InDesignBuilder(incremental=True).openStream(f)
+        Traceback (most recent call last):
+        ...
+        ValueError: InDesignBuilder: Incremental export cannot be streamed
+        >>> InDesignBuilder(pagesPerChunk=10).openStream(f)
+        Traceback (most recent call last):
+        ...
+        ValueError: InDesignBuilder: Chunked export cannot be streamed
+        """
+        self._checkStreaming()
+        if self._stream is not None:
+            self.closeStream()
+        if isinstance(pathOrFile, str):
+            self._stream = codecs.open(pathOrFile, 'w', encoding='utf-8')
+            self._streamOwned = True
+        else:
+            self._stream = pathOrFile
+            self._streamOwned = False
+        self._streamBufferSize = bufferSize or self.STREAM_BUFFER_SIZE
+        self.idml = None # Streaming is for script output, don't collect IDML.
+        self._flushStream() # Write anything that was already generated.
+
+    def _checkStreaming(self):
+        """Raise ValueError if the options of the builder need the complete
+        script, so the output cannot be streamed."""
+        if self.incremental:
+            raise ValueError('%s: Incremental export cannot be streamed' % self.__class__.__name__)
+        if self.pagesPerChunk:
+            raise ValueError('%s: Chunked export cannot be streamed' % self.__class__.__name__)
+
+    def _flushStream(self):
+        """Write the buffered lines to the stream and empty the buffer."""
+        if self.jsOut:
+            self.jsOut.append('') # Make the join end with a newline.
+            self._stream.write('\n'.join(self.jsOut))
+            self.jsOut = []
+        self._streamBuffered = 0
+
+    def closeStream(self):
+        """Flush the remaining buffered output and close the stream if it was
+        opened by self.openStream() from a path."""
+        if self._stream is None:
+            return
+        self._outCulledFrames()
+        self._outRows()
+        self._flushStream()
+        self._stream.write('\n' * 3)
+        if self._streamOwned:
+            self._stream.close()
+        else:
+            self._stream.flush()
+        self._stream = None
+        self._streamOwned = False
+
+    def resetStream(self):
+        """Stop streaming without writing the buffered output, e.g. after the
+        stream failed or its reader went away. The stream is closed if it was
+        opened by self.openStream() from a path.
+
+        >>> import io
+        >>> b = InDesignBuilder()
+        >>> b.openStream(io.StringIO())
+        >>> b._out('var a;')
+        >>> b.resetStream()
+        >>> b.isStreaming, b.jsOut
+        (False, [])
+        """
+        stream, owned = self._stream, self._streamOwned
+        self._stream = None
+        self._streamOwned = False
+        self._streamBuffered = 0
+        self.jsOut = []
+        self._rows = []
+        if stream is not None and owned:
+            stream.close()
+
+    def _get_isStreaming(self):
+        return self._stream is not None
+    isStreaming = property(_get_isStreaming)
+
+    def newDocument(self, w=None, h=None, doc=None, pageCount=None):
+        """Output the creation of the document, with the swatches, styles and
+        masters of doc. pageCount is the number of pages, if it is not the
+        number of pages of doc, such as for a merged template, see
+        indesigncontext.merge."""
         if doc is not None:
             w = w or doc.w
             h = h or doc.h
@@ -80,10 +311,12 @@ class InDesignBuilder(BaseBuilder):
         self._out('/* Document */')
         self._out(JSX_LIB)
         self._out('var pbDoc = app.documents.add();')
-        self._out('pbDoc.documentPreferences.pagesPerDocument = %d;' % len(doc.pages))
+        if pageCount is None:
+            pageCount = len(doc.pages)
+        self._out('pbDoc.documentPreferences.pagesPerDocument = %d;' % pageCount)
         if w is not None and h is not None:
-            self._out('pbDoc.documentPreferences.pageWidth = "%s";' % w)
-            self._out('pbDoc.documentPreferences.pageHeight = "%s";' % h)
+            self._out('pbDoc.documentPreferences.pageWidth = %s;' % json.dumps(str(w)))
+            self._out('pbDoc.documentPreferences.pageHeight = %s;' % json.dumps(str(h)))
             if w > h:
                 self._out('pbDoc.documentPreferences.pageOrientation = PageOrientation.landscape;')
             else:
@@ -92,14 +325,483 @@ class InDesignBuilder(BaseBuilder):
         self._out('var pbPage;')
         self._out('var pbPageIndex = 0;')
         self._out('var pbElement;')
+        self._pageIndex = None
+        self._pageIndexOverride = None
+        self._pageSegments = []
+        self._pageDigests = {}
+        self.idml = None
+        if self.collectIdml and not self.isStreaming:
+            self.idml = IdmlWriter(upt(w), upt(h))
+        self.culled = []
+        self._pageFrames = []
+        self._cullBounds = self._getCullBounds(w, h)
+        self.prepareAssets(doc)
+        self.outSwatches(doc)
         self.outDocumentStyles(doc)
+        self.outCharacterStyles(doc)
+        self.outMasters(doc)
+
+    def _iterElements(self, doc):
+        """Yields all elements of the pages of doc, depth-first in drawing
+        order, so the builder can analyze the document before emitting it."""
+        if doc is None:
+            return
+        for pn, pnPages in doc.getSortedPages():
+            for page in pnPages:
+                stack = list(reversed(page.elements))
+                while stack:
+                    e = stack.pop()
+                    yield e
+                    stack.extend(reversed(e.elements))
+
+    def prepareAssets(self, doc):
+        """Collect the images of doc with their placed sizes, and make the
+        proxies of the images that are placed much smaller than their
+        resolution, before the script refers to them. Elements with a path
+        of an existing file are taken as images."""
+        self.assets.reset()
+        for e in self._iterElements(doc):
+            path = getattr(e, 'path', None)
+            if isinstance(path, str):
+                self.assets.add(path, *self.getWH(None, None, e))
+        self.assets.build()
+
+    def _getCullBounds(self, w, h, page=None):
+        """Answers the (x1, y1, x2, y2) of a page of w by h with the bleed of
+        page, outside which frames are not visible. If the origin is at the
+        bottom, then the bottom bleed is below y = 0.
+
+        >>> b = InDesignBuilder()
+        >>> class Page:
+        ...     bleedLeft, bleedTop, bleedRight, bleedBottom = pt(1, 2, 3, 4)
+        >>> b._getCullBounds(pt(100), pt(200), Page())
+        (-1, -2, 103, 204)
+        >>> b.originTop = False
+        >>> b._getCullBounds(pt(100), pt(200), Page())
+        (-1, -4, 103, 202)
+        """
+        left, top, right, bottom = [upt(getattr(page, name, 0) or 0)
+            for name in ('bleedLeft', 'bleedTop', 'bleedRight', 'bleedBottom')]
+        if not self.originTop:
+            top, bottom = bottom, top
+        return -left, -top, upt(w) + right, upt(h) + bottom
+
+    def _holdFrame(self, e, bounds, name, args, kwargs):
+        """If self.cull is True, hold the call of frame method name with args
+        and kwargs, and answer True. bounds is the final (x, y, w, h) of the
+        frame, as the element builds it, with its alignment and origin.
+        The held frames of a page are output by self._outCulledFrames(),
+        when the frames above them are known. Frames without element use the
+        builder state, so they are output right away, after the held ones.
+        While the frames of a page are recorded, all calls are held."""
+        if self._recordedFrames is not None:
+            self._recordedFrames.append((e, bounds, name, args, kwargs))
+            return True
+        if not self.cull or self._replaying or self._buildingMasters:
+            return False
+        if e is None:
+            self._outCulledFrames() # Keep the drawing order.
+            return False
+        self._pageFrames.append((e, self._getCullFrame(e, bounds), name, args, kwargs))
+        return True
+
+    def _outCulledFrames(self):
+        """Output the held frames of the page, in drawing order, except the
+        frames that are completely outside the page and its bleed, or
+        completely covered by an opaque frame above them. These are added to
+        self.culled. Frames with transparency are never culled.
+
+        >>> from pagebot.toolbox.color import color
+        >>> class Page:
+        ...     index = 0
+        >>> class Rect:
+        ...     def __init__(self, x, y, fill):
+        ...         self.x, self.y, self.w, self.h, self.fill = pt(x), pt(y), pt(100), pt(100), fill
+        ...         self.style, self.elements, self.stroke, self.strokeWidth = {}, [], None, pt(0)
+        ...         self.page = Page()
+        >>> b = InDesignBuilder(cull=True)
+        >>> b._cullBounds = (0, 0, 500, 500)
+        >>> for e in (Rect(0, 0, color(1, 0, 0)), Rect(600, 10, color(1, 0, 0)), Rect(0, 0, color(0, 0, 1))):
+        ...     b.rect(e.x, e.y, e=e)
+        >>> b.getOut().count('pbPage.rectangles.add'), b.getCullingSummary()
+        (1, {'covered': 1, 'offPage': 1})
+        """
+        frames, self._pageFrames = self._pageFrames, []
+        if not frames:
+            return
+        culled = dict(getCulledFrames([cullFrame for e, cullFrame, name, args, kwargs in frames], self._cullBounds))
+        self._replaying = True
+        try:
+            for index, (e, cullFrame, name, args, kwargs) in enumerate(frames):
+                reason = culled.get(index)
+                if reason is None: # Call the method of the class, not a profiling wrapper.
+                    getattr(self.__class__, name)(self, *args, **kwargs)
+                else:
+                    self.culled.append((getattr(e, 'page', None), e, reason))
+        finally:
+            self._replaying = False
+
+    def _getCullFrame(self, e, bounds):
+        """Answers the (rectangle, isOpaque, canCull) of element e at bounds
+        (x, y, w, h), where the rectangle includes the stroke, see
+        culling.getCulledFrames(). Elements with transparency and rotated
+        elements are not culled. Frames on a master spread are below the
+        page, so they never cover page frames."""
+        x1, y1, x2, y2 = self._getFrameRectangle(bounds)
+        if self._isOnMaster(e):
+            return (x1, y1, x2, y2), False, False
+        fillColor = self._getFillColor(e)
+        strokeColor, strokeWidth = self._getStrokeColor(e)
+        canCull = not getattr(e, 'angle', 0)
+        for c in (fillColor, strokeColor):
+            if self._colorValues(c) is not None and c.a < 1:
+                canCull = False
+        isOpaque = (canCull and e.__class__.__name__ in self.OPAQUE_CLASSES and
+            self._colorValues(fillColor) is not None)
+        if self._colorValues(strokeColor) is not None:
+            d = upt(strokeWidth) / 2
+            return (x1 - d, y1 - d, x2 + d, y2 + d), isOpaque, canCull
+        return (x1, y1, x2, y2), isOpaque, canCull
+
+    def getCullingSummary(self):
+        """Answers the dictionary of reason --> number of culled elements."""
+        summary = {}
+        for page, e, reason in self.culled:
+            summary[reason] = summary.get(reason, 0) + 1
+        return summary
+
+    def _getFrameRectangle(self, bounds):
+        """Answers the (x1, y1, x2, y2) of the frame at bounds (x, y, w, h),
+        x1 <= x2, y1 <= y2."""
+        top, right, bottom, left = upt(self.getXY(*bounds))
+        return min(left, right), min(top, bottom), max(left, right), max(top, bottom)
+
+    def _recordPageFrames(self, view, page):
+        """Answers the list of (e, bounds, name, args, kwargs) of the frame
+        method calls of the elements of page, as they build themselves in
+        view, with the origin of PageView.build(). bounds is the final
+        (x, y, w, h) of the frame, with alignment and origin offset, or None
+        for bulk frames. Nothing is output."""
+        state = self.jsOut, self._rows, self.idml, self._stream, self.incremental
+        self.jsOut, self._rows, self.idml, self._stream, self.incremental = [], [], None, None, False
+        self._recordedFrames = frames = []
+        try:
+            page.buildChildElements(view, (view.pl, view.pb, pt(0)))
+        finally:
+            self.jsOut, self._rows, self.idml, self._stream, self.incremental = state
+            self._recordedFrames = None
+        return frames
+
+    def _getMasterSignature(self, frame):
+        """Answers a hashable value that is equal for recorded frame calls
+        that make the same output, wherever their page is."""
+        e, bounds, name, args, kwargs = frame
+        fillColor = self._getFillColor(e)
+        strokeColor, strokeWidth = self._getStrokeColor(e)
+        signature = [name, self._getFrameRectangle(bounds), getattr(e, 'angle', 0)]
+        for c in (fillColor, strokeColor):
+            jsColor = self._colorValues(c)
+            signature.append((jsColor, None if jsColor is None else c.a))
+        signature.append(upt(strokeWidth))
+        if name == 'image':
+            signature += [args[0], kwargs['alpha'], kwargs['pageNumber'], kwargs['scaleType']]
+        elif name == 'textBox':
+            bs = args[0]
+            runs = self._getTextRuns(bs, e)
+            styleName = e.style.get('name') if e.style else None
+            signature += [bs.s, styleName, tuple(upt(e.pt, e.pl, e.pb, e.pr)), json.dumps(runs)]
+        return repr(signature)
+
+    def outMasters(self, doc):
+        """If self.extractMasters is True, find the frames that are the same
+        on at least MIN_MASTER_PAGES pages, and output them once on a master
+        spread. Pages with the same set of repeated frames share a master
+        spread. As master items are below all page items, a frame is only
+        moved if no other frame below it overlaps it. The frames are compared
+        and output as the elements build themselves, see
+        self._recordPageFrames(). They are not output again on the pages, the
+        IDML export keeps them on the pages."""
+        self.masterSpreads = []
+        self._masterElements = {}
+        self._pageMasters = {}
+        if not self.extractMasters or doc is None:
+            return
+        pages = []
+        pageItems = {} # id(page) --> list of (frame, signature or None, rectangle)
+        pageCounts = {} # Signature --> number of pages
+        for pn, pnPages in doc.getSortedPages():
+            for page in pnPages:
+                pages.append(page)
+                frames = self._recordPageFrames(doc.view, page)
+                calls = {} # id(e) --> number of frame calls of e
+                for e, bounds, name, args, kwargs in frames:
+                    calls[id(e)] = calls.get(id(e), 0) + 1
+                items = []
+                occurrences = {}
+                for frame in frames:
+                    e, bounds, name, args, kwargs = frame
+                    signature = rectangle = None # Unknown, overlaps all.
+                    if bounds is not None:
+                        rectangle = self._getFrameRectangle(bounds)
+                        # Elements are moved with all their frames, so only single frames.
+                        if e is not None and calls[id(e)] == 1 and kwargs.get('clipPath') is None:
+                            signature = self._getMasterSignature(frame)
+                            occurrences[signature] = occurrences.get(signature, 0) + 1
+                            signature = signature, occurrences[signature] # Same frames on one page.
+                            pageCounts[signature] = pageCounts.get(signature, 0) + 1
+                    items.append((frame, signature, rectangle))
+                pageItems[id(page)] = items
+        groups = {} # Frozen set of master signatures --> list of pages
+        for page in pages:
+            items = pageItems[id(page)]
+            masterSignatures = self._getMasterSignatures(items, [signature for frame, signature, rectangle in items
+                if signature is not None and pageCounts[signature] >= self.MIN_MASTER_PAGES])
+            if masterSignatures:
+                groups.setdefault(masterSignatures, []).append(page)
+        masterGroups = []
+        singlePages = []
+        for signatures, groupPages in groups.items():
+            if len(groupPages) >= self.MIN_MASTER_PAGES:
+                masterGroups.append((signatures, groupPages))
+            else:
+                singlePages += groupPages
+        if not masterGroups:
+            return
+        # Other pages can use a master with part of their repeated frames.
+        masterGroups.sort(key=lambda group: -len(group[0]))
+        for page in singlePages:
+            items = pageItems[id(page)]
+            for signatures, groupPages in masterGroups:
+                if self._getMasterSignatures(items, signatures) == signatures:
+                    groupPages.append(page)
+                    break
+        masterGroups.sort(key=lambda group: group[1][0].index) # Name masters in page order.
+        self._out('/* Masters */')
+        idml, incremental = self.idml, self.incremental
+        self.idml, self.incremental = None, False # The pages keep the frames in IDML and fingerprints.
+        self._buildingMasters = True
+        try:
+            for index, (signatures, groupPages) in enumerate(masterGroups):
+                name = 'M%d-PageBot' % (index + 1)
+                firstPage = groupPages[0]
+                frames = [frame for frame, signature, rectangle in pageItems[id(firstPage)] if signature in signatures]
+                self._out('pbPage = pbDoc.masterSpreads.add(1, {namePrefix:"M%d", baseName:"PageBot"}).pages.item(0);' % (index + 1))
+                w, h = self.getWH(None, None, firstPage)
+                self._out('pbPage.resize(CoordinateSpaces.INNER_COORDINATES, AnchorPoint.CENTER_ANCHOR, ResizeMethods.REPLACING_CURRENT_DIMENSIONS_WITH, [%d, %d]);' % (w.pt, h.pt))
+                self._pageIndex = firstPage.index # Frames don't select their page.
+                for e, bounds, methodName, args, kwargs in frames:
+                    getattr(self.__class__, methodName)(self, *args, **kwargs)
+                self._outRows()
+                self._pageIndex = None
+                for page in groupPages:
+                    self._pageMasters[id(page)] = name
+                    for frame, signature, rectangle in pageItems[id(page)]:
+                        if signature in signatures:
+                            self._masterElements[id(frame[0])] = name
+                self.masterSpreads.append((name, groupPages, [frame[0] for frame in frames]))
+        finally:
+            self.idml, self.incremental = idml, incremental
+            self._buildingMasters = False
+
+    def _getMasterSignatures(self, items, signatures):
+        """Answers the frozen set of the signatures that can be moved to a
+        master spread, starting from signatures. A frame cannot be moved if
+        another frame below it on the page overlaps it. Removing a frame can
+        make it block frames above it, so this repeats until nothing changes.
+        items is the list of (frame, signature, rectangle) of the page in
+        drawing order, where a rectangle of None overlaps all."""
+        signatures = set(signatures)
+        present = set(signature for frame, signature, rectangle in items)
+        signatures &= present
+        changed = True
+        while changed:
+            changed = False
+            for index, (frame, signature, rectangle) in enumerate(items):
+                if signature not in signatures:
+                    continue
+                for below, belowSignature, belowRectangle in items[:index]:
+                    if belowSignature in signatures:
+                        continue
+                    if (belowRectangle is None or (belowRectangle[0] < rectangle[2] and rectangle[0] < belowRectangle[2]
+                            and belowRectangle[1] < rectangle[3] and rectangle[1] < belowRectangle[3])):
+                        signatures.remove(signature)
+                        changed = True
+                        break
+        return frozenset(signatures)
+
+    def _isOnMaster(self, e):
+        """Answers True if the frame of element e is output on the master
+        spread of its page, instead of on the page."""
+        return not self._buildingMasters and e is not None and id(e) in self._masterElements
+
+    def outSwatches(self, doc):
+        """Collect the distinct colors of all elements and paragraph styles
+        in doc, and create them once as pbSwatches array, so elements can
+        refer to them by index, instead of trying to add the color for every
+        element. Colors that were not collected here are added to the array
+        when they are used first."""
+        self._swatches = {}
+        self._swatchColors = []
+        colors = []
+        if doc is not None:
+            for name, style in self._getUsedStyles(doc):
+                colors.append(style.get('textFill'))
+                colors.append(style.get('textStroke'))
+            for e in self._iterElements(doc):
+                colors.append(e.fill)
+                colors.append(e.stroke)
+        jsColors = []
+        for c in colors:
+            jsColor = self._colorValues(c)
+            if jsColor is None:
+                continue
+            name = colorName(jsColor)
+            if name not in self._swatches:
+                self._swatches[name] = len(jsColors)
+                jsColors.append('    %s' % (jsColor,))
+                self._swatchColors.append(jsColor)
+        self._out('/* Swatches */')
+        start = len(self.jsOut)
+        for line in self._getSwatchTable(jsColors):
+            self._out(line)
+        self._swatchLines = (start, len(self.jsOut))
+
+    def _getSwatchTable(self, jsColors):
+        """Answers the script lines that create the pbSwatches array."""
+        if jsColors:
+            return ['var pbSwatches = pbNewColors(pbDoc, [', ',\n'.join(jsColors), ']);']
+        return ['var pbSwatches = [];']
+
+    def _getSwatchIndex(self, c):
+        """Answers the index of the swatch of color c in the pbSwatches
+        array. Output the creation of the swatch if it is not there yet.
+        Answers None if c is no color."""
+        jsColor = self._colorValues(c)
+        if jsColor is None:
+            return None
+        name = colorName(jsColor)
+        index = self._swatches.get(name)
+        if index is None:
+            index = self._swatches[name] = len(self._swatches)
+            self._swatchColors.append(jsColor)
+            self._out('pbSwatches[%d] = pbNewColor(pbDoc, %s);' % (index, jsColor))
+        return index
+
+    def _getSwatch(self, c):
+        """Answers the JS reference to the swatch of color c in the
+        pbSwatches array, or None if c is no color."""
+        index = self._getSwatchIndex(c)
+        if index is None:
+            return None
+        return 'pbSwatches[%d]' % index
+
+    def _getUsedStyles(self, doc):
+        """Answers the list of (name, style) of the doc.styles that are
+        referenced by name in the style of elements, as text boxes apply
+        them as paragraph style. Unused styles are not output."""
+        usedNames = set()
+        for e in self._iterElements(doc):
+            if e.style and 'name' in e.style:
+                usedNames.add(e.style['name'])
+        return [(name, style) for name, style in doc.styles.items()
+            if name in usedNames or style.get('name') in usedNames]
+
+    def _getParagraphStyleProperties(self, style):
+        """Answers the (properties, idmlStyle) of style, where properties is
+        the dictionary of JS property name --> JS value source."""
+        properties = {}
+        idmlStyle = {} # Same attributes for the IDML export.
+        # Make sure the swatches exist before the style definition starts.
+        fillSwatch = self._getSwatch(style.get('textFill'))
+        strokeSwatch = self._getSwatch(style.get('textStroke'))
+        if 'font' in style:
+            font = style['font']
+            if not isinstance(font, str): # For now, only with real Font objects.
+                properties['appliedFont'] = json.dumps(font.info.familyName)
+                properties['fontStyle'] = json.dumps(font.info.styleName)
+                idmlStyle['appliedFont'] = font.info.familyName
+                idmlStyle['FontStyle'] = font.info.styleName
+        if 'fontSize' in style:
+            properties['pointSize'] = json.dumps(str(style['fontSize']))
+            idmlStyle['PointSize'] = upt(style['fontSize'])
+        if 'leading' in style:
+            leading = style['leading']
+            leading.base = style.get('fontSize', DEFAULT_FONT_SIZE)
+            properties['leading'] = json.dumps(str(pt(leading)))
+            idmlStyle['Leading'] = upt(leading)
+        if fillSwatch is not None:
+            properties['fillColor'] = fillSwatch
+            idmlStyle['FillColor'] = self._colorValues(style['textFill'])
+        if strokeSwatch is not None:
+            properties['strokeColor'] = strokeSwatch
+            idmlStyle['StrokeColor'] = self._colorValues(style['textStroke'])
+        return properties, idmlStyle
+
+    def getStyleTree(self, styles):
+        """Answers the list of (name, basedOn, properties) for the list of
+        (name, properties) in styles, in the order to define them. Styles
+        with the same font get a shared base style, if they have more
+        properties in common. Each style is then based on the base style or
+        on an earlier style, for which the fewest properties differ, and only
+        defines these properties. A style is only based on a style that has
+        no properties it does not have itself, as they would be inherited.
+
+        >>> b = InDesignBuilder()
+        >>> font = dict(appliedFont='"Upgrade"', fontStyle='"Bold"', leading='"14pt"')
+        >>> styles = [('h1', dict(font, pointSize='"24pt"')), ('h2', dict(font, pointSize='"18pt"')),
+        ...     ('h3', dict(font, pointSize='"18pt"', fillColor='pbSwatches[0]')), ('p', dict(pointSize='"10pt"'))]
+        >>> for name, basedOn, properties in b.getStyleTree(styles):
+        ...     print(name, basedOn, sorted(properties))
+        pbBase0 None ['appliedFont', 'fontStyle', 'leading']
+        h1 pbBase0 ['pointSize']
+        h2 pbBase0 ['pointSize']
+        h3 h2 ['fillColor']
+        p None ['pointSize']
+        """
+        groups = {} # Font --> list of properties, to find shared base styles.
+        for name, properties in styles:
+            font = properties.get('appliedFont'), properties.get('fontStyle')
+            groups.setdefault(font, []).append(properties)
+        tree = []
+        defined = [] # List of (name, properties) of the defined styles, including inherited.
+        bases = {} # Font --> (name, properties) of shared base style.
+        for font, group in groups.items():
+            if len(group) < 2:
+                continue
+            common = dict((key, value) for key, value in group[0].items()
+                if all(properties.get(key) == value for properties in group[1:]))
+            if len(common) >= 2:
+                name = 'pbBase%d' % len(bases)
+                bases[font] = name, common
+                tree.append((name, None, common))
+        for name, properties in styles:
+            candidates = list(defined)
+            base = bases.get((properties.get('appliedFont'), properties.get('fontStyle')))
+            if base is not None:
+                candidates.insert(0, base)
+            basedOn = None
+            diff = properties
+            for candidateName, candidate in candidates:
+                if any(key not in properties for key in candidate):
+                    continue
+                candidateDiff = dict((key, value) for key, value in properties.items()
+                    if candidate.get(key) != value)
+                if len(candidateDiff) < len(diff):
+                    basedOn, diff = candidateName, candidateDiff
+            tree.append((name, basedOn, diff))
+            defined.append((name, properties))
+        return tree
 
     def outDocumentStyles(self, doc):
         """If there are @doc styles defined, then export them as paragraph styles JS such as
 
-        pbDoc.paragraphStyles.add({name:"Title", appliedFont:"Upgrade", fontStyle:'Bold',
-            justification:Justification.CENTER_ALIGN,
-            pointSize:300, leading:300, fillColor: pbGetColor(pbDoc, [255, 255, 255])});
+        pbParagraphStyles["Title"] = pbDoc.paragraphStyles.add({name:"Title",
+            basedOn: pbParagraphStyles["pbBase0"],
+            pointSize:300, leading:300, fillColor: pbSwatches[0]});
+
+        Only the styles that are used by elements are output. Styles are
+        based on shared base styles or on each other, see self.getStyleTree(),
+        so only their differing properties are defined.
 
         >>> from pagebot.toolbox.color import color
         >>> from pagebot.toolbox.units import pt
@@ -115,80 +817,470 @@ class InDesignBuilder(BaseBuilder):
         >>> #context.b.getOut()
         """
         self._out('/* Paragraph styles */')
-        for name, style in doc.styles.items():
-            self._out('pbDoc.paragraphStyles.add({name:"%s",' % name)
-            if 'font' in style:
-                font = style['font']
-                if not isinstance(font, str): # For now, only with real Font objects.
-                    self._out('\tappliedFont:"%s",' % font.info.familyName)
-                    self._out('\tfontStyle:"%s",' % font.info.styleName)
-            if 'fontSize' in style:
-                fontSize = pt(style['fontSize'])
-                self._out('\tpointSize:"%s",' % style['fontSize'])
-            if 'leading' in style:
-                leading = style['leading']
-                leading.base = style.get('fontSize', DEFAULT_FONT_SIZE)
-                self._out('\tleading:"%s",' % pt(leading))
-            if 'textFill' in style:
-                fillColor = style['textFill']
-                if fillColor.isCmyk:
-                    c, m, y, k = fillColor.cmyk
-                    self._out('\tfillColor: pbGetColor(pbDoc, [%s, %s, %s, %s]),' % (c*100, m*100, y*100, k**100))
-                else: # Round other colors to rgb output.
-                    r, g, b = fillColor.rgb
-                    self._out('\tfillColor: pbGetColor(pbDoc, [%s, %s, %s]),' % (r*255, g*255, b*255))
-            if 'textStroke' in style:
-                strokeColor = style['textStroke']
-                if fillColor.isCmyk:
-                    c, m, y, k = strokeColor.cmyk
-                    self._out('\tstrokeColor: pbGetColor(pbDoc, [%s, %s, %s, %s]),' % (c*100, m*100, y*100, k**100))
-                else: # Round other colors to rgb output.
-                    r, g, b = strokeColor.rgb
-                    self._out('\tstrokeColor: pbGetColor(pbDoc, [%s, %s, %s]),' % (r*255, g*255, b*255))
-            self._out('});')
+        self._out('var pbParagraphStyles = {};')
+        styles = []
+        for name, style in self._getUsedStyles(doc):
+            properties, idmlStyle = self._getParagraphStyleProperties(style)
+            styles.append((name, properties))
+            if self.idml is not None: # IDML styles are complete, without basedOn.
+                self.idml.addParagraphStyle(name, **idmlStyle)
+        for name, basedOn, properties in self.getStyleTree(styles):
+            lines = ['pbParagraphStyles[%s] = pbDoc.paragraphStyles.add({name:%s,' % (json.dumps(name), json.dumps(name))]
+            if basedOn is not None:
+                lines.append('\tbasedOn: pbParagraphStyles[%s],' % json.dumps(basedOn))
+            lines.extend(['\t%s:%s,' % item for item in properties.items()])
+            lines.append('});')
+            self._out('\n'.join(lines))
+
+    def outCharacterStyles(self, doc):
+        """Create the character styles of the styled runs in the text boxes
+        of doc as pbCharacterStyles array, so text boxes can refer to them
+        by index. Run styles that were not collected here are added to the
+        array when they are used first, see self._getTextRuns()."""
+        self._out('/* Character styles */')
+        start = len(self.jsOut)
+        self._characterStyles = {}
+        self._characterStyleIdml = {}
+        self._characterStyleDefs = []
+        self._runStyles = {}
+        self._out('var pbCharacterStyles = [];')
+        for e in self._iterElements(doc):
+            bs = getattr(e, 'bs', None)
+            if bs is not None:
+                self._getTextRuns(bs, e)
+        self._characterStyleLines = (start, len(self.jsOut))
+
+    def _getCharacterStyleProperties(self, style):
+        """Answers the (properties, idmlStyle) of the character style of run
+        style, where properties is the dictionary of JS property name --> JS
+        value source, and idmlStyle is the dictionary of JS property name -->
+        (IDML attribute, value)."""
+        properties, paragraphIdml = self._getParagraphStyleProperties(style)
+        idmlStyle = {}
+        for name, idmlName in self.IDML_STYLE_NAMES:
+            if name in properties and idmlName in paragraphIdml:
+                idmlStyle[name] = idmlName, paragraphIdml[idmlName]
+        fontSize = upt(style.get('fontSize', DEFAULT_FONT_SIZE))
+        if style.get('tracking'): # InDesign tracking is in 1/1000 em.
+            tracking = upt(style['tracking'], base=fontSize) / fontSize * 1000
+            properties['tracking'] = fmt(tracking)
+            idmlStyle['tracking'] = 'Tracking', tracking
+        if style.get('uppercase'):
+            properties['capitalization'] = 'Capitalization.ALL_CAPS'
+            idmlStyle['capitalization'] = 'Capitalization', 'AllCaps'
+        if style.get('underline'):
+            properties['underline'] = 'true'
+            idmlStyle['underline'] = 'Underline', 'true'
+        return properties, idmlStyle
+
+    def _getCharacterStyleIndex(self, properties, idmlStyle=None):
+        """Answers the index in the pbCharacterStyles array of the character
+        style with properties. Output its creation if it does not exist yet.
+        The style name is made from the values of the properties, where the
+        values of idmlStyle replace the JS sources, so colors are named by
+        value instead of swatch index. The same style then has the same name
+        in every export, also if the swatch order changed. The idmlStyle
+        attributes are kept for the IDML export, see self.textBox().
+
+        >>> from pagebot.toolbox.color import color
+        >>> def getName(b):
+        ...     index = b._getCharacterStyleIndex(*b._getCharacterStyleProperties(dict(textFill=color(1, 0, 0))))
+        ...     return [name for name, i in b._characterStyles.items() if i == index][0]
+        >>> b1, b2 = InDesignBuilder(), InDesignBuilder()
+        >>> b2._getSwatchIndex(color(0, 0, 1)) # Red gets another swatch index.
+        0
+        >>> getName(b1) == getName(b2)
+        True
+        """
+        idmlStyle = idmlStyle or {}
+        properties = sorted(properties.items())
+        values = [(key, idmlStyle[key][1] if key in idmlStyle else value) for key, value in properties]
+        name = 'pbRun-' + hashlib.sha1(repr(values).encode('utf-8')).hexdigest()[:10]
+        index = self._characterStyles.get(name)
+        if index is None:
+            self._characterStyleIdml[name] = idmlStyle
+            index = self._characterStyles[name] = len(self._characterStyles)
+            line = 'pbCharacterStyles[%d] = pbNewCharacterStyle(pbDoc, %s, {%s});' % (index, json.dumps(name),
+                ', '.join('%s:%s' % (key, value) for key, value in properties))
+            self._characterStyleDefs.append(line)
+            self._out(line)
+        return index
+
+    def _getParagraphStyle(self, e):
+        """Answers the style of e.doc.styles that the text box e applies as
+        paragraph style, or None if e has no style name or the style is not
+        in the document, see self.outDocumentStyles()."""
+        if e is None or not e.style or 'name' not in e.style:
+            return None
+        styles = getattr(getattr(e, 'doc', None), 'styles', None) or {}
+        return styles.get(e.style['name'])
+
+    def _getTextRuns(self, bs, e=None):
+        """Answers the (defaultStyle, ranges) of the styled runs of bs for
+        pbSetRuns, or None if the runs need no character styles. Only the
+        properties that differ from the paragraph style of e are in the
+        character styles, see self._getParagraphStyle(). Adjacent runs with
+        the same character style are merged. The style of most ranges becomes
+        defaultStyle, applied to all text in one call, so only the [start,
+        end, style] ranges of the other styles are answered.
+
+        >>> from indesigncontext.context import InDesignContext
+        >>> from pagebot.toolbox.units import pt
+        >>> context = InDesignContext()
+        >>> bs = context.newString('A')
+        >>> for n in range(3):
+        ...     bs += context.newString('B', style=dict(fontSize=pt(20))) + context.newString('C')
+        >>> context.b._getTextRuns(bs)
+        (None, [[1, 2, 0], [3, 4, 0], [5, 6, 0]])
+        >>> context.b._getTextRuns(context.newString('ABC'))
+        >>> import types # Text box with a style, but without paragraph style name.
+        >>> e = types.SimpleNamespace(style=dict(fontSize=pt(20)), doc=None)
+        >>> context.b._getTextRuns(context.newString('A', style=dict(fontSize=pt(20))) + context.newString('B'), e)
+        (0, [[1, 2, None]])
+        """
+        getRunRanges = getattr(bs, 'getRunRanges', None)
+        if getRunRanges is None: # Not an InDesignString
+            return None
+        paragraphProperties = {}
+        paragraphStyle = self._getParagraphStyle(e)
+        if paragraphStyle is not None:
+            paragraphProperties = self._getParagraphStyleProperties(paragraphStyle)[0]
+        paragraphKey = tuple(sorted(paragraphProperties.items()))
+        ranges = []
+        for start, end, style in getRunRanges():
+            key = style, paragraphKey
+            if key in self._runStyles:
+                index = self._runStyles[key]
+            else:
+                properties, idmlStyle = self._getCharacterStyleProperties(style)
+                properties = dict((name, value) for name, value in properties.items()
+                    if paragraphProperties.get(name) != value)
+                index = None
+                if properties:
+                    index = self._getCharacterStyleIndex(properties,
+                        dict(idmlStyle[name] for name in properties if name in idmlStyle))
+                self._runStyles[key] = index
+            if ranges and ranges[-1][2] == index:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end, index])
+        if all(r[2] is None for r in ranges):
+            return None
+        counts = {} # Character style index --> (number of ranges, number of characters)
+        for start, end, index in ranges:
+            n, chars = counts.get(index, (0, 0))
+            counts[index] = n + 1, chars + end - start
+        defaultStyle = max(counts, key=counts.get)
+        return defaultStyle, [r for r in ranges if r[2] != defaultStyle]
+
+    def _getRunNames(self, runs):
+        """Answers runs with character style names instead of indices, that
+        don't depend on the order of the styles in the document."""
+        if runs is None:
+            return None
+        names = dict((index, name) for name, index in self._characterStyles.items())
+        defaultStyle, ranges = runs
+        return names.get(defaultStyle), [(start, end, names.get(index)) for start, end, index in ranges]
 
     def _outSelectPage(self, e):
-        """Output code to select the e.page if it is not selected already."""
+        """Output code to select the e.page if it is not selected already.
+        Elements arrive grouped by page, so the page lookup is done once per
+        page, instead of once per element."""
         if e is not None:
-            self._out('pbPageIndex = %d' % (e.page.index))
-            self._out('pbPage = pbDoc.pages.item(pbPageIndex);')
+            pageIndex = self._pageIndexOverride
+            if pageIndex is None:
+                pageIndex = e.page.index
+            if pageIndex != self._pageIndex:
+                self._outRows() # Rows belong to the previous page.
+                self._setPageIndex(pageIndex)
+                self._out('pbPageIndex = %d' % pageIndex)
+                self._out('pbPage = pbDoc.pages.item(pbPageIndex);')
 
-    def newPage(self, w=None, h=None, page=None):
+    def newPage(self, w=None, h=None, page=None, pageIndex=None):
+        """Output the selection and setup of the next page. If pageIndex is
+        defined, it is used instead of page.index, for the page and its
+        elements until the next page, so one template page can be output as
+        many pages."""
         w, h = self.getWH(w, h, page)
+        self._outCulledFrames() # Frames of the previous page.
+        self._outRows()
         self._out('/* Page */')
+        self._pageIndexOverride = pageIndex
         if page is not None:
+            self._pageIndex = None # Always select, the page may be new.
             self._outSelectPage(page)
         else:
-            self._out('if (pbPage) pbPageIndex += 1;')
+            if pageIndex is not None:
+                self._setPageIndex(pageIndex)
+            elif self._pageIndex is None:
+                self._setPageIndex(0)
+            else:
+                self._setPageIndex(self._pageIndex + 1)
+            # Absolute index, so the page code also runs in an update script.
+            self._out('pbPageIndex = %d;' % self._pageIndex)
             self._out('pbPage = pbDoc.pages.item(pbPageIndex);')
-        self._out('pbPage.resize(CoordinateSpaces.INNER_COORDINATES,')
-        self._out('    AnchorPoint.CENTER_ANCHOR,')
-        self._out('    ResizeMethods.REPLACING_CURRENT_DIMENSIONS_WITH,')
-        self._out('    [%d, %d]);' % (w.pt, h.pt))
-        if page is not None:
-            pt, pr, pb, pl = page.padding # Padding is called margin in InDesign script.
-            self._out('pbPage.marginPreferences.top = "%s";' % pt)
-            self._out('pbPage.marginPreferences.right = "%s";' % pr)
-            self._out('pbPage.marginPreferences.bottom = "%s";' % pb)
-            self._out('pbPage.marginPreferences.left = "%s";' % pl)
+        margins = None
+        if page is None:
+            self._out(templates.PAGE_SIZE % (w.pt, h.pt))
+        else:
+            # Padding is called margin in InDesign script.
+            margins = templates.getNumbers(page.padding)
+            self._out(templates.getTemplate((templates.PAGE_SIZE, templates.PAGE_MARGINS))
+                % tuple([w.pt, h.pt] + margins))
+        master = None
+        if self.extractMasters:
+            master = self._pageMasters.get(id(page))
+            if master is None: # Default master, the page may have had another one before an update.
+                self._out('pbPage.appliedMaster = pbDoc.masterSpreads.item(0);')
+            else:
+                self._out('pbPage.appliedMaster = pbDoc.masterSpreads.itemByName(%s);' % json.dumps(master))
+        self._cullBounds = self._getCullBounds(w, h, page)
+        if self.idml is not None:
+            self.idml.newPage(self._pageIndex, w.pt, h.pt, margins)
+        if self.incremental:
+            self._fingerprint('page', upt(w, h), margins, master)
+
+    def _setPageIndex(self, pageIndex):
+        """Set the index of the page that is built. In incremental or chunked
+        mode the script lines that follow are recorded as segment of that
+        page."""
+        self._pageIndex = pageIndex
+        if self.incremental or self.pagesPerChunk:
+            self._pageSegments.append((pageIndex, len(self.jsOut)))
+
+    def _fingerprint(self, *values):
+        """Add the values that define an element (or the page itself) to the
+        fingerprint of the current page. Colors are included as values, not
+        as swatch index, so the fingerprint does not change if other pages
+        add or remove colors.
+
+        >>> b = InDesignBuilder(incremental=True)
+        >>> b._setPageIndex(0)
+        >>> b._fingerprint('rect', [0, 0, 100, 100], dict(fill=[255, 0, 0]))
+        >>> b._setPageIndex(1)
+        >>> b._fingerprint('rect', [0, 0, 100, 100], dict(fill=[255, 0, 0]))
+        >>> hashes = b.getPageHashes()
+        >>> sorted(hashes), hashes[0] == hashes[1]
+        ([0, 1], True)
+        """
+        digest = self._pageDigests.get(self._pageIndex)
+        if digest is None:
+            digest = self._pageDigests[self._pageIndex] = hashlib.sha1()
+        digest.update(repr(values).encode('utf-8'))
+
+    def getPageHashes(self):
+        """Answers the dictionary of pageIndex --> fingerprint hash of the
+        content of the pages that were built in incremental mode."""
+        return {pageIndex: digest.hexdigest() for pageIndex, digest in self._pageDigests.items()}
+
+    def _getPreambleHash(self):
+        """Answers the hash of the script before the first page, except for
+        the swatch table. If it changes, the document needs a full rebuild."""
+        end = len(self.jsOut)
+        if self._pageSegments:
+            end = self._pageSegments[0][1]
+        lines = []
+        start = 0
+        for tableStart, tableEnd in (self._swatchLines, self._characterStyleLines):
+            lines += self.jsOut[start:tableStart]
+            start = tableEnd
+        lines += self.jsOut[start:end]
+        lines.append(repr((self.compact, self.originTop)))
+        return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+    def _getPageLines(self):
+        """Answers the dictionary of pageIndex --> list of script lines of
+        the page, collected from the recorded page segments."""
+        pageLines = {}
+        segments = self._pageSegments + [(None, len(self.jsOut))]
+        for (pageIndex, start), (_, end) in zip(segments, segments[1:]):
+            pageLines.setdefault(pageIndex, []).extend(self.jsOut[start:end])
+        return pageLines
+
+    def _idmlBounds(self, x, y, w, h):
+        """Answers the (top, left, bottom, right) bounds in pt of the current
+        page for IDML export, from the same self.getXY positions that are used
+        for the script. IDML always is origin-top, so flip if needed."""
+        top, right, bottom, left = upt(self.getXY(x, y, w, h))
+        if not self.originTop:
+            ph = self.idml.getPage(self._pageIndex or 0).h
+            top, bottom = ph - top, ph - bottom
+        return top, left, bottom, right
+
+    def _idmlStyle(self, e):
+        """Answers the fill and stroke attributes of e (or the current
+        builder state) for the IdmlWriter."""
+        fillColor = self._getFillColor(e)
+        strokeColor, strokeWidth = self._getStrokeColor(e)
+        return self._getIdmlStyle(fillColor, strokeColor, strokeWidth)
+
+    def _getIdmlStyle(self, fillColor, strokeColor, strokeWidth):
+        style = dict(fill=self._colorValues(fillColor),
+            stroke=self._colorValues(strokeColor), strokeWidth=upt(strokeWidth))
+        if fillColor is not None and fillColor.a < 1:
+            style['opacity'] = fillColor.a * 100
+        if strokeColor is not None and strokeColor.a < 1:
+            style['strokeOpacity'] = strokeColor.a * 100
+        return style
+
+    def _addRow(self, kind, bounds, e, *extra):
+        """Add the compact data row of a frame with bounds and the fill and
+        stroke of e, to be created by pbBuildFrames. The extra values are
+        JS source strings."""
+        fillColor = self._getFillColor(e)
+        strokeColor, strokeWidth = self._getStrokeColor(e)
+        row = [str(kind)]
+        for v in upt(bounds):
+            row.append(fmt(v))
+        fillIndex = self._getSwatchIndex(fillColor)
+        strokeIndex = self._getSwatchIndex(strokeColor)
+        for index in (fillIndex, None, strokeIndex, None, None):
+            if index is None:
+                row.append('null')
+            else:
+                row.append(str(index))
+        if fillColor is not None and fillColor.a < 1:
+            row[6] = fmt(fillColor.a * 100)
+        if strokeIndex is not None:
+            row[8] = fmt(upt(strokeWidth))
+        if strokeColor is not None and strokeColor.a < 1:
+            row[9] = fmt(strokeColor.a * 100)
+        row.extend(extra)
+        self._rows.append('[%s]' % ', '.join(row))
+        if len(self._rows) >= self.MAX_ROWS:
+            self._outRows()
+
+    def _outRows(self):
+        """Output the pending compact rows as one pbBuildFrames call on
+        the current page."""
+        if self._rows:
+            self._out('pbBuildFrames(pbPage, [')
+            self._out(',\n'.join(self._rows))
+            self._out(']);')
+            self._rows = []
 
     def rect(self, x, y, w=None, h=None, e=None):
         w, h = self.getWH(w, h, e)
+        x, y, w, h = templates.getPt((x, y, w, h)) # Floats, unit arithmetic is slow.
+        if self._holdFrame(e, (x, y, w, h), 'rect', (x, y, w, h), dict(e=e)):
+            return
         px1, py1, px2, py2 = self.getXY(x, y, w, h) # Calculate positions, using self.originTop flag.
-        self._out('/* Rect */')
-        self._outSelectPage(e)
-        self._out('pbElement = pbPage.rectangles.add({geometricBounds:["%s", "%s", "%s", "%s"]});' % (py1, px1, py2, px2))
-        self._outElementFillColor(e)
-        self._outElementStrokeColor(e)
+        if self._isOnMaster(e):
+            pass # Output by self.outMasters()
+        elif self.compact:
+            self._outSelectPage(e)
+            self._addRow(self.ROW_RECT, (py1, px1, py2, px2), e)
+        else:
+            self._outSelectPage(e)
+            self._outFragment(self._getFrameScript, 'Rect', 'rectangles', (py1, px1, py2, px2),
+                self._getElementFill(e), self._getElementStroke(e))
+        if self.idml is not None:
+            self.idml.rect(self._pageIndex or 0, self._idmlBounds(x, y, w, h), **self._idmlStyle(e))
+        if self.incremental:
+            self._fingerprint('rect', upt(py1, px1, py2, px2), self._idmlStyle(e))
 
     def oval(self, x, y, w=None, h=None, e=None):
         w, h = self.getWH(w, h, e)
+        x, y, w, h = templates.getPt((x, y, w, h)) # Floats, unit arithmetic is slow.
+        if self._holdFrame(e, (x, y, w, h), 'oval', (x, y, w, h), dict(e=e)):
+            return
         px1, py1, px2, py2 = self.getXY(x, y, w, h) # Calculate positions, using self.originTop flag.
-        self._out('/* Oval */')
-        self._outSelectPage(e)
-        self._out('pbElement = pbPage.ovals.add({geometricBounds:["%s", "%s", "%s", "%s"]});' % (py1, px1, py2, px2))
-        self._outElementFillColor(e)
-        self._outElementStrokeColor(e)
+        if self._isOnMaster(e):
+            pass # Output by self.outMasters()
+        elif self.compact:
+            self._outSelectPage(e)
+            self._addRow(self.ROW_OVAL, (py1, px1, py2, px2), e)
+        else:
+            self._outSelectPage(e)
+            self._outFragment(self._getFrameScript, 'Oval', 'ovals', (py1, px1, py2, px2),
+                self._getElementFill(e), self._getElementStroke(e))
+        if self.idml is not None:
+            self.idml.oval(self._pageIndex or 0, self._idmlBounds(x, y, w, h), **self._idmlStyle(e))
+        if self.incremental:
+            self._fingerprint('oval', upt(py1, px1, py2, px2), self._idmlStyle(e))
+
+    def rects(self, x, y, w, h, fill=None, stroke=None, strokeWidth=None, e=None):
+        """Output many rectangles at once, on the page of e (or the current
+        page). x, y, w and h are sequences of pt values, such as lists or
+        NumPy arrays, or one value for all rectangles. fill, stroke and
+        strokeWidth are one value or a sequence of values, the default is the
+        current builder state. The bounds are calculated by indesigncontext.bulk
+        in one pass, and output as compact rows for pbBuildFrames, also if
+        self.compact is False.
+
+        >>> b = InDesignBuilder()
+        >>> b.rects([0, 10], [0, 20], 100, 50)
+        >>> print(b.getOut())
+        pbBuildFrames(pbPage, [
+        [0, 100, 0, 0, 50, null, null, null, null, null],
+        [0, 110, 20, 10, 70, null, null, null, null, null]
+        ]);
+        """
+        self._bulkFrames(self.ROW_RECT, x, y, w, h, fill, stroke, strokeWidth, e)
+
+    def ovals(self, x, y, w, h, fill=None, stroke=None, strokeWidth=None, e=None):
+        """Output many ovals at once, see self.rects()."""
+        self._bulkFrames(self.ROW_OVAL, x, y, w, h, fill, stroke, strokeWidth, e)
+
+    def _bulkFrames(self, kind, x, y, w, h, fill, stroke, strokeWidth, e):
+        if self._recordedFrames is not None: # Bounds unknown, see self.outMasters()
+            self._recordedFrames.append((e, None, 'rects', (), {}))
+            return
+        self._outCulledFrames() # Keep the drawing order.
+        if e is not None:
+            self._outSelectPage(e)
+        bounds = getBounds(x, y, w, h, self.originTop)
+        n = len(bounds)
+        if fill is None:
+            fill = self._fillColor
+        if stroke is None:
+            stroke = self._strokeColor
+        if strokeWidth is None:
+            strokeWidth = self._strokeWidth
+        fills = list(fill) if isSequence(fill) else [fill] * n
+        strokes = list(stroke) if isSequence(stroke) else [stroke] * n
+        strokeWidths = list(strokeWidth) if isSequence(strokeWidth) else [strokeWidth] * n
+        assert len(fills) == len(strokes) == len(strokeWidths) == n, ('%s: Not the same number of frames and colors' % self.__class__.__name__)
+
+        colorFields = {} # id(color) --> (swatch index, opacity), colors are not hashable.
+        def getColorFields(c):
+            fields = colorFields.get(id(c))
+            if fields is None:
+                index = self._getSwatchIndex(c)
+                opacity = 'null'
+                if c is not None and c.a < 1:
+                    opacity = fmt(c.a * 100)
+                fields = colorFields[id(c)] = ('null' if index is None else str(index), opacity)
+            return fields
+
+        collect = self.idml is not None or self.incremental
+        styles = []
+        idmlStyles = {} # (id(fill), id(stroke), id(strokeWidth)) --> IDML style
+        for (x2, top, x1, bottom), fillColor, strokeColor, sw in zip(bounds, fills, strokes, strokeWidths):
+            fillIndex, fillOpacity = getColorFields(fillColor)
+            strokeIndex, strokeOpacity = getColorFields(strokeColor)
+            strokeWeight = 'null' if strokeIndex == 'null' else fmt(upt(sw))
+            self._rows.append(self.BULK_ROW % (kind, x2, top, x1, bottom,
+                fillIndex, fillOpacity, strokeIndex, strokeWeight, strokeOpacity))
+            if len(self._rows) >= self.MAX_ROWS:
+                self._outRows()
+            if collect:
+                key = id(fillColor), id(strokeColor), id(sw)
+                style = idmlStyles.get(key)
+                if style is None:
+                    style = idmlStyles[key] = self._getIdmlStyle(fillColor, strokeColor, sw)
+                styles.append(style)
+
+        if self.idml is not None:
+            pageIndex = self._pageIndex or 0
+            ph = self.idml.getPage(pageIndex).h
+            addFrame = self.idml.oval if kind == self.ROW_OVAL else self.idml.rect
+            for (x2, top, x1, bottom), style in zip(bounds, styles):
+                if not self.originTop:
+                    top, bottom = ph - top, ph - bottom
+                addFrame(pageIndex, (top, x1, bottom, x2), **style)
+        if self.incremental:
+            self._fingerprint('frames', kind, bounds, styles)
 
     def fill(self, c):
         self._fillColor = c
@@ -201,87 +1293,211 @@ class InDesignBuilder(BaseBuilder):
         if w is not None:
             self._strokeWidth = w
 
-    def _outElementFillColor(self, e):
-        """Set the fill color of pbElement to the current self._fillColor."""
-        jsColor = None
+    def _colorValues(self, c):
+        """Answers the InDesign color values of c, as list of CMYK percentages
+        or list of RGB 0-255 values. Answers None if c is no color."""
+        if c in (None, noColor):
+            return None
+        if c.isCmyk:
+            c, m, y, k = c.cmyk
+            return [c*100, m*100, y*100, k*100]
+        # All other color types default to c.rgb:
+        r, g, b = c.rgb
+        return [r*255, g*255, b*255]
+
+    def _getFillColor(self, e):
+        """Answers the fill color of e, or the current self._fillColor."""
         if e is not None:
-            fillColor = e.fill
-        else:
-            fillColor = self._fillColor
-        if fillColor not in (None, noColor):
-            if fillColor.isCmyk:
-                c, m, y, k = fillColor.cmyk
-                jsColor = [c*100, m*100, y*100, k*100]
-            else: # All other color types default to fillColor.rgb:
-                r, g, b = fillColor.rgb
-                jsColor = [r*255, g*255, b*255]
-        if jsColor is not None:
-            self._out('pbElement.fillColor = pbGetColor(pbDoc, %s);' % (jsColor,))
-        if fillColor is not None and fillColor.a < 1:
-            self._out('pbElement.fillTransparencySettings.blendingSettings.opacity = %s' % (fillColor.a * 100))
-        return None
+            return e.fill
+        return self._fillColor
 
-    def _outElementStrokeColor(self, e):
-        """Set the fill color of pbElement to the current self._strokeColor."""
-        jsColor = None
+    def _getStrokeColor(self, e):
+        """Answers the (strokeColor, strokeWidth) of e, or the current
+        self._strokeColor and self._strokeWidth."""
         if e is not None:
-            strokeColor = e.stroke
-            strokeWidth = e.strokeWidth
-        else:
-            strokeColor = self._strokeColor
-            strokeWidth = self._strokeWidth
-        if strokeColor not in (None, noColor):
-            if strokeColor.isCmyk:
-                c, m, y, k = strokeColor.cmyk
-                jsColor = [c*100, m*100, y*100, k*100]
-            else: # All other color types default to strokeColor.rgb:
-                r, g, b = strokeColor.rgb
-                jsColor = [r*255, g*255, b*255]
-        if jsColor is not None:
-            self._out('pbElement.strokeColor = pbGetColor(pbDoc, %s);' % (jsColor,))
-            self._out('pbElement.strokeWeight = "%s"' % strokeWidth)
+            return e.stroke, e.strokeWidth
+        return self._strokeColor, self._strokeWidth
+
+    def _getElementFill(self, e):
+        """Answers the (swatch, opacity) of the fill of e, or of the current
+        self._fillColor. The swatch is created first if it does not exist.
+        Opacity is None for opaque colors."""
+        fillColor = self._getFillColor(e)
+        opacity = None
+        if fillColor is not None and fillColor.a < 1:
+            opacity = fillColor.a * 100
+        return self._getSwatch(fillColor), opacity
+
+    def _getElementStroke(self, e):
+        """Answers the (swatch, strokeWidth, opacity) of the stroke of e, or
+        of the current self._strokeColor and self._strokeWidth."""
+        strokeColor, strokeWidth = self._getStrokeColor(e)
+        opacity = None
         if strokeColor is not None and strokeColor.a < 1:
-            self._out('pbElement.strokeTransparencySettings.blendingSettings.opacity = %s' % (strokeColor.a * 100))
-        return None
+            opacity = strokeColor.a * 100
+        return self._getSwatch(strokeColor), strokeWidth, opacity
+
+    def _outFragment(self, getScript, *args):
+        """Output the script of an element, as answered by getScript(*args).
+        If there is a self.fragmentCache, then the script is looked up by the
+        hash of getScript and args first, so repeated elements (in this build
+        or in previous ones) skip formatting. Swatches are resolved before,
+        so args refer to them by name.
+
+        >>> import os, tempfile
+        >>> from indesigncontext.caches import DiskLRUCache
+        >>> b = InDesignBuilder(fragmentCache=DiskLRUCache(os.path.join(tempfile.mkdtemp(), 'fragments.json')))
+        >>> fill, stroke = ('pbSwatches[0]', None), (None, pt(1), None)
+        >>> for n in range(3):
+        ...     b._outFragment(b._getFrameScript, 'Rect', 'rectangles', pt(0, 0, 10, 20), fill, stroke)
+        >>> print(b.getOut().split('\\n')[-1])
+        pbElement.fillColor = pbSwatches[0];
+        >>> b.fragmentCache.info()['hits']
+        2
+        """
+        if self.fragmentCache is None:
+            self._out(getScript(*args))
+            return
+        key = repr((self.FRAGMENT_FORMAT, getScript.__name__) + args)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        fragment = self.fragmentCache.get(key)
+        if fragment is None:
+            fragment = self.fragmentCache[key] = getScript(*args)
+        self._out(fragment)
+
+    def _getFrameScript(self, comment, frames, bounds, fill, stroke, parts=(), values=()):
+        """Answers the script that adds a frame to the frames collection of
+        pbPage (such as 'rectangles' or 'ovals') with bounds, and the fill and
+        stroke from self._getElementFill and self._getElementStroke. The
+        template parts with values follow, for the content of the frame.
+
+        >>> b = InDesignBuilder()
+        >>> print(b._getFrameScript('Rect', 'rectangles', pt(0, 0, 10, 20), ('pbSwatches[0]', 50), (None, pt(1), None)))
+        /* Rect */
+        pbElement = pbPage.rectangles.add({geometricBounds:["0pt", "0pt", "10pt", "20pt"]});
+        pbElement.fillColor = pbSwatches[0];
+        pbElement.fillTransparencySettings.blendingSettings.opacity = 50;
+        """
+        fillSwatch, fillOpacity = fill
+        strokeSwatch, strokeWidth, strokeOpacity = stroke
+        frameParts = [templates.FRAME]
+        frameValues = [comment, frames] + templates.getNumbers(bounds)
+        if fillSwatch is not None:
+            frameParts.append(templates.FILL)
+            frameValues.append(fillSwatch)
+        if fillOpacity is not None:
+            frameParts.append(templates.FILL_OPACITY)
+            frameValues.append(fillOpacity)
+        if strokeSwatch is not None:
+            frameParts.append(templates.STROKE)
+            frameValues += [strokeSwatch] + templates.getNumbers([strokeWidth])
+        if strokeOpacity is not None:
+            frameParts.append(templates.STROKE_OPACITY)
+            frameValues.append(strokeOpacity)
+        frameParts.extend(parts)
+        frameValues.extend(values)
+        return templates.getTemplate(tuple(frameParts)) % tuple(frameValues)
+
+    def _getImageScript(self, bounds, fill, stroke, path, proportional, key=None):
+        if key is None:
+            parts, values = [templates.IMAGE], [json.dumps(path)]
+        else:
+            parts, values = [templates.IMAGE_KEY], [json.dumps(path), json.dumps(key)]
+        if proportional:
+            parts.append(templates.PROPORTIONAL)
+        comment = 'Image %s' % path.replace('*/', '*\\/') # Path cannot end the comment.
+        return self._getFrameScript(comment, 'rectangles', bounds, fill, stroke, parts, values)
+
+    def _getTextBoxScript(self, bounds, fill, stroke, s, styleName, inset, runs=None):
+        """Answers the script of a text frame with string s. Strings are
+        output as JS string literals.
+
+        >>> b = InDesignBuilder()
+        >>> print(b._getTextBoxScript(pt(0, 0, 10, 20), (None, None), (None, pt(1), None), 'Say "hi"\\n', 'h1', pt(1, 1, 1, 1)).split('\\n')[2])
+        pbElement.contents = "Say \\"hi\\"\\n";
+        """
+        parts, values = [templates.CONTENTS], [json.dumps(s)]
+        if styleName is not None:
+            parts.append(templates.PARAGRAPH_STYLE)
+            values.append(json.dumps(styleName))
+        if runs is not None:
+            parts.append(templates.RUNS)
+            values += [json.dumps(runs[0]), json.dumps(runs[1])]
+        parts.append(templates.INSET)
+        values += templates.getNumbers(inset)
+        return self._getFrameScript('TextBox', 'textFrames', bounds, fill, stroke, parts, values)
 
     def image(self, path, p, alpha=None, pageNumber=1, w=None, h=None, scaleType=None, e=None):
         w, h = self.getWH(w, h, e)
         x, y = point2D(p)
+        x, y, w, h = templates.getPt((x, y, w, h)) # Floats, unit arithmetic is slow.
+        if self._holdFrame(e, (x, y, w, h), 'image', (path, (x, y)), dict(alpha=alpha,
+                pageNumber=pageNumber, w=w, h=h, scaleType=scaleType, e=e)):
+            return
         px1, py1, px2, py2 = self.getXY(x, y, w, h) # Calculate positions, using self.originTop flag.
-        self._out('/* Image %s */' % path)
-        self._outSelectPage(e)
-        self._out('pbElement = pbPage.rectangles.add({geometricBounds:["%s", "%s", "%s", "%s"]});' % (py1, px1, py2, px2))
-        self._outElementFillColor(e)
-        self._outElementStrokeColor(e)
-        #self._out('alert(myScriptPath() + "%s");' % path)
-        self._out('pbElement.place(File(myScriptPath() + "%s"));' % path)
-        # FitOptions: http://jongware.mit.edu/idcs4js/pe_FitOptions.html
-        self._out('pbElement.fit(FitOptions.CONTENT_TO_FRAME);')
-        self._out('pbElement.fit(FitOptions.CENTER_CONTENT);')
         if scaleType is None and e is not None:
             scaleType = e.scaleType
-        if scaleType  != SCALE_TYPE_FITWH:
-            self._out('pbElement.fit(FitOptions.PROPORTIONALLY);')
+        path, key = self.assets.get(path) # Proxy path, if there is one.
+        if self._isOnMaster(e):
+            pass # Output by self.outMasters()
+        elif self.compact:
+            self._outSelectPage(e)
+            self._addRow(self.ROW_IMAGE, (py1, px1, py2, px2), e, json.dumps(path),
+                json.dumps(scaleType != SCALE_TYPE_FITWH), json.dumps(key))
+        else:
+            self._outSelectPage(e)
+            self._outFragment(self._getImageScript, (py1, px1, py2, px2),
+                self._getElementFill(e), self._getElementStroke(e), path, scaleType != SCALE_TYPE_FITWH, key)
+        if self.idml is not None:
+            self.idml.image(self._pageIndex or 0, self._idmlBounds(x, y, w, h), path,
+                proportional=scaleType != SCALE_TYPE_FITWH, **self._idmlStyle(e))
+        if self.incremental:
+            self._fingerprint('image', upt(py1, px1, py2, px2), path, scaleType, self._idmlStyle(e))
 
     def textBox(self, bs, p, w=None, h=None, clipPath=None, e=None):
-
         w, h = self.getWH(w, h, e)
         x, y = point2D(p)
+        x, y, w, h = templates.getPt((x, y, w, h)) # Floats, unit arithmetic is slow.
+        if self._holdFrame(e, (x, y, w, h), 'textBox', (bs, (x, y)), dict(w=w, h=h, clipPath=clipPath, e=e)):
+            return
 
         # Calculate positions, using self.originTop flag.
         px1, py1, px2, py2 = self.getXY(x, y, w, h)
 
-        self._out('/* TextBox */')
-        self._outSelectPage(e)
-        self._out('pbElement = pbPage.textFrames.add({geometricBounds:["%s", "%s", "%s", "%s"]});' % (py1, px1, py2, px2))
-        self._outElementFillColor(e)
-        self._outElementStrokeColor(e)
-        self._out('pbElement.contents = "%s";' % bs.s)
-
+        styleName = None
         if e is not None and e.style and 'name' in e.style:
-            self._out('pbElement.parentStory.paragraphs.item(0).appliedParagraphStyle = pbDoc.paragraphStyles.item("%s", false);' % e.style['name'])
+            styleName = e.style['name']
+        runs = self._getTextRuns(bs, e)
+        if self._isOnMaster(e):
+            pass # Output by self.outMasters()
+        elif self.compact:
+            self._outSelectPage(e)
+            extra = [json.dumps(bs.s), json.dumps(styleName),
+                '[%s]' % ', '.join(fmt(v) for v in upt(e.pt, e.pl, e.pb, e.pr))]
+            if runs is not None:
+                extra += [json.dumps(runs[0]), json.dumps(runs[1])]
+            self._addRow(self.ROW_TEXTBOX, (py1, px1, py2, px2), e, *extra)
+        else:
+            self._outSelectPage(e)
+            self._outFragment(self._getTextBoxScript, (py1, px1, py2, px2),
+                self._getElementFill(e), self._getElementStroke(e), bs.s, styleName, (e.pt, e.pl, e.pb, e.pr), runs)
 
-        self._out('pbElement.textFramePreferences.insetSpacing = ["%s", "%s", "%s", "%s"]; // top, left, bottom, right' % (e.pt, e.pl, e.pb, e.pr))
+        if self.idml is not None:
+            paragraphStyle = None
+            if e is not None and e.style and 'name' in e.style:
+                paragraphStyle = e.style['name']
+            runNames = self._getRunNames(runs)
+            if runNames is not None:
+                defaultStyle, ranges = runNames
+                for name in set([defaultStyle] + [name for start, end, name in ranges]):
+                    if name is not None:
+                        self.idml.addCharacterStyle(name, **self._characterStyleIdml[name])
+            self.idml.textFrame(self._pageIndex or 0, self._idmlBounds(x, y, w, h), bs.s,
+                paragraphStyle=paragraphStyle, inset=upt(e.pt, e.pl, e.pb, e.pr), runs=runNames,
+                **self._idmlStyle(e))
+        if self.incremental:
+            self._fingerprint('textBox', upt(py1, px1, py2, px2), bs.s, styleName,
+                upt(e.pt, e.pl, e.pb, e.pr), self._idmlStyle(e), self._getRunNames(runs))
 
     def scale(self, sx, sy, center=None):
         pass
@@ -299,13 +1515,204 @@ class InDesignBuilder(BaseBuilder):
         pass
 
     def saveDocument(self, path):
-        """Write the IDML file from idmlRoot, indicated by path."""
+        """Write the IDML file from idmlRoot, indicated by path. If the
+        output is streaming, then the script already went to the stream, so
+        only the remaining buffer is written. Paths with an .idml extension
+        are written as IDML package instead of script. In incremental mode
+        the script is followed by <name>.manifest.json with the hashes of the
+        pages, and by <name>.update.js if only pages changed since the
+        previous export. Running that script on the document that was built
+        from the previous export rebuilds only the changed pages. If
+        pagesPerChunk is defined, the script is written as chunks with path
+        as driver script, see self._saveChunks()."""
         print('path %s' % path)
 
+        if path.lower().endswith('.' + FILETYPE_IDML):
+            self._outCulledFrames()
+            assert self.idml is not None, ('%s.saveDocument: No IDML collected for "%s", set collectIdml before newDocument'
+                % (self.__class__.__name__, path))
+            self.idml.save(path)
+            return
+
+        if self.isStreaming:
+            self._checkStreaming() # Options may have changed after openStream.
+            self.closeStream()
+            return
+
+        if self.pagesPerChunk:
+            self._saveChunks(path)
+        else:
+            f = codecs.open(path, 'w', encoding='utf-8')
+            #f = codecs.open(self.SCRIPT_PATH + path, 'w', encoding='utf-8')
+            f.write(self.getOut())
+            f.write('\n' * 4)
+            f.close()
+
+        if self.incremental:
+            self._saveIncremental(path)
+
+    def _getChunks(self):
+        """Answers the list of (name, lines) of the preamble and the chunks
+        of at most self.pagesPerChunk pages, from the recorded page
+        segments, in output order."""
+        self._outCulledFrames()
+        self._outRows()
+        segments = self._pageSegments + [(None, len(self.jsOut))]
+        chunks = [('preamble', self.jsOut[:segments[0][1]])]
+        chunkStart = segments[0][1]
+        pageIndices = [] # Pages of the current chunk, in output order.
+        for pageIndex, start in segments:
+            if pageIndex is None or (pageIndex not in pageIndices and len(pageIndices) >= self.pagesPerChunk):
+                if pageIndices:
+                    name = 'pages-%04d-%04d' % (min(pageIndices) + 1, max(pageIndices) + 1)
+                    chunks.append((name, self.jsOut[chunkStart:start]))
+                chunkStart = start
+                pageIndices = []
+            if pageIndex is not None and pageIndex not in pageIndices:
+                pageIndices.append(pageIndex)
+        return chunks
+
+    def _saveChunks(self, path):
+        """Write the script as preamble (the library, document setup, swatches
+        and styles) and chunks of self.pagesPerChunk pages, in the folder
+        <name>_chunks next to path, and write path as driver script that
+        evaluates them in order, so InDesign parses one chunk at a time. The
+        names of the chunks contain the hash of their content, so chunks that
+        did not change are not written again, and can be cached. The chunks
+        are written in parallel. Old chunks are removed.
+
+        >>> import os, tempfile
+        >>> b = InDesignBuilder(pagesPerChunk=2)
+        >>> b._out('var pbDoc;')
+        >>> for pageIndex in range(5):
+        ...     b._setPageIndex(pageIndex)
+        ...     b._out('pbPageIndex = %d;' % pageIndex)
+        >>> path = os.path.join(tempfile.mkdtemp(), 'Doc.js')
+        >>> b._saveChunks(path)
+        >>> [os.path.basename(chunkPath).split('.')[0] for chunkPath, isWritten in b.chunks]
+        ['preamble', 'pages-0001-0002', 'pages-0003-0004', 'pages-0005-0005']
+        >>> print(open(b.chunks[2][0]).read().strip())
+        pbPageIndex = 2;
+        pbPageIndex = 3;
+        >>> b._saveChunks(path)
+        >>> [isWritten for chunkPath, isWritten in b.chunks]
+        [False, False, False, False]
+        >>> 'Doc_chunks/pages-0005-0005.' in open(path).read()
+        True
+        """
+        root, extension = os.path.splitext(path)
+        folder = root + '_chunks'
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        names = []
+        jobs = []
+        for name, lines in self._getChunks():
+            content = '\n'.join(lines) + '\n'
+            fileName = '%s.%s%s' % (name, hashlib.sha1(content.encode('utf-8')).hexdigest()[:10], extension)
+            names.append(fileName)
+            jobs.append((os.path.join(folder, fileName), content))
+        with ThreadPoolExecutor() as executor:
+            written = list(executor.map(lambda job: self._writeChunk(*job), jobs))
+        self.chunks = [(chunkPath, isWritten) for (chunkPath, content), isWritten in zip(jobs, written)]
+        for fileName in os.listdir(folder): # Remove chunks of previous exports.
+            if fileName not in names and fileName.startswith(('preamble.', 'pages-')):
+                os.remove(os.path.join(folder, fileName))
+
+        folderName = os.path.basename(folder)
+        f = codecs.open(path, 'w', encoding='utf-8')
+        f.write('/* Document in %d chunks, evaluated in order */\n' % len(names))
+        f.write('var pbFolder = File($.fileName).parent;\n')
+        f.write('var pbChunks = [\n%s];\n' % ',\n'.join('    %s' % json.dumps(folderName + '/' + fileName)
+            for fileName in names))
+        f.write('for (var pbChunk = 0; pbChunk < pbChunks.length; pbChunk++) {\n')
+        f.write('    $.evaluateFile(File(pbFolder + "/" + pbChunks[pbChunk]));\n')
+        f.write('}\n')
+        f.close()
+
+    def _writeChunk(self, path, content):
+        """Write content to path, unless it exists. Answers True if it was
+        written. The file is written under a temporary name first, so an
+        interrupted export never leaves a partial chunk with a valid name."""
+        if os.path.exists(path):
+            return False
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        with codecs.open(tmpPath, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmpPath, path)
+        return True
+
+    def _saveIncremental(self, path):
+        """Compare the page hashes with the manifest of the previous export
+        of path, and write the new manifest. If only pages changed, then write
+        an update script that rebuilds these pages in the active InDesign
+        document. self.changedPages is set to the sorted list of changed page
+        indices, or None if the document needs to be built from the full
+        script (no previous manifest, or document-level changes).
+
+        >>> import os, tempfile
+        >>> def build(fill):
+        ...     b = InDesignBuilder(incremental=True)
+        ...     b._out('var pbDoc;')
+        ...     for pageIndex in range(3):
+        ...         b._setPageIndex(pageIndex)
+        ...         b._fingerprint('rect', pageIndex == 1 and fill)
+        ...         b._out('pbPageIndex = %d;' % pageIndex)
+        ...     return b
+        >>> path = os.path.join(tempfile.mkdtemp(), 'Doc.js')
+        >>> b = build(fill=0)
+        >>> b._saveIncremental(path)
+        >>> b.changedPages, os.path.exists(path.replace('.js', '.update.js'))
+        (None, False)
+        >>> b = build(fill=1)
+        >>> b._saveIncremental(path)
+        >>> b.changedPages
+        [1]
+        >>> print(open(path.replace('.js', '.update.js')).read().split('\\n')[0])
+        /* Update pages 1 */
+        """
+        root, ext = os.path.splitext(path)
+        manifestPath = root + '.manifest.json'
+        updatePath = root + '.update' + ext
+        pageHashes = {str(pageIndex): h for pageIndex, h in self.getPageHashes().items()}
+        manifest = dict(preamble=self._getPreambleHash(), pages=pageHashes)
+        try:
+            with open(manifestPath) as f:
+                oldManifest = json.load(f)
+        except (OSError, ValueError):
+            oldManifest = None
+
+        if oldManifest is None or oldManifest.get('preamble') != manifest['preamble']:
+            self.changedPages = None
+            if os.path.exists(updatePath): # Don't leave an outdated update.
+                os.remove(updatePath)
+        else:
+            oldPages = oldManifest.get('pages', {})
+            self.changedPages = sorted(int(pageIndex) for pageIndex, h in pageHashes.items()
+                if oldPages.get(pageIndex) != h)
+            self._saveUpdate(updatePath, self.changedPages)
+
+        with open(manifestPath, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    def _saveUpdate(self, path, pageIndices):
+        """Write the script that removes the items of the pages in pageIndices
+        from the active document and builds them again."""
+        pageLines = self._getPageLines()
         f = codecs.open(path, 'w', encoding='utf-8')
-        #f = codecs.open(self.SCRIPT_PATH + path, 'w', encoding='utf-8')
-        f.write(self.getOut())
-        f.write('\n' * 4)
+        f.write('/* Update pages %s */\n' % ', '.join(str(pageIndex) for pageIndex in pageIndices))
+        f.write(JSX_LIB + '\n')
+        f.write('var pbDoc = app.activeDocument;\n')
+        f.write('var pbPage;\nvar pbPageIndex = 0;\nvar pbElement;\n')
+        # Swatches can be used on any page, so the update has the complete table.
+        jsColors = ['    %s' % (jsColor,) for jsColor in self._swatchColors]
+        f.write('\n'.join(self._getSwatchTable(jsColors)) + '\n')
+        f.write('\n'.join(['var pbCharacterStyles = [];'] + self._characterStyleDefs) + '\n')
+        for pageIndex in pageIndices:
+            # The page lines start by selecting the page.
+            f.write('pbDoc.pages.item(%d).pageItems.everyItem().remove();\n' % pageIndex)
+            f.write('\n'.join(pageLines.get(pageIndex, [])))
+            f.write('\n')
+        f.write('\n' * 3)
         f.close()
 
 if __name__ == '__main__':
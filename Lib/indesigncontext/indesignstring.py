@@ -15,18 +15,152 @@
 #
 
 import os, re, copy
+import weakref
 
 from pagebot.strings.babelstring import BabelString
 from pagebot.style import css
 from pagebot.constants import LEFT, DEFAULT_FONT_SIZE, DEFAULT_LEADING
 from pagebot.paths import DEFAULT_FONT_PATH
-from pagebot.toolbox.units import isUnit
+from pagebot.toolbox.units import isUnit, pt, upt
 from pagebot.fonttoolbox.objects.font import findFont
+from indesigncontext.caches import LRUCache
+from indesigncontext.textmetrics import getRunMetrics, layoutText
+
+def styleValueKey(v, depth=0):
+    """Answers a hashable key for style value v. Units and colors are not
+    hashable, so their attributes are used. Fonts and other values with a
+    path are keyed by their path, as their attributes are many.
+
+    >>> from pagebot.toolbox.units import pt
+    >>> styleValueKey(pt(12)) == styleValueKey(pt(12)), styleValueKey(pt(12)) == styleValueKey(pt(13))
+    (True, False)
+    >>> styleValueKey((1, [2, 3]))
+    (1, (2, 3))
+    >>> class Font:
+    ...     def __init__(self, path):
+    ...         self.path, self.info = path, {}
+    ...     def __eq__(self, other):
+    ...         return self.path == other.path
+    >>> styleValueKey(Font('/fonts/Upgrade-Bold.ttf'))
+    ('Font', '/fonts/Upgrade-Bold.ttf')
+    """
+    try:
+        hash(v)
+        return v
+    except TypeError:
+        pass
+    path = getattr(v, 'path', None)
+    if isinstance(path, str): # Font, equal by its file.
+        return (v.__class__.__name__, path)
+    if depth > 4: # Nested too deep, only identical objects are equal.
+        return ('id', id(v))
+    if isinstance(v, (list, tuple)):
+        return tuple(styleValueKey(vv, depth+1) for vv in v)
+    if isinstance(v, dict):
+        attributes = v
+    else:
+        attributes = getattr(v, '__dict__', None)
+        if attributes is None:
+            return (v.__class__.__name__, repr(v))
+    return (v.__class__.__name__,) + tuple(sorted(((str(k), styleValueKey(vv, depth+1))
+        for k, vv in attributes.items()), key=lambda item: item[0]))
+
+class RunStyle(dict):
+    """Immutable style dictionary of InDesignString runs. Equal styles are
+    interned by RunStyle.intern(style), so runs share the same instance, and
+    comparing run styles is comparing identity.
+
+    >>> from pagebot.toolbox.units import pt
+    >>> s1 = RunStyle.intern(dict(fontSize=pt(12)))
+    >>> s1 is RunStyle.intern(dict(fontSize=pt(12))), s1 is RunStyle.intern(dict(fontSize=pt(14)))
+    (True, False)
+    >>> s1['fontSize'] = pt(10)
+    Traceback (most recent call last):
+    ...
+    TypeError: RunStyle is immutable
+    >>> style = dict(fontSize=pt(12))
+    >>> RunStyle.intern(style) is s1
+    True
+    >>> style['fontSize'] = pt(14) # Changed style is interned again.
+    >>> RunStyle.intern(style) is s1
+    False
+    """
+    _interned = weakref.WeakValueDictionary()
+    # Recently interned styles, id(style) --> (style, items, RunStyle). The
+    # style is kept, so its id is not reused.
+    _recent = LRUCache(maxSize=256)
+
+    @classmethod
+    def intern(cls, style):
+        """Answers the shared RunStyle instance with the values of style.
+        Interning the same style again, with the same value objects, skips
+        making its key."""
+        if style.__class__ is cls:
+            return style
+        entry = cls._recent.get(id(style))
+        if (entry is not None and entry[0] is style and len(style) == len(entry[1])
+                and all(style.get(k, entry) is v for k, v in entry[1])):
+            return entry[2]
+        key = tuple(sorted((k, styleValueKey(v)) for k, v in style.items()))
+        runStyle = cls._interned.get(key)
+        if runStyle is None:
+            runStyle = cls(style)
+            cls._interned[key] = runStyle
+        cls._recent[id(style)] = style, tuple(style.items()), runStyle
+        return runStyle
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s is immutable' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return id(self)
+
+    def __eq__(self, other):
+        return self is other or dict.__eq__(self, other)
+
+    def __copy__(self):
+        """Answers a plain, mutable copy."""
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (RunStyle.intern, (dict(self),))
+
+class StyleView(dict):
+    """Mutable copy of the style of the last run of an InDesignString, as
+    answered by InDesignString.style. Changes are written back as new
+    interned style of that run, so shared run styles are never modified."""
+    def __init__(self, bs, style):
+        dict.__init__(self, style)
+        self._bs = bs
+
+    def _update(self):
+        self._bs._setLastStyle(RunStyle.intern(dict(self)))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._update()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._update()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._update()
 
 class InDesignString(BabelString):
     """InDesignString is a wrapper around the Indesign string."""
 
     BABEL_STRING_TYPE = 'indesign'
+    # Process-wide cache of styles resolved by newString, shared by all
+    # instances. Use RESOLVED_STYLES.info() to read the hits and misses.
+    RESOLVED_STYLES = LRUCache(maxSize=256)
 
     def __init__(self, s, context, style=None):
         """Constructor of the InDesignString. Optionally store the (latest)
@@ -48,7 +182,114 @@ class InDesignString(BabelString):
         if style is None:
             style = {}
         self.context = context # Store context, in case we need more of its functions.
-        self.runs = [[str(s), copy.copy(style)]] # Format is [(s1, style1), (s2, style2), ...]
+        # Run table: all text is in self._text (joined lazily from the
+        # fragments in self._pending), self._starts holds the text offset and
+        # self._styles the shared RunStyle of each run.
+        s = str(s)
+        self._text = s
+        self._pending = []
+        self._length = len(s)
+        self._starts = [0]
+        self._styles = [RunStyle.intern(style)]
+        # Offset of the last appended fragment, that can be merged into the
+        # last run. Setting the style splits it off again.
+        self._lastStart = 0
+        self._lines = None # Cached (w, lines) of the last self._layout(w)
+
+    def _appendRun(self, s, style):
+        """Add a run with text s and the interned RunStyle style. An empty
+        last run is replaced, and a run with the same style as the last run
+        is merged into it, so the runs stay normalized.
+
+        >>> from indesigncontext.context import InDesignContext
+        >>> from pagebot.toolbox.units import pt
+        >>> context = InDesignContext()
+        >>> bs = context.newString('A', style=dict(fontSize=pt(12)))
+        >>> for c in 'BCD':
+        ...     bs += context.newString(c, style=dict(fontSize=pt(12)))
+        >>> bs += context.newString('', style=dict(fontSize=pt(14)))
+        >>> bs += context.newString('E', style=dict(fontSize=pt(16)))
+        >>> bs.runs
+        [['ABCD', {'fontSize': 12pt}], ['E', {'fontSize': 16pt}]]
+        """
+        self._lines = None
+        if self._styles and self._starts[-1] == self._length:
+            self._starts.pop() # Empty last run has no text to keep its style for.
+            self._styles.pop()
+        self._lastStart = self._length
+        if not self._styles or self._styles[-1] is not style:
+            self._starts.append(self._length)
+            self._styles.append(style)
+        if s:
+            self._pending.append(s)
+            self._length += len(s)
+
+    def _setLastStyle(self, style):
+        """Set the style of the last appended fragment. If that was merged
+        into the last run, then it is split off again.
+
+        >>> from indesigncontext.context import InDesignContext
+        >>> from pagebot.toolbox.units import pt
+        >>> context = InDesignContext()
+        >>> bs = context.newString('AB', style=dict(fontSize=pt(12)))
+        >>> bs += context.newString('CD', style=dict(fontSize=pt(12)))
+        >>> bs.fontSize = pt(14)
+        >>> bs.runs
+        [['AB', {'fontSize': 12pt}], ['CD', {'fontSize': 14pt}]]
+        >>> bs.fontSize = pt(12)
+        >>> bs.runs
+        [['ABCD', {'fontSize': 12pt}]]
+        """
+        self._lines = None
+        if self._starts[-1] < self._lastStart:
+            if style is not self._styles[-1]:
+                self._starts.append(self._lastStart)
+                self._styles.append(style)
+        else:
+            self._styles[-1] = style
+            if len(self._styles) > 1 and self._styles[-2] is style:
+                self._starts.pop()
+                self._styles.pop()
+
+    def _get_runs(self):
+        """Answers the runs as list of [s, style] pairs. The style
+        dictionaries are shared and immutable.
+
+        >>> from indesigncontext.context import InDesignContext
+        >>> context = InDesignContext()
+        >>> bs = context.newString('ABC')
+        >>> bs.runs = [['AB', {}], ['C', dict(tracking=2)]]
+        >>> bs.runs, bs.s
+        ([['AB', {}], ['C', {'tracking': 2}]], 'ABC')
+        """
+        text = self.s
+        ends = self._starts[1:] + [self._length]
+        return [[text[start:end], style] for start, end, style in zip(self._starts, ends, self._styles)]
+    def _set_runs(self, runs):
+        self._text = ''
+        self._pending = []
+        self._length = 0
+        self._starts = []
+        self._styles = []
+        self._lastStart = 0
+        self._lines = None
+        for s, style in runs:
+            self._appendRun(str(s), RunStyle.intern(style))
+    runs = property(_get_runs, _set_runs)
+
+    def getRunRanges(self):
+        """Answers the list of (start, end, style) of the runs that are not
+        empty, with offsets in self.s. The styles are the shared RunStyle
+        instances, so equal styles are identical.
+
+        >>> from indesigncontext.context import InDesignContext
+        >>> context = InDesignContext()
+        >>> bs = context.newString('AB') + context.newString('', style=dict(tracking=1)) + context.newString('C', style=dict(tracking=2))
+        >>> bs.getRunRanges()
+        [(0, 2, {}), (2, 3, {'tracking': 2})]
+        """
+        ends = self._starts[1:] + [self._length]
+        return [(start, end, style) for start, end, style in zip(self._starts, ends, self._styles) if start < end]
 
     def __add__(self, bs):
         """Adds bs to self.
@@ -70,9 +311,12 @@ class InDesignString(BabelString):
         [['ABCD', {'fontSize': 21pt}], ['EFGH', {'fontSize': 23pt}], ['IJKL', {}]]
         """
         if isinstance(bs, self.__class__):
-            self.runs += bs.runs
+            text = bs.s
+            ends = bs._starts[1:] + [bs._length]
+            for start, end, style in zip(bs._starts, ends, bs._styles):
+                self._appendRun(text[start:end], style)
         else:
-            self.runs.append([str(bs), {}])
+            self._appendRun(str(bs), RunStyle.intern({}))
         return self
 
     def _get_style(self):
@@ -86,8 +330,8 @@ class InDesignString(BabelString):
         >>> bs.s, bs.style
         ('ABCD', {'fontSize': 21pt})
         """
-        if self.runs:
-            return self.runs[-1][1]
+        if self._styles:
+            return StyleView(self, self._styles[-1])
         return None
     def _set_style(self, style):
         """Replace the style of the last run by a copy of @style.
@@ -101,10 +345,10 @@ class InDesignString(BabelString):
         >>> bs.s, bs.style
         ('ABCD', {'fontSize': 21pt})
         """
-        if self.runs:
-            self.runs[-1][1] = copy.copy(style)
+        if self._styles:
+            self._setLastStyle(RunStyle.intern(style))
         else:
-            self.runs = ['', copy.copy(style)]
+            self._appendRun('', RunStyle.intern(style))
     style = property(_get_style, _set_style)
 
     def _get_s(self):
@@ -120,12 +364,13 @@ class InDesignString(BabelString):
         'ABCD'
         >>> bs.s = 'EFGH' # Replace the runs
         >>> bs.runs
-        [('EFGH', {})]
+        [['EFGH', {}]]
         """
-        runs = []
-        for s, style in self.runs:
-            runs.append(s)
-        return ''.join(runs)
+        if self._pending: # Join the appended text once, until the next append.
+            self._pending.insert(0, self._text)
+            self._text = ''.join(self._pending)
+            self._pending = []
+        return self._text
     def _set_s(self, s):
         self.runs = [(s, {})]
     s = property(_get_s, _set_s)
@@ -182,12 +427,12 @@ class InDesignString(BabelString):
         >>> from indesigncontext.context import InDesignContext
         >>> context = InDesignContext()
         >>> bs = InDesignString('ABC', context)
-        >>> fs
-        ABC
-        >>> len(fs)
+        >>> bs.s
+        'ABC'
+        >>> len(bs)
         3
         """
-        return len(self.asText())
+        return self._length
 
     def asText(self):
         """Answers as unicode string.
@@ -195,25 +440,87 @@ class InDesignString(BabelString):
         >>> from indesigncontext.context import InDesignContext
         >>> context = InDesignContext()
         >>> fs = InDesignString('ABC', context)
-        >>> bs.runs
-
+        >>> fs.runs
+        [['ABC', {}]]
         >>> fs.s
         'ABC'
         >>> fs.asText()
         'ABC'
         """
-        return str(self.s) # TODO: To be changed to Indesign string behavior.
+        return self.s # TODO: To be changed to Indesign string behavior.
+
+    def _layout(self, w=None):
+        """Answers the list of textmetrics.Line of the text, broken to fit
+        width w, measured with the advance widths of the run fonts. The result
+        is cached until the string changes."""
+        if w is not None:
+            w = upt(w)
+        if self._lines is not None and self._lines[0] == w:
+            return self._lines[1]
+        runs = []
+        ends = self._starts[1:] + [self._length]
+        for start, end, style in zip(self._starts, ends, self._styles):
+            if start < end:
+                fontPath = self._resolveStyle(None, style)[3]
+                widths, leading, tracking = getRunMetrics(style, fontPath)
+                runs.append((start, end, widths, leading, tracking))
+        lines = layoutText(self.s, runs, w)
+        self._lines = (w, lines)
+        return lines
 
     def textSize(self, w=None, h=None):
-        """Answers the (w, h) size for a given width, with the current text."""
-        return 100, 20
-        # TODO: Make this work in Indesign same as in DrawBot
-        #return self.b.textSize(s)
+        """Answers the (w, h) size for a given width, with the current text.
+        The width is the longest line, the height is the sum of the line
+        leadings.
+
+        >>> from indesigncontext.context import InDesignContext
+        >>> context = InDesignContext()
+        >>> bs = InDesignString('ABC DEF', context, style=dict(fontSize=pt(10), leading=pt(12)))
+        >>> tw, th = bs.textSize(w=pt(1000))
+        >>> th
+        12pt
+        >>> tw1, th1 = bs.textSize(w=tw - 1) # Wraps to two lines.
+        >>> th1
+        24pt
+        """
+        lines = self._layout(w)
+        return pt(max(line.width for line in lines), sum(line.height for line in lines))
 
     def textOverflow(self, w, h, align=LEFT):
-        # TODO: Make this work in Indesign same as in DrawBot
-        # TODO: Some stuff needs to get here.
-        return ''
+        """Answers the part of the text that does not fit in a box of (w, h),
+        as new InDesignString with the styles of the runs. The answer is
+        empty if all text fits.
+
+        >>> from indesigncontext.context import InDesignContext
+        >>> context = InDesignContext()
+        >>> bs = InDesignString('ABC DEF', context, style=dict(fontSize=pt(10), leading=pt(12)))
+        >>> tw, th = bs.textSize()
+        >>> bs.textOverflow(tw, pt(12)).s
+        ''
+        >>> bs.textOverflow(tw - 1, pt(12)).s
+        'DEF'
+        """
+        h = upt(h) + 0.001 # Rounding margin.
+        height = 0
+        for line in self._layout(w):
+            height += line.height
+            if height > h:
+                return self._slice(line.start)
+        return self._slice(self._length)
+
+    def _slice(self, start):
+        """Answers a new InDesignString with the text and styles from offset
+        start to the end."""
+        text = self.s
+        runs = []
+        ends = self._starts[1:] + [self._length]
+        for runStart, end, style in zip(self._starts, ends, self._styles):
+            if end > start:
+                runs.append((text[max(start, runStart):end], style))
+        bs = self.__class__('', self.context)
+        if runs:
+            bs.runs = runs
+        return bs
 
     def append(self, s):
         """Append string or InDesignString to self."""
@@ -235,6 +542,42 @@ class InDesignString(BabelString):
             reCompiled= self.FIND_FS_MARKERS
         return reCompiled.findall(u'%s' % self.s)
 
+    @classmethod
+    def join(cls, fragments, context, style=None):
+        """Answers a new InDesignString with all fragments, in one pass. A
+        fragment is a plain string, that gets style, an (s, style) pair or
+        an InDesignString. Equal styles are interned once by their dict,
+        runs with the same style are merged and the text is joined once, so
+        this is much faster than adding the fragments one by one.
+
+        >>> from indesigncontext.context import InDesignContext
+        >>> from pagebot.toolbox.units import pt
+        >>> context = InDesignContext()
+        >>> bold = dict(fontSize=pt(12), tracking=1)
+        >>> bs = InDesignString.join(['A', ('B', bold), ('C', bold), InDesignString('D', context), 'E'], context)
+        >>> bs.runs
+        [['A', {}], ['BC', {'fontSize': 12pt, 'tracking': 1}], ['DE', {}]]
+        >>> InDesignString.join([], context, style=bold).runs
+        [['', {'fontSize': 12pt, 'tracking': 1}]]
+        """
+        bs = cls('', context, style=style)
+        defaultStyle = bs._styles[0]
+        runStyles = {} # id(style) --> (style, RunStyle), style is kept so its id is not reused.
+        for fragment in fragments:
+            if isinstance(fragment, str):
+                bs._appendRun(fragment, defaultStyle)
+            elif isinstance(fragment, BabelString):
+                text = fragment.s
+                for start, end, runStyle in fragment.getRunRanges():
+                    bs._appendRun(text[start:end], runStyle)
+            else:
+                s, fragmentStyle = fragment
+                entry = runStyles.get(id(fragmentStyle))
+                if entry is None:
+                    entry = runStyles[id(fragmentStyle)] = (fragmentStyle, RunStyle.intern(fragmentStyle or {}))
+                bs._appendRun(str(s), entry[1])
+        return bs
+
     @classmethod
     def newString(cls, s, context, e=None, style=None, w=None, h=None, pixelFit=True):
         """Answers a InDesignString instance from valid attributes in *style*.
@@ -249,13 +592,17 @@ class InDesignString(BabelString):
         >>> #bs.s.lines()
         >>> #'indesign.text.text' in str(bs)
         True
+        >>> InDesignString.RESOLVED_STYLES.clear()
+        >>> bs = InDesignString.newString('BBB', context, style=dict(fontSize=pt(30)))
+        >>> bs = InDesignString.newString('CCC', context, style=dict(fontSize=pt(30)))
+        >>> info = InDesignString.RESOLVED_STYLES.info()
+        >>> info['hits'], info['misses']
+        (1, 1)
         """
         if style is None:
             style = {}
 
-        sUpperCase = css('uppercase', e, style)
-        sLowercase = css('lowercase', e, style)
-        sCapitalized = css('capitalized', e, style)
+        sUpperCase, sLowercase, sCapitalized, font, inDesignFont = cls._resolveStyle(e, style)
 
         if sUpperCase:
             s = s.upper()
@@ -271,18 +618,6 @@ class InDesignString(BabelString):
         #
         # This needs to be installed, in case PageBot is running outside of DrawBot.
 
-        font = style.get('font')
-
-        if font is not None and not isinstance(font, str):
-            font = font.path
-        if font is None or not os.path.exists(font):
-            font = DEFAULT_FONT_PATH
-
-        fontSize = style.get('fontSize', DEFAULT_FONT_SIZE)
-        assert isUnit(fontSize), ('%s.newString: FontSize %s must be of type Unit' % (cls.__name__, fontSize))
-        leading = style.get('leading', DEFAULT_LEADING)
-        assert isUnit(leading), ('%s.newString: Leading %s must be of type Unit' % (cls.__name__, leading))
-        inDesignFont = findFont(font)
         #strike = context.b.strike(indesignFont)
         #strike.size(fontSize.pt, leading.pt, units='pt')
         #if w is not None:
@@ -291,6 +626,40 @@ class InDesignString(BabelString):
         s = ''
         return cls(s, context=context, style=style) # Make real Indesign flavor BabelString here.
 
+    @classmethod
+    def _resolveStyle(cls, e, style):
+        """Answers the (uppercase, lowercase, capitalized, fontPath, font)
+        values of style for newString. The result is cached in
+        cls.RESOLVED_STYLES by font path and the style values, so the file
+        system check and font lookup only happen once per style. With an
+        element e the case values are inherited from e, so only the font
+        part can be cached."""
+        font = style.get('font')
+        if font is not None and not isinstance(font, str):
+            font = font.path
+        fontSize = style.get('fontSize', DEFAULT_FONT_SIZE)
+        leading = style.get('leading', DEFAULT_LEADING)
+
+        if e is None:
+            key = (font, bool(style.get('uppercase')), bool(style.get('lowercase')),
+                bool(style.get('capitalized')), str(fontSize), str(leading))
+        else:
+            key = (font, None, None, None, str(fontSize), str(leading))
+        resolved = cls.RESOLVED_STYLES.get(key)
+        if resolved is None:
+            assert isUnit(fontSize), ('%s.newString: FontSize %s must be of type Unit' % (cls.__name__, fontSize))
+            assert isUnit(leading), ('%s.newString: Leading %s must be of type Unit' % (cls.__name__, leading))
+            if font is None or not os.path.exists(font):
+                fontPath = DEFAULT_FONT_PATH
+            else:
+                fontPath = font
+            resolved = (key[1], key[2], key[3], fontPath, findFont(fontPath))
+            cls.RESOLVED_STYLES[key] = resolved
+        if e is not None:
+            resolved = (css('uppercase', e, style), css('lowercase', e, style),
+                css('capitalized', e, style)) + resolved[3:]
+        return resolved
+
 if __name__ == '__main__':
     import doctest
     import sys
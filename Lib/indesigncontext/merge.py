@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     merge.py
+#
+#     Data merge: outputs the pages of a template document once for every
+#     record of an iterator, with the {field} placeholders in the texts and
+#     image paths of the frames replaced by the values of the record. The
+#     frames of each record are copies that are released after they are
+#     output, and the script is streamed into files of a limited number of
+#     pages, so memory does not grow with the number of records.
+#
+import copy
+import itertools
+import os
+
+from pagebot.constants import FILETYPE_IDML
+from pagebot.toolbox.units import pt
+
+# Default maximum number of pages in one output file.
+PAGES_PER_FILE = 500
+
+class RecordFields(dict):
+    """Values of a record for str.format_map, that keeps the placeholders
+    of missing fields."""
+    def __missing__(self, key):
+        return '{%s}' % key
+
+def formatRecord(s, record):
+    """Answers s with the {field} placeholders replaced by the values of the
+    record dictionary. Unknown fields are kept, and text with braces that are
+    no placeholders is answered unchanged.
+
+    >>> formatRecord('{name}: {price} {currency}', dict(name='Chair', price=12.5))
+    'Chair: 12.5 {currency}'
+    >>> formatRecord('function() {}', dict(name='Chair'))
+    'function() {}'
+    """
+    if '{' not in s:
+        return s
+    try:
+        return s.format_map(RecordFields(record))
+    except (ValueError, IndexError, AttributeError, KeyError):
+        return s
+
+def getChunkPath(path, index):
+    """Answers the path of output file index (from 0) for path.
+
+    >>> getChunkPath('_export/Catalog.js', 0), getChunkPath('Catalog.idml', 11)
+    ('_export/Catalog-0001.js', 'Catalog-0012.idml')
+    """
+    root, extension = os.path.splitext(path)
+    return '%s-%04d%s' % (root, index + 1, extension)
+
+def mergeElement(e, record, setFields=None):
+    """Answers a shallow copy of the template frame e, with the fields of
+    record in its text and image path. Placeholders must be within one run
+    of the text. The style is copied too, so if defined, setFields(e, record)
+    can change the style and other attributes of the copy."""
+    merged = copy.copy(e)
+    if getattr(e, 'style', None) is not None:
+        merged.style = copy.copy(e.style)
+    bs = getattr(e, 'bs', None)
+    if bs is not None and '{' in bs.s:
+        mergedBs = bs.__class__('', bs.context)
+        mergedBs.runs = [(formatRecord(s, record), style) for s, style in bs.runs]
+        merged.bs = mergedBs
+    path = getattr(e, 'path', None)
+    if isinstance(path, str) and '{' in path:
+        merged.path = formatRecord(path, record)
+    if setFields is not None:
+        setFields(merged, record)
+    return merged
+
+def buildElement(e, view, origin):
+    """Build element e in view at origin, by the build hook of the builder
+    if e has one, as Element.buildChildElements() does."""
+    hook = 'build_' + view.context.b.PB_ID
+    if hasattr(e, hook):
+        getattr(e, hook)(view, origin)
+    else:
+        e.build(view, origin)
+
+def mergeRecords(context, template, records, path, pagesPerFile=PAGES_PER_FILE, setFields=None):
+    """Output the pages of the template Document for each record (a
+    dictionary of field values) of the records iterator, into files of at
+    most pagesPerFile pages (at least one record). Each file is a complete
+    document, named by getChunkPath(path, index), as script or as IDML if
+    path has an .idml extension. Scripts are streamed, IDML is collected
+    for one file at a time. The frames of FRAME_CLASSES that are direct
+    children of the template pages are output. The copies build themselves
+    in the view of the template, as PageView.build() builds the elements of
+    a page. Master extraction is off, as merged frames are different on
+    every page. Incremental and chunked export are off too, as the files
+    are new and already split by pagesPerFile. Answers the list of written
+    paths.
+
+    >>> import os, tempfile
+    >>> from pagebot.document import Document
+    >>> from pagebot.elements import newTextBox
+    >>> from indesigncontext.context import InDesignContext
+    >>> context = InDesignContext()
+    >>> template = Document(w=500, h=500, context=context)
+    >>> e = newTextBox('Product {name}', parent=template[1], x=50, y=50, w=200, h=50)
+    >>> path = os.path.join(tempfile.mkdtemp(), 'Catalog.js')
+    >>> records = (dict(name='P%d' % n) for n in range(5))
+    >>> paths = mergeRecords(context, template, records, path, pagesPerFile=2)
+    >>> [os.path.basename(path) for path in paths]
+    ['Catalog-0001.js', 'Catalog-0002.js', 'Catalog-0003.js']
+    >>> 'Product P4' in open(paths[2]).read()
+    True
+    """
+    b = context.b
+    templatePages = []
+    for pn, pnPages in template.getSortedPages():
+        templatePages += pnPages
+    recordsPerFile = max(1, pagesPerFile // max(1, len(templatePages)))
+    isIdml = path.lower().endswith('.' + FILETYPE_IDML)
+    records = iter(records)
+    paths = []
+    view = template.view
+    origin = view.pl, view.pb, pt(0) # As PageView.build()
+    options = b.extractMasters, b.collectIdml, b.incremental, b.pagesPerChunk
+    b.extractMasters, b.collectIdml, b.incremental, b.pagesPerChunk = False, isIdml, False, None
+    try:
+        while True:
+            # Only the records of one file are read ahead, not their elements.
+            fileRecords = list(itertools.islice(records, recordsPerFile))
+            if not fileRecords:
+                break
+            chunkPath = getChunkPath(path, len(paths))
+            if not isIdml:
+                b.openStream(chunkPath)
+            b.newDocument(doc=template, pageCount=len(fileRecords) * len(templatePages))
+            pageIndex = 0
+            for record in fileRecords:
+                for page in templatePages:
+                    b.newPage(page=page, pageIndex=pageIndex)
+                    for e in page.elements:
+                        if e.show and e.__class__.__name__ in b.FRAME_CLASSES:
+                            buildElement(mergeElement(e, record, setFields), view, origin)
+                    pageIndex += 1
+            if isIdml:
+                b.saveDocument(chunkPath)
+                b.jsOut = [] # Script of this file is not needed.
+                b._rows = []
+            else:
+                b.closeStream()
+            paths.append(chunkPath)
+    finally:
+        b.extractMasters, b.collectIdml, b.incremental, b.pagesPerChunk = options
+        if b.isStreaming: # Stopped by an exception.
+            b.closeStream()
+    return paths
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     profiling.py
+#
+#     Counts calls, time and emitted script bytes of builder and context
+#     methods. The methods are wrapped on the instance only while profiling,
+#     so there is no overhead when it is off.
+#
+import json
+import os
+import threading
+import time
+
+class Profiler:
+    """Collects the statistics of wrapped methods. Times are inclusive:
+    the time of a method includes the methods it calls. If trace is True,
+    all calls are kept as events for self.saveTrace().
+
+    >>> class Builder:
+    ...     def _out(self, s):
+    ...         pass
+    ...     def rect(self, x, y, e=None):
+    ...         self._out('pbElement = pbPage.rectangles.add();')
+    >>> b = Builder()
+    >>> profiler = Profiler(trace=True)
+    >>> profiler.wrap(b, ('rect',), outName='_out')
+    >>> b.rect(0, 0)
+    >>> b.rect(0, 0)
+    >>> stats = profiler.getSummary()['rect']
+    >>> stats['calls'], stats['bytes']
+    (2, 74)
+    >>> len(profiler.events)
+    2
+    >>> profiler.unwrap()
+    >>> 'rect' in b.__dict__
+    False
+
+    If a wrapped method calls another wrapped method for the same element,
+    only one of them records the element, so it is counted once.
+
+    >>> class Rect:
+    ...     pass
+    >>> class Context:
+    ...     def rect(self, x, y, e=None):
+    ...         b.rect(x, y, e=e)
+    >>> context = Context()
+    >>> profiler = Profiler()
+    >>> profiler.wrap(context, ('rect',), prefix='context.', elements=False)
+    >>> profiler.wrap(b, ('rect',), outName='_out')
+    >>> for n in range(3):
+    ...     context.rect(0, 0, e=Rect())
+    >>> summary = profiler.getSummary()
+    >>> summary['context.rect']['calls'], summary['rect']['calls'], summary['element.Rect']['calls']
+    (3, 3, 3)
+    >>> summary['element.Rect']['bytes'] == summary['rect']['bytes']
+    True
+    """
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.stats = {} # Name --> [calls, seconds, bytes]
+        self.events = [] # Chrome trace events, if self.trace
+        self.outBytes = 0 # Total of emitted script bytes.
+        self._wrapped = [] # List of (obj, names) to unwrap.
+        self._t0 = time.perf_counter()
+
+    def wrap(self, obj, names, prefix='', outName=None, elements=True):
+        """Wrap the methods of obj with names, recording them as prefix +
+        name. The method with outName is the one that emits script lines,
+        it is wrapped to count the emitted bytes. If elements is True, calls
+        with an element e are recorded for the class of e too. Set it to
+        False for methods that call other wrapped methods with the same
+        element, so the element is not recorded twice."""
+        wrapped = []
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is None or name in obj.__dict__:
+                continue # Missing or already wrapped.
+            setattr(obj, name, self._wrapMethod(prefix + name, method, elements))
+            wrapped.append(name)
+        if outName is not None and outName not in obj.__dict__:
+            out = getattr(obj, outName)
+            def countOut(s):
+                self.outBytes += len(s.encode('utf-8')) + 1 # Including newline.
+                return out(s)
+            setattr(obj, outName, countOut)
+            wrapped.append(outName)
+        self._wrapped.append((obj, wrapped))
+
+    def unwrap(self):
+        """Restore the original methods of all wrapped objects."""
+        for obj, names in self._wrapped:
+            for name in names:
+                obj.__dict__.pop(name, None)
+        self._wrapped = []
+
+    def _wrapMethod(self, name, method, elements=True):
+        def wrapper(*args, **kwargs):
+            outBytes = self.outBytes
+            t = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                e = kwargs.get('e') if elements else None
+                self.add(name, t, time.perf_counter(), self.outBytes - outBytes, e)
+        wrapper.__wrapped__ = method
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    def add(self, name, start, end, outBytes=0, e=None):
+        """Record a call of name from start to end (perf_counter times) that
+        emitted outBytes. If element e is given, then the call is recorded
+        for the class of e too."""
+        seconds = end - start
+        names = [name]
+        if e is not None:
+            names.append('element.' + e.__class__.__name__)
+        for n in names:
+            stats = self.stats.get(n)
+            if stats is None:
+                stats = self.stats[n] = [0, 0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += outBytes
+        if self.trace:
+            event = dict(name=name, ph='X', ts=(start - self._t0) * 1e6, dur=seconds * 1e6,
+                pid=os.getpid(), tid=threading.get_ident(), args=dict(bytes=outBytes))
+            if e is not None:
+                event['args']['element'] = e.__class__.__name__
+            self.events.append(event)
+
+    def getSummary(self):
+        """Answers the dictionary of name --> dict(calls, seconds, bytes),
+        sorted by decreasing time."""
+        summary = {}
+        for name, (calls, seconds, outBytes) in sorted(self.stats.items(), key=lambda item: -item[1][1]):
+            summary[name] = dict(calls=calls, seconds=seconds, bytes=outBytes)
+        return summary
+
+    def saveTrace(self, path):
+        """Write the events as Chrome trace file, to be opened in
+        chrome://tracing or https://ui.perfetto.dev"""
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit='ms'), f)
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
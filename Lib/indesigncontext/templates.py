@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     templates.py
+#
+#     Format strings of the script of elements and pages. The parts of an
+#     element are joined into one format once, for each combination of
+#     parts, so the script of an element is made by one % operation. Number
+#     fields are formatted from floats rounded by getNumbers(), instead of by
+#     Unit.__str__, the same as the rows of compact output. String fields
+#     (%s without quotes) get JS string literals, made by json.dumps().
+#
+from indesigncontext.bulk import DECIMALS, BOUND_FORMAT
+
+# Number field, for values answered by getNumbers()
+N = BOUND_FORMAT
+PT = '"' + N + 'pt"'
+
+FRAME = '/* %s */\npbElement = pbPage.%s.add({geometricBounds:[' + ', '.join([PT] * 4) + ']});'
+FILL = 'pbElement.fillColor = %s;'
+FILL_OPACITY = 'pbElement.fillTransparencySettings.blendingSettings.opacity = ' + N + ';'
+STROKE = 'pbElement.strokeColor = %s;\npbElement.strokeWeight = ' + PT + ';'
+STROKE_OPACITY = 'pbElement.strokeTransparencySettings.blendingSettings.opacity = ' + N + ';'
+# Places the image, or duplicates the frame where the asset key was placed.
+# FitOptions: http://jongware.mit.edu/idcs4js/pe_FitOptions.html
+IMAGE = ('pbElement = pbPlaceImage(pbElement, %s);\n'
+    'pbElement.fit(FitOptions.CONTENT_TO_FRAME);\npbElement.fit(FitOptions.CENTER_CONTENT);')
+IMAGE_KEY = ('pbElement = pbPlaceImage(pbElement, %s, %s);\n'
+    'pbElement.fit(FitOptions.CONTENT_TO_FRAME);\npbElement.fit(FitOptions.CENTER_CONTENT);')
+PROPORTIONAL = 'pbElement.fit(FitOptions.PROPORTIONALLY);'
+CONTENTS = 'pbElement.contents = %s;'
+PARAGRAPH_STYLE = 'pbElement.parentStory.paragraphs.item(0).appliedParagraphStyle = pbDoc.paragraphStyles.item(%s, false);'
+RUNS = 'pbSetRuns(pbElement.parentStory, %s, %s);'
+INSET = 'pbElement.textFramePreferences.insetSpacing = [' + ', '.join([PT] * 4) + ']; // top, left, bottom, right'
+
+PAGE_SIZE = ('pbPage.resize(CoordinateSpaces.INNER_COORDINATES,\n    AnchorPoint.CENTER_ANCHOR,\n'
+    '    ResizeMethods.REPLACING_CURRENT_DIMENSIONS_WITH,\n    [%d, %d]);')
+PAGE_MARGINS = ('pbPage.marginPreferences.top = ' + PT + ';\npbPage.marginPreferences.right = ' + PT + ';\n'
+    'pbPage.marginPreferences.bottom = ' + PT + ';\npbPage.marginPreferences.left = ' + PT + ';')
+
+_templates = {} # Tuple of parts --> format string
+
+def getTemplate(parts):
+    """Answers the format string of the tuple of parts, joined as lines.
+
+    >>> getTemplate((FILL, PROPORTIONAL)) % 'pbSwatches[0]'
+    'pbElement.fillColor = pbSwatches[0];\\npbElement.fit(FitOptions.PROPORTIONALLY);'
+    """
+    template = _templates.get(parts)
+    if template is None:
+        template = _templates[parts] = '\n'.join(parts)
+    return template
+
+def getPt(values):
+    """Answers the list of values (units or numbers) as pt numbers. Units
+    are converted by their pt property, that is much faster than upt().
+
+    >>> from pagebot.toolbox.units import pt, p
+    >>> getPt((pt(10), p(1), 2.5))
+    [10, 12, 2.5]
+    """
+    return [getattr(v, 'pt', v) for v in values]
+
+def getNumbers(values):
+    """Answers the list of values (units or numbers) as pt floats rounded to
+    DECIMALS, to be formatted by the N fields. -0.0 becomes 0.0, see getPt().
+
+    >>> N % tuple(getNumbers([1/3])), FRAME % tuple(['Rect', 'ovals'] + getNumbers([0, -0.0, 10, 20.5]))
+    ('0.3333', '/* Rect */\\npbElement = pbPage.ovals.add({geometricBounds:["0pt", "0pt", "10pt", "20.5pt"]});')
+    """
+    return [round(getattr(v, 'pt', v), DECIMALS) + 0.0 for v in values]
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])
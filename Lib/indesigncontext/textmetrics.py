@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+# -----------------------------------------------------------------------------
+#
+#     P A G E B O T
+#
+#     Copyright (c) 2016+ Buro Petr van Blokland + Claudia Mens
+#     www.pagebot.io
+#     Licensed under MIT conditions
+#
+#     Supporting DrawBot, www.drawbot.com
+#     Supporting Flat, xxyxyz.org/flat
+#     Supporting usage of InDesign API-scripting
+# -----------------------------------------------------------------------------
+#
+#     textmetrics.py
+#
+#     Measures and line-breaks InDesignString runs from the advance widths in
+#     the font files, so text fitting can be decided before the script is
+#     generated. It is an approximation of the InDesign composer: greedy line
+#     breaking on white space, no kerning, hyphenation or justification.
+#
+import re
+import weakref
+
+from pagebot.constants import DEFAULT_FONT_SIZE, DEFAULT_LEADING
+from pagebot.toolbox.units import upt
+from indesigncontext.caches import LRUCache
+
+# Advance width in em for characters that are not in the font, and for all
+# characters if the font cannot be read.
+FALLBACK_ADVANCE = 0.5
+
+# Words, white space and newlines, the units of line breaking.
+TOKENS = re.compile(r'\n|[^\S\n]+|[^\s]+')
+
+class AdvanceWidths(dict):
+    """Dictionary of character --> advance width in pt for one font size,
+    that looks up missing characters in the font once."""
+    def __init__(self, metrics, fontSize):
+        dict.__init__(self)
+        self.metrics = metrics
+        self.scale = fontSize / metrics.unitsPerEm
+
+    def __missing__(self, char):
+        width = self[char] = self.metrics.getAdvance(char) * self.scale
+        return width
+
+    def measure(self, s):
+        """Answers the width of string s in pt."""
+        return sum(map(self.__getitem__, s))
+
+class FontMetrics:
+    """Advance widths of the font at path, read once with fontTools. Use
+    FontMetrics.get(path) for the cached instance.
+
+    >>> metrics = FontMetrics(None) # No font, use fallback widths.
+    >>> metrics.getWidths(10).measure('Hello')
+    25.0
+    """
+    CACHE = LRUCache(maxSize=64)
+
+    def __init__(self, path):
+        self.path = path
+        self.unitsPerEm = 1000
+        self.advances = {} # Unicode --> advance in font units
+        self.defaultAdvance = FALLBACK_ADVANCE * self.unitsPerEm
+        self._widths = {} # fontSize --> AdvanceWidths
+        if path is not None:
+            self._read(path)
+
+    @classmethod
+    def get(cls, path):
+        metrics = cls.CACHE.get(path)
+        if metrics is None:
+            metrics = cls.CACHE[path] = cls(path)
+        return metrics
+
+    def _read(self, path):
+        try:
+            from fontTools.ttLib import TTFont
+            ttFont = TTFont(path, lazy=True)
+            self.unitsPerEm = ttFont['head'].unitsPerEm
+            cmap = ttFont.getBestCmap() or {}
+            hmtx = ttFont['hmtx'].metrics
+        except Exception: # Not a readable font, keep the fallback widths.
+            return
+        self.defaultAdvance = FALLBACK_ADVANCE * self.unitsPerEm
+        for uni, glyphName in cmap.items():
+            if glyphName in hmtx:
+                self.advances[uni] = hmtx[glyphName][0]
+        ttFont.close()
+
+    def getAdvance(self, char):
+        """Answers the advance width of char in font units."""
+        return self.advances.get(ord(char), self.defaultAdvance)
+
+    def getWidths(self, fontSize):
+        """Answers the cached AdvanceWidths for fontSize in pt."""
+        widths = self._widths.get(fontSize)
+        if widths is None:
+            widths = self._widths[fontSize] = AdvanceWidths(self, fontSize)
+        return widths
+
+class Line:
+    """Measured line of text. start and end are offsets in the string,
+    width excludes trailing white space."""
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.width = 0
+        self.height = 0
+
+    def __repr__(self):
+        return '<Line %d-%d w=%s h=%s>' % (self.start, self.end, round(self.width, 2), round(self.height, 2))
+
+# RunStyle --> (AdvanceWidths, line height, tracking), for the shared run styles.
+_RUN_METRICS = weakref.WeakKeyDictionary()
+
+def getRunMetrics(style, fontPath):
+    """Answers the (widths, leading, tracking) in pt for the run style."""
+    try:
+        return _RUN_METRICS[style]
+    except (KeyError, TypeError):
+        pass
+    fontSize = upt(style.get('fontSize', DEFAULT_FONT_SIZE))
+    leading = upt(style.get('leading', DEFAULT_LEADING), base=fontSize)
+    tracking = upt(style.get('tracking', 0), base=fontSize)
+    result = (FontMetrics.get(fontPath).getWidths(fontSize), leading, tracking)
+    try:
+        _RUN_METRICS[style] = result
+    except TypeError: # Plain dictionaries cannot be weak keys.
+        pass
+    return result
+
+def layoutText(text, runs, w=None):
+    """Answers the list of Line instances of text, broken greedily on white
+    space to fit width w (unlimited if w is None). runs is a list of
+    (start, end, widths, leading, tracking) for the styled parts of text.
+
+    >>> widths = FontMetrics(None).getWidths(10) # All characters 5pt
+    >>> text = 'Aaaa bbbb cc\\ndd'
+    >>> lines = layoutText(text, [(0, len(text), widths, 12, 0)], w=40)
+    >>> lines
+    [<Line 0-5 w=20.0 h=12>, <Line 5-13 w=35.0 h=12>, <Line 13-15 w=10.0 h=12>]
+    >>> [text[line.start:line.end] for line in lines]
+    ['Aaaa ', 'bbbb cc\\n', 'dd']
+    >>> layoutText('Aaaaaaaaaaaaaa', [(0, 14, widths, 12, 0)], w=20)
+    [<Line 0-4 w=20.0 h=12>, <Line 4-8 w=20.0 h=12>, <Line 8-12 w=20.0 h=12>, <Line 12-14 w=10.0 h=12>]
+    """
+    lines = []
+    line = Line(0)
+    lineWidth = 0 # Including trailing white space.
+    pending = None # Word (start, end, width, height) that may continue in the next run.
+
+    def placeWord(start, end, width, height):
+        nonlocal line, lineWidth
+        if w is not None and line.end > line.start and lineWidth + width > w:
+            lines.append(line)
+            line = Line(start)
+            lineWidth = 0
+        line.end = end
+        lineWidth += width
+        line.width = lineWidth
+        line.height = max(line.height, height)
+
+    for runStart, runEnd, widths, leading, tracking in runs:
+        for m in TOKENS.finditer(text, runStart, runEnd):
+            token = m.group()
+            start, end = m.span()
+            if token[0] == '\n' or token[0].isspace():
+                if pending is not None:
+                    placeWord(*pending)
+                    pending = None
+                if token == '\n':
+                    line.end = end
+                    line.height = max(line.height, leading)
+                    lines.append(line)
+                    line = Line(end)
+                    lineWidth = 0
+                else: # Spaces extend the line, but don't count for its width.
+                    line.end = end
+                    lineWidth += widths.measure(token) + tracking * len(token)
+                    line.height = max(line.height, leading)
+                continue
+            width = widths.measure(token) + tracking * len(token)
+            height = leading
+            merged = pending is not None and pending[1] == start
+            if merged: # Word continues over the run border.
+                start, width, height = pending[0], pending[2] + width, max(pending[3], leading)
+            pending = None
+            if w is not None and width > w and not merged: # Word does not fit any line, break by characters.
+                if line.end > line.start:
+                    lines.append(line)
+                    line = Line(start)
+                    lineWidth = 0
+                for index in range(start, end):
+                    charWidth = widths[text[index]] + tracking
+                    placeWord(index, index + 1, charWidth, leading)
+                continue
+            if end == runEnd:
+                pending = (start, end, width, height)
+            else:
+                placeWord(start, end, width, height)
+    if pending is not None:
+        placeWord(*pending)
+    if line.end > line.start or not lines:
+        lines.append(line)
+    return lines
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    sys.exit(doctest.testmod()[0])